@@ -242,6 +242,80 @@ class AffineSampler:
 		return chain_arr, weight_arr / correction_total
 
 
+class BatchAffineSampler:
+	'''An affine sampler which updates the ensemble in two halves (Foreman-Mackey, Hogg, Lang et al. 2012), so that
+	the proposals for an entire half can be evaluated with a single call to the log-density.'''
+	
+	def __init__(self, X0, f_logpdf, params, a=2.):
+		'''Initialize the batched affine sampler
+			X0: Initial ensemble of states, with shape (L, N). L must be even and greater than N.
+			f_logpdf: function which returns log p(X) for an array of states X with shape (M, N), returning shape (M,)
+			params: any parameters needed by f_logpdf
+			a: Dimensionless scale of stretch move. Must be greater than unity.'''
+		self.f_logpdf = f_logpdf
+		self.params = params
+		self.X = np.array(X0, dtype=np.float64)
+		self.L, self.N = self.X.shape
+		if self.L % 2 != 0:
+			raise ValueError('Number of samplers in ensemble must be even.')
+		self.pi_X = self.f_logpdf(self.X, self.params)
+		# Initialize the chain statistics
+		self.N_accepted = 0
+		self.N_rejected = 0
+		# Split the ensemble into two halves
+		self.halves = (np.arange(0, self.L/2), np.arange(self.L/2, self.L))
+		self.reset_chain()
+		self.set_scale(a)
+	
+	def set_scale(self, a):
+		'''Set the step size'''
+		self.a = a
+		self.sqrt_a = sqrt(a)
+	
+	def Z_stretch(self, size):
+		return ((self.sqrt_a - 1./self.sqrt_a) * np.random.random(size) + 1./self.sqrt_a)**2.
+	
+	def step(self):
+		'''Take one Metropolis-Hastings step for each sampler in ensemble'''
+		for S, C in (self.halves, self.halves[::-1]):
+			# Stretch each point in S past a random point in the complementary half
+			k = C[np.random.randint(0, C.size, size=S.size)]
+			Z = self.Z_stretch(S.size)
+			Y = self.X[k] + Z[:,None] * (self.X[S] - self.X[k])
+			pi_Y = self.f_logpdf(Y, self.params)
+			# Accept with probability Z^(n-1) p(Y) / p(X)
+			log_P_accept = (self.N - 1.) * np.log(Z) + pi_Y - self.pi_X[S]
+			accepted = np.log(np.random.random(S.size)) < log_P_accept
+			self.X[S[accepted]] = Y[accepted]
+			self.pi_X[S[accepted]] = pi_Y[accepted]
+			self.N_accepted += np.sum(accepted)
+			self.N_rejected += np.sum(~accepted)
+		# Log the state of the full ensemble
+		self.chain.append(self.X.copy())
+		self.pi_chain.append(self.pi_X.copy())
+	
+	def reset_chain(self):
+		'''Clear the chain'''
+		self.chain = []
+		self.pi_chain = []
+	
+	def get_acceptance(self):
+		'''Get the acceptance rate of the chain'''
+		return float(self.N_accepted) / float(self.N_accepted + self.N_rejected)
+	
+	def get_chain(self):
+		'''Return a numpy array containing the chain in the form [X_0, X_1, ...]'''
+		return np.array(self.chain).reshape(-1, self.N)
+	
+	def get_lnp(self):
+		'''Return a numpy array containing log p(X) for each element of the chain'''
+		return np.array(self.pi_chain).reshape(-1)
+	
+	def get_mean(self):
+		'''Return a numpy array containing the means of the chain'''
+		return np.mean(self.get_chain(), axis=0)
+
+
 def calc_mean(chain, weight):
 	'''Return a numpy array containing the means of the chain'''
 	N = len(chain[0])
@@ -0,0 +1,100 @@
+#!/usr/bin/env python2.7
+# -*- coding: utf-8 -*-
+#
+#       bench_evaluate.py
+#       
+#       Copyright 2012 Greg <greg@greg-G53JW>
+#       
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 2 of the License, or
+#       (at your option) any later version.
+#       
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#       
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#       MA 02110-1301, USA.
+#       
+#       
+
+import sys, argparse
+from time import time
+
+import numpy as np
+
+import healpix_utils as hputils
+
+
+def evaluate_loop(m, mu_eval):
+	'''
+	Reference implementation of ExtinctionMap.evaluate, which loops over
+	the distances and scans the anchors for each one.
+	'''
+	Ar_map = np.empty((len(mu_eval), m.Ar.shape[1]), dtype=np.float64)
+	Ar_map.fill(np.NaN)
+	
+	for k,mu in enumerate(mu_eval):
+		if (mu >= m.mu[0]) and (mu <= m.mu[-1]):
+			for i,mu_anchor in enumerate(m.mu[1:]):
+				if mu_anchor >= mu:
+					slope = (m.Ar[i+1] - m.Ar[i]) / (m.mu[i+1] - m.mu[i])
+					Ar_map[k] = m.Ar[i] + slope * (mu - m.mu[i])
+					break
+	
+	return Ar_map
+
+
+def main():
+	parser = argparse.ArgumentParser(prog='bench_evaluate.py', description='Time evaluation of an extinction map at many distances.', add_help=True)
+	parser.add_argument('-n', '--nside', type=int, default=512, help='Healpix nside parameter (default: 512).')
+	parser.add_argument('-a', '--anchors', type=int, default=21, help='# of distance anchors in map (default: 21).')
+	parser.add_argument('-d', '--distances', type=int, default=100, help='# of distances at which to evaluate map (default: 100).')
+	parser.add_argument('-f', '--fraction', type=float, default=1., help='Fraction of pixels which are valid (default: 1).')
+	parser.add_argument('-r', '--repeat', type=int, default=3, help='# of times to repeat each measurement (default: 3).')
+	parser.add_argument('-sgl', '--single', action='store_true', help='Evaluate into a preallocated single-precision buffer.')
+	parser.add_argument('-ref', '--reference', action='store_true', help='Also time the reference (loop-based) implementation.')
+	if 'python' in sys.argv[0]:
+		offset = 2
+	else:
+		offset = 1
+	values = parser.parse_args(sys.argv[offset:])
+	
+	# Generate a random map
+	mu = np.linspace(5., 20., values.anchors)
+	m = hputils.ExtinctionMap(nside=values.nside, mu=mu)
+	valid = np.random.random(m.Ar.shape[1]) < values.fraction
+	m.Ar[:, valid] = np.cumsum(0.1 * np.random.random((values.anchors, np.sum(valid))), axis=0)
+	mu_eval = np.linspace(4., 21., values.distances)
+	print 'nside = %d, %d anchors, %d distances, %d valid pixels' % (values.nside, values.anchors, values.distances, np.sum(valid))
+	
+	out = None
+	if values.single:
+		out = np.empty((mu_eval.size, m.Ar.shape[1]), dtype=np.float32)
+	
+	t = []
+	for i in xrange(values.repeat):
+		t_start = time()
+		Ar_map = m.evaluate(mu_eval, out=out)
+		t.append(time() - t_start)
+	print 'ExtinctionMap.evaluate: %.3f s (best of %d)' % (min(t), values.repeat)
+	
+	if values.reference:
+		t = []
+		for i in xrange(values.repeat):
+			t_start = time()
+			Ar_ref = evaluate_loop(m, mu_eval)
+			t.append(time() - t_start)
+		print 'Reference loop: %.3f s (best of %d)' % (min(t), values.repeat)
+		
+		diff = np.abs(Ar_map - Ar_ref)
+		print 'Max. difference: %.3g' % np.max(diff[np.isfinite(diff)])
+	
+	return 0
+
+if __name__ == '__main__':
+	main()
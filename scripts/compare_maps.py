@@ -0,0 +1,273 @@
+#!/usr/bin/env python2.7
+# -*- coding: utf-8 -*-
+#
+#       compare_maps.py
+#       
+#       Copyright 2012 Greg <greg@greg-G53JW>
+#       
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 2 of the License, or
+#       (at your option) any later version.
+#       
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#       
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#       MA 02110-1301, USA.
+#       
+#       
+
+
+import sys, argparse
+import json
+from os.path import abspath
+
+import numpy as np
+import healpy as hp
+
+import healpix_utils as hputils
+
+
+def common_grid(m1, m2):
+	'''
+	Bring two maps onto a common healpix grid. If their nside or
+	ordering differ, both are degraded (see ExtinctionMap.degrade) to
+	the coarser of the two nsides, in nested ordering.
+	'''
+	if (m1.nside == m2.nside) and (m1.nested == m2.nested):
+		return m1, m2
+	nside = min(m1.nside, m2.nside)
+	if (m1.nside != nside) or not m1.nested:
+		m1 = m1.degrade(nside)
+	if (m2.nside != nside) or not m2.nested:
+		m2 = m2.degrade(nside)
+	return m1, m2
+
+
+def common_mu(m1, m2):
+	'''
+	Distance moduli at which to compare two maps: the anchors of both
+	maps, within the range covered by both. Raises ValueError if the
+	maps do not cover a common range of distance moduli.
+	'''
+	mu_min = max(m1.mu[0], m2.mu[0])
+	mu_max = min(m1.mu[-1], m2.mu[-1])
+	mu = np.union1d(m1.mu, m2.mu)
+	mu = mu[(mu >= mu_min) & (mu <= mu_max)]
+	if mu.size == 0:
+		raise ValueError('Maps cover disjoint ranges of distance modulus (%.2f - %.2f and %.2f - %.2f).' % (m1.mu[0], m1.mu[-1], m2.mu[0], m2.mu[-1]))
+	return mu
+
+
+def pixel_fits(m, pix_index):
+	'''
+	Return N_stars and measure of the map at the given pixels.
+	'''
+	if m.is_sparse():
+		col = hputils.pixel_columns(m.sparse_index, pix_index)[0]
+	else:
+		col = pix_index
+	return np.asarray(m.N_stars[col], dtype=np.float64), np.asarray(m.measure[col], dtype=np.float64)
+
+
+def compare(m1, m2, mu_eval=None, diff_range=1., N_bins=100, outlier=0.1, N_outliers=20, chunk_size=2**16):
+	'''
+	Compare two extinction maps pixel by pixel, in chunks of
+	<chunk_size> pixels, after bringing them onto a common grid.
+	
+	Input:
+	    m1, m2      Reference and new ExtinctionMap
+	    mu_eval     Distance moduli at which to compare the maps (default:
+	                see common_mu)
+	    diff_range  Histograms of Ar2 - Ar1 cover [-diff_range, diff_range],
+	                with values beyond clipped into the outermost bins
+	    N_bins      # of histogram bins
+	    outlier     Pixels with |Ar2 - Ar1| > outlier at any distance are
+	                counted as outliers
+	    N_outliers  # of largest outliers to list
+	
+	Output:
+	    report      Dictionary of summary statistics (see format_report)
+	'''
+	m1, m2 = common_grid(m1, m2)
+	if mu_eval is None:
+		mu_eval = common_mu(m1, m2)
+	mu_eval = np.atleast_1d(np.array(mu_eval, dtype=np.float64))
+	N_mu = mu_eval.size
+	
+	# Coverage
+	pix1 = m1.valid_pixels()
+	pix2 = m2.valid_pixels()
+	pix_index = np.intersect1d(pix1, pix2)
+	coverage = {'both':int(pix_index.size), 'only_1':int(pix1.size - pix_index.size), 'only_2':int(pix2.size - pix_index.size)}
+	del pix1, pix2
+	
+	# Accumulators
+	edges = np.linspace(-diff_range, diff_range, N_bins+1)
+	hist = np.zeros((N_mu, N_bins), dtype=np.int64)
+	N = np.zeros(N_mu, dtype=np.int64)
+	sum_diff = np.zeros(N_mu, dtype=np.float64)
+	sum_diff2 = np.zeros(N_mu, dtype=np.float64)
+	max_abs = np.zeros(N_mu, dtype=np.float64)
+	N_over = np.zeros(N_mu, dtype=np.int64)
+	N_chi, sum_chi, sum_chi2, N_chi_up = 0, 0., 0., 0
+	worst_pix = np.zeros(0, dtype=np.int64)
+	worst_diff = np.zeros(0, dtype=np.float64)
+	worst_k = np.zeros(0, dtype=np.int64)
+	dof_1 = m1.mu.size + 1
+	dof_2 = m2.mu.size + 1
+	
+	for start in xrange(0, pix_index.size, chunk_size):
+		pix = pix_index[start:start+chunk_size]
+		diff = m2.evaluate(mu_eval, pix) - m1.evaluate(mu_eval, pix)
+		valid = np.isfinite(diff)
+		
+		# Differences at each distance
+		diff_clipped = np.clip(np.where(valid, diff, 0.), edges[0], edges[-1])
+		bin_index = np.minimum(np.searchsorted(edges, diff_clipped, side='right') - 1, N_bins-1)
+		for k in xrange(N_mu):
+			hist[k] += np.bincount(bin_index[k][valid[k]], minlength=N_bins)
+		diff[~valid] = 0.
+		abs_diff = np.abs(diff)
+		N += np.sum(valid, axis=1)
+		sum_diff += np.sum(diff, axis=1)
+		sum_diff2 += np.sum(diff * diff, axis=1)
+		if pix.size != 0:
+			max_abs = np.maximum(max_abs, np.max(abs_diff, axis=1))
+		N_over += np.sum(abs_diff > outlier, axis=1)
+		
+		# Largest outliers, over all distances
+		k_max = np.argmax(abs_diff, axis=0)
+		diff_max = abs_diff[k_max, np.arange(pix.size)]
+		sel = (diff_max > outlier)
+		worst_pix = np.concatenate([worst_pix, pix[sel]])
+		worst_diff = np.concatenate([worst_diff, diff[k_max[sel], np.where(sel)[0]]])
+		worst_k = np.concatenate([worst_k, k_max[sel]])
+		if worst_pix.size > N_outliers:
+			keep = np.argsort(-np.abs(worst_diff), kind='mergesort')[:N_outliers]
+			worst_pix, worst_diff, worst_k = worst_pix[keep], worst_diff[keep], worst_k[keep]
+		
+		# Change in goodness of fit
+		N_stars_1, measure_1 = pixel_fits(m1, pix)
+		N_stars_2, measure_2 = pixel_fits(m2, pix)
+		chi_diff = measure_2 / (N_stars_2 - dof_2) - measure_1 / (N_stars_1 - dof_1)
+		chi_diff = chi_diff[np.isfinite(chi_diff)]
+		N_chi += chi_diff.size
+		sum_chi += np.sum(chi_diff)
+		sum_chi2 += np.sum(chi_diff * chi_diff)
+		N_chi_up += np.sum(chi_diff > 0.)
+	
+	# Summary statistics at each distance
+	diff_stats = []
+	for k in xrange(N_mu):
+		stats = {'mu':float(mu_eval[k]), 'N':int(N[k]), 'N_outliers':int(N_over[k]), 'max_abs':float(max_abs[k])}
+		if N[k] != 0:
+			stats['mean'] = float(sum_diff[k] / N[k])
+			stats['rms'] = float(np.sqrt(sum_diff2[k] / N[k]))
+			stats['median'] = float(hist_quantile(hist[k], edges, 0.5))
+		diff_stats.append(stats)
+	
+	chi2dof = {'N':int(N_chi)}
+	if N_chi != 0:
+		chi2dof['mean_diff'] = float(sum_chi / N_chi)
+		chi2dof['rms_diff'] = float(np.sqrt(sum_chi2 / N_chi))
+		chi2dof['frac_increased'] = float(N_chi_up) / float(N_chi)
+	
+	outliers = []
+	if worst_pix.size != 0:
+		order = np.argsort(-np.abs(worst_diff), kind='mergesort')
+		theta, phi = hp.pix2ang(m1.nside, worst_pix[order], nest=m1.nested)
+		l, b = hputils.thetaphi2lb(theta, phi)
+		for i,j in enumerate(order):
+			outliers.append({'pix':int(worst_pix[j]), 'l':float(l[i]), 'b':float(b[i]), 'mu':float(mu_eval[worst_k[j]]), 'diff':float(worst_diff[j])})
+	
+	report = {'nside':int(m1.nside), 'nested':bool(m1.nested), 'mu':[float(mu) for mu in mu_eval],
+	          'coverage':coverage, 'diff':diff_stats, 'chi2dof':chi2dof, 'outlier_threshold':float(outlier), 'outliers':outliers,
+	          'histogram':{'edges':[float(e) for e in edges], 'counts':hist.tolist()}}
+	
+	return report
+
+
+def hist_quantile(counts, edges, q):
+	'''
+	Estimate a quantile from a histogram, interpolating linearly within
+	bins.
+	'''
+	cdf = np.concatenate([[0.], np.cumsum(counts, dtype=np.float64)])
+	if cdf[-1] == 0.:
+		return np.NaN
+	return np.interp(q * cdf[-1], cdf, edges)
+
+
+def format_report(report):
+	'''
+	Format a report produced by compare as text.
+	'''
+	lines = []
+	cov = report['coverage']
+	lines.append('nside = %d (%s)' % (report['nside'], 'nested' if report['nested'] else 'ring'))
+	lines.append('Pixels in both maps: %d, only in map 1: %d, only in map 2: %d' % (cov['both'], cov['only_1'], cov['only_2']))
+	lines.append('')
+	lines.append('Ar2 - Ar1 (outliers: |diff| > %.3g):' % report['outlier_threshold'])
+	lines.append('%8s %9s %9s %9s %9s %9s %9s' % ('mu', 'N', 'mean', 'median', 'rms', 'max|diff|', 'outliers'))
+	for s in report['diff']:
+		if s['N'] == 0:
+			lines.append('%8.2f %9d %9s %9s %9s %9s %9d' % (s['mu'], 0, '-', '-', '-', '-', 0))
+		else:
+			lines.append('%8.2f %9d %9.4f %9.4f %9.4f %9.4f %9d' % (s['mu'], s['N'], s['mean'], s['median'], s['rms'], s['max_abs'], s['N_outliers']))
+	lines.append('')
+	chi = report['chi2dof']
+	if chi['N'] != 0:
+		lines.append('chi2/dof (2 - 1): mean %.4g, rms %.4g, increased in %.1f%% of %d pixels' % (chi['mean_diff'], chi['rms_diff'], 100.*chi['frac_increased'], chi['N']))
+	if len(report['outliers']) != 0:
+		lines.append('')
+		lines.append('Largest differences:')
+		lines.append('%10s %8s %8s %8s %9s' % ('pixel', 'l', 'b', 'mu', 'diff'))
+		for o in report['outliers']:
+			lines.append('%10d %8.3f %8.3f %8.2f %9.4f' % (o['pix'], o['l'], o['b'], o['mu'], o['diff']))
+	return '\n'.join(lines)
+
+
+def main():
+	parser = argparse.ArgumentParser(prog='compare_maps.py', description='Compare two extinction maps pixel by pixel, and report differences in Ar, coverage and goodness of fit.', add_help=True)
+	parser.add_argument('map1', type=str, help='Reference extinction map (FITS).')
+	parser.add_argument('map2', type=str, help='Extinction map (FITS) to compare against the reference.')
+	parser.add_argument('-mu', '--mu', type=float, nargs='+', default=None, help='Distance moduli at which to compare maps (default: anchors of both maps, within their common range).')
+	parser.add_argument('-r', '--range', type=float, default=1., help='Histograms of differences cover [-range, range] (default: 1).')
+	parser.add_argument('-nb', '--bins', type=int, default=100, help='# of histogram bins (default: 100).')
+	parser.add_argument('-out', '--outlier', type=float, default=0.1, help='Threshold in |Ar2 - Ar1| for outlying pixels (default: 0.1).')
+	parser.add_argument('-no', '--N_outliers', type=int, default=20, help='# of largest outliers to list (default: 20).')
+	parser.add_argument('-ch', '--chunk', type=int, default=2**16, help='# of pixels to process at once (default: 2^16).')
+	parser.add_argument('-j', '--json', type=str, default=None, help='Write the full report (including histograms) to a JSON file.')
+	if 'python' in sys.argv[0]:
+		offset = 2
+	else:
+		offset = 1
+	values = parser.parse_args(sys.argv[offset:])
+	
+	m1 = hputils.ExtinctionMap(abspath(values.map1), FITS=True, lazy=True)
+	m2 = hputils.ExtinctionMap(abspath(values.map2), FITS=True, lazy=True)
+	try:
+		report = compare(m1, m2, mu_eval=values.mu, diff_range=values.range, N_bins=values.bins, outlier=values.outlier, N_outliers=values.N_outliers, chunk_size=values.chunk)
+	except ValueError as e:
+		print 'Error: %s' % e
+		return 1
+	report['map1'] = abspath(values.map1)
+	report['map2'] = abspath(values.map2)
+	
+	print format_report(report)
+	
+	if values.json is not None:
+		f = open(values.json, 'w')
+		json.dump(report, f, indent=1, sort_keys=True)
+		f.close()
+	
+	return 0
+
+if __name__ == '__main__':
+	main()
@@ -27,6 +27,7 @@
 import sys, argparse
 from os.path import abspath, exists
 from time import time
+import multiprocessing
 
 import numpy as np
 import scipy.ndimage.filters as filters
@@ -42,6 +43,7 @@ import matplotlib.pyplot as plt
 
 from galstar_io import *
 from galstarutils import get_objects
+from AffineSampling import BatchAffineSampler
 import healpix_utils as hputils
 
 
@@ -113,6 +115,46 @@ def line_integral(Delta_y, img):
 	return line_int_ret
 
 
+# Compute the line integral through the images stacked in <img> for each set of steps stacked in <Delta_y>
+def line_integral_batch(Delta_y, img, max_elements=2**22):
+	'''
+	Vectorized version of line_integral, which evaluates many reddening
+	profiles at once. Returns an array of shape (N_profiles, N_images).
+	The stacked images are processed in chunks of profiles, so that no
+	more than <max_elements> interpolated pixels are held at once.
+	'''
+	Delta_y = np.atleast_2d(Delta_y)
+	N_profiles = Delta_y.shape[0]
+	N_regions = Delta_y.shape[1] - 1
+	if img.shape[1] % N_regions != 0:
+		raise Exception('Number of samples in mu (%d) not integer multiple of number of piecewise linear regions (%d).' % (img.shape[1], N_regions))
+	N_images, N_x, y_max = img.shape
+	N_samples = N_x / N_regions
+	
+	# Reddening at the start of each sample in mu
+	dy = np.repeat(Delta_y[:,1:] / float(N_samples), N_samples, axis=1)
+	y = Delta_y[:,:1] + np.cumsum(dy, axis=1) - dy
+	y_floor = np.floor(y)
+	y_ceil = np.ceil(y)
+	
+	# Stop integrating once the profile leaves the image
+	valid = np.cumprod((y_ceil < y_max) & (y_floor >= 0), axis=1).astype(np.bool)
+	w_floor = np.where(valid, y_ceil - y, 0.)
+	w_ceil = np.where(valid, y - y_floor, 0.)
+	y_floor = np.where(valid, y_floor, 0).astype(np.int64)
+	y_ceil = np.where(valid, y_ceil, 0).astype(np.int64)
+	
+	x = np.arange(N_x)
+	line_int_ret = np.empty((N_profiles, N_images), dtype=np.float64)
+	chunk = max(1, max_elements / (N_images * N_x))
+	for s in xrange(0, N_profiles, chunk):
+		e = min(s + chunk, N_profiles)
+		line_int_ret[s:e] = np.einsum('kpx,px->pk', img[:, x, y_floor[s:e]], w_floor[s:e])
+		line_int_ret[s:e] += np.einsum('kpx,px->pk', img[:, x, y_ceil[s:e]], w_ceil[s:e])
+	
+	return line_int_ret
+
+
 # Return chi for the model with steps in reddening given by <log_Delta_y>
 def chi_leastsq(log_Delta_y, pdfs=None, p0=1.e-5, regulator=10000.):
 	Delta_y = np.exp(log_Delta_y)
@@ -252,6 +294,115 @@ def min_nlopt(pdfs, guess, p0=1.e-5, regulator=1000., maxtime=25., maxeval=10000
 	return x, success, measure
 
 
+# Return the measure used by NLopt for each set of steps stacked in <Delta_y>, optionally weighting each star
+def batch_measure(Delta_y, pdfs, p0=1.e-5, regulator=1000., Delta_y_neighbor=None, weight_neighbor=None, weight_stars=None):
+	measure = line_integral_batch(Delta_y, pdfs)
+	measure += p0 * np.exp(-measure/p0)
+	if weight_stars is None:
+		measure = -np.sum(np.log(measure), axis=1)
+	else:
+		measure = -np.dot(np.log(measure), weight_stars)
+	
+	measure += np.sum(Delta_y[:,1:]*Delta_y[:,1:], axis=1) / (2.*regulator*regulator)
+	
+	# Tie this pixel to neighbors
+	if Delta_y_neighbor is not None:
+		Delta_y_tension = weight_neighbor[None,:] * (Delta_y_neighbor[None,:,:] - Delta_y[:,None,:]).swapaxes(1,2) / (2. * 10. * 10.)
+		measure += np.sum(np.sum(Delta_y_tension * Delta_y_tension, axis=2), axis=1)
+	
+	return measure
+
+
+# Log posterior density for an ensemble of walkers, with the same bounds as min_nlopt
+def mcmc_logpdf(Delta_y, params):
+	pdfs, p0, regulator, upper, Delta_y_neighbor, weight_neighbor = params
+	
+	logp = np.empty(Delta_y.shape[0], dtype=np.float64)
+	logp.fill(-np.inf)
+	idx = np.all((Delta_y >= 1.e-10) & (Delta_y <= upper), axis=1)
+	if np.any(idx):
+		logp[idx] = -batch_measure(Delta_y[idx], pdfs, p0, regulator, Delta_y_neighbor, weight_neighbor)
+	
+	return logp
+
+
+# Sample the posterior with an ensemble sampler, returning the best sample found along with the chain
+def sample_mcmc(pdfs, guess, p0=1.e-5, regulator=1000., N_walkers=None, N_burnin=100, N_steps=200, Delta_Ar_neighbor=None, weight_neighbor=None):
+	N_regions = guess.size - 1
+	if N_walkers == None:
+		N_walkers = 4 * (N_regions + 1)
+	N_walkers += N_walkers % 2
+	upper = max(float(pdfs.shape[2]), 1.2*np.max(guess))
+	params = (pdfs, p0, regulator, upper, Delta_Ar_neighbor, weight_neighbor)
+	
+	# Start the walkers in a small ball around the guess
+	X0 = guess[None,:] * (1. + 0.1 * np.random.randn(N_walkers, N_regions+1))
+	X0 = np.clip(np.abs(X0), 1.e-5, upper)
+	sampler = BatchAffineSampler(X0, mcmc_logpdf, params, a=2.)
+	
+	for i in xrange(N_burnin):
+		sampler.step()
+	sampler.reset_chain()
+	for i in xrange(N_steps):
+		sampler.step()
+	
+	chain = sampler.get_chain()
+	lnp = sampler.get_lnp()
+	k = np.argmax(lnp)
+	sys.stderr.write('Acceptance rate: %.3f\n' % sampler.get_acceptance())
+	
+	return chain[k], int(np.isfinite(lnp[k])), -lnp[k], chain
+
+
+# Data shared with the bootstrap worker processes, which inherit it when forked
+_bootstrap_data = None
+
+
+def bootstrap_weights(N_stars, N_replicates):
+	'''
+	Draw bootstrap resamplings of the stars, expressed as the number of
+	times each star is drawn in each replicate.
+	'''
+	p = np.ones(N_stars, dtype=np.float64) / float(N_stars)
+	return np.random.multinomial(N_stars, p, size=N_replicates).astype(np.float64)
+
+
+# Refit one bootstrap replicate, starting from the main solution
+def min_bootstrap(weight_stars):
+	pdfs, x0, p0, regulator, maxeval, Delta_y_neighbor, weight_neighbor = _bootstrap_data
+	N_regions = x0.size - 1
+	
+	opt = nlopt.opt(nlopt.LN_COBYLA, N_regions+1)
+	lower = np.empty(N_regions+1, dtype=np.float64)
+	upper = np.empty(N_regions+1, dtype=np.float64)
+	lower.fill(1.e-10)
+	upper.fill(max(float(pdfs.shape[2]), 1.2*np.max(x0)))
+	opt.set_lower_bounds(lower)
+	opt.set_upper_bounds(upper)
+	opt.set_initial_step(1.)
+	opt.set_maxeval(maxeval)
+	opt.set_min_objective(lambda x, grad: batch_measure(x[None,:], pdfs, p0, regulator, Delta_y_neighbor, weight_neighbor, weight_stars)[0])
+	
+	return opt.optimize(np.clip(x0, lower, upper))
+
+
+# Estimate the spread in the reddening profile by refitting bootstrap resamplings of the stars
+def bootstrap_los(pdfs, x0, p0=1.e-5, regulator=1000., N_replicates=100, N_procs=None, maxeval=1000, Delta_y_neighbor=None, weight_neighbor=None):
+	global _bootstrap_data
+	_bootstrap_data = (pdfs, x0, p0, regulator, maxeval, Delta_y_neighbor, weight_neighbor)
+	weight_stars = bootstrap_weights(pdfs.shape[0], N_replicates)
+	
+	pool = multiprocessing.Pool(N_procs)
+	try:
+		x = pool.map(min_bootstrap, list(weight_stars))
+	finally:
+		pool.close()
+		pool.join()
+	_bootstrap_data = None
+	
+	return np.array(x, dtype=np.float64)
+
+
 def min_brute(pdfs, guess, p0=1.e-5, regulator=10000.):
 	N_regions = guess.size - 1
 	ranges = [(-5., 5.) for i in xrange(N_regions+1)]
@@ -344,7 +495,10 @@ def gen_guess(pdfs, N_regions=15):
 
 
 # Fit line-of-sight reddening profile, given the binned pdfs in <bin_fname> and stats in <stats_fname>
-def fit_los(bin_fname, stats_fname, N_regions, sparse=True, converged=False, method='anneal', smooth=(1,1), regulator=10000., dwell=1000, maxtime=25., maxeval=10000, p0=1.e-5, ev_range=25., iterate=None):
+def fit_los(bin_fname, stats_fname, N_regions, sparse=True, converged=False, method='anneal', smooth=(1,1), regulator=10000., dwell=1000, maxtime=25., maxeval=10000, p0=1.e-5, ev_range=25., iterate=None, N_walkers=None, N_burnin=100, N_steps=200, N_bootstrap=0, N_procs=None):
+	if (method == 'mcmc') and (N_bootstrap > 0):
+		raise ValueError('Bootstrap replicates cannot be combined with MCMC sampling: both provide the samples of the reddening profile.')
+	
 	# Load pdfs
 	sys.stderr.write('Loading binned pdfs...\n')
 	bounds, p = load_bins(bin_fname, sparse)
@@ -374,7 +528,7 @@ def fit_los(bin_fname, stats_fname, N_regions, sparse=True, converged=False, met
 	guess_line_int = line_integral(guess, p)
 	
 	# Fit reddening profile
-	x, success, measure = None, None, None
+	x, success, measure, chain = None, None, None, None
 	if method == 'leastsq':
 		sys.stderr.write('Fitting reddening profile using the LM method (scipy.optimize.leastsq)...\n')
 		x, success, measure = min_leastsq(p, guess, p0=p0, regulator=regulator)
@@ -390,6 +544,14 @@ def fit_los(bin_fname, stats_fname, N_regions, sparse=True, converged=False, met
 	elif method == 'nlopt CRS':
 		sys.stderr.write('Fitting reddening profile using NLopt (nlopt.GN_CRS2_LM)...\n')
 		x, success, measure = min_nlopt(p, guess, p0=p0, regulator=regulator, maxtime=maxtime, maxeval=maxeval, algorithm='CRS')
+	elif method == 'mcmc':
+		sys.stderr.write('Sampling reddening profile using the affine-invariant ensemble sampler...\n')
+		x, success, measure, chain = sample_mcmc(p, guess, p0=p0, regulator=regulator, N_walkers=N_walkers, N_burnin=N_burnin, N_steps=N_steps, Delta_Ar_neighbor=Delta_Ar_neighbor, weight_neighbor=weight_neighbor)
+	
+	# Refit bootstrap resamplings of the stars, starting from the best fit
+	if N_bootstrap > 0:
+		sys.stderr.write('Refitting %d bootstrap replicates...\n' % N_bootstrap)
+		chain = bootstrap_los(p, x, p0=p0, regulator=regulator, N_replicates=N_bootstrap, N_procs=N_procs, maxeval=maxeval, Delta_y_neighbor=Delta_Ar_neighbor, weight_neighbor=weight_neighbor)
 	
 	measure = nlopt_measure(x, np.array([]), p, p0, regulator, Delta_Ar_neighbor, weight_neighbor)
 	line_int = line_integral(x, p)
@@ -398,6 +560,9 @@ def fit_los(bin_fname, stats_fname, N_regions, sparse=True, converged=False, met
 	
 	# Convert output into physical coordinates (rather than pixel coordinates)
 	Delta_Ar = x * ((bounds[3] - bounds[2]) / float(p.shape[2]))
+	Delta_Ar_samples = None
+	if chain is not None:
+		Delta_Ar_samples = chain * ((bounds[3] - bounds[2]) / float(p.shape[2]))
 	
 	# Output basic information about fit
 	sys.stderr.write('Delta_Ar: %s\n' % np.array_str(Delta_Ar, max_line_width=N_regions*100, precision=8))
@@ -406,7 +571,7 @@ def fit_los(bin_fname, stats_fname, N_regions, sparse=True, converged=False, met
 	sys.stderr.write('Extreme outliers: %d of %d\n' % (N_outliers, line_int.size))
 	sys.stderr.write('Outliers (below softening limit): %d of %d\n\n' % (N_softened, line_int.size))
 	
-	return bounds, p, line_int, guess_line_int, measure, success, Delta_Ar, guess_Delta_Ar, Delta_Ar_mean
+	return bounds, p, line_int, guess_line_int, measure, success, Delta_Ar, guess_Delta_Ar, Delta_Ar_mean, Delta_Ar_samples
 
 
 
@@ -560,13 +725,11 @@ def output_profile(fname, pixnum, bounds, Delta_Ar, N_stars, line_int, measure,
 		Ar_anchors	(float64) x (N_regions + 1)
 	'''
 	
-	# Calculate reddening profile
+	# Calculate reddening profile (Ar at anchor i is the sum of Delta_Ar[:i+1],
+	# as in line_integral)
 	N_regions = Delta_Ar.size - 1
 	mu_anchors = np.linspace(bounds[0], bounds[1], N_regions+1).astype(np.float64)
-	Ar_anchors = np.empty(N_regions+1, dtype=np.float64)
-	Ar_anchors[0] = bounds[2] + Delta_Ar[0]
-	for i in xrange(1, N_regions+1):
-		Ar_anchors[i] = bounds[2] + np.sum(Delta_Ar[:i])
+	Ar_anchors = (bounds[2] + np.cumsum(Delta_Ar)).astype(np.float64)
 	
 	# Append to end of file <fname>
 	f = open(fname, 'ab')
@@ -580,19 +743,67 @@ def output_profile(fname, pixnum, bounds, Delta_Ar, N_stars, line_int, measure,
 	f.close()
 
 
+def output_envelope(fname, pixnum, bounds, Delta_Ar_samples, percentiles=(15.87, 50., 84.13)):
+	'''
+	Append percentiles of the reddening profile, taken over a set of
+	samples of Delta_Ar, to the end of the binary file given by <fname>.
+	
+	Format - for each pixel:
+		pixnum		(uint64)
+		N_pct		(uint16)
+		N_regions	(uint16)
+		percentiles	(float64) x N_pct
+		mu_anchors	(float64) x (N_regions + 1)
+		Ar_pct		(float64) x N_pct x (N_regions + 1)
+	'''
+	
+	# Calculate percentiles of Ar at each anchor
+	N_regions = Delta_Ar_samples.shape[1] - 1
+	percentiles = np.array(percentiles, dtype=np.float64)
+	mu_anchors = np.linspace(bounds[0], bounds[1], N_regions+1).astype(np.float64)
+	Ar_samples = bounds[2] + np.cumsum(Delta_Ar_samples, axis=1)
+	Ar_pct = np.array([np.percentile(Ar_samples, pct, axis=0) for pct in percentiles], dtype=np.float64)
+	
+	# Append to end of file <fname>
+	f = open(fname, 'ab')
+	f.write(np.array([pixnum], dtype=np.uint64).tostring())
+	f.write(np.array([percentiles.size, N_regions], dtype=np.uint16).tostring())
+	f.write(percentiles.tostring())
+	f.write(mu_anchors.tostring())
+	f.write(Ar_pct.tostring())
+	f.close()
+
+
 
 #
 # Load in neighboring pixels
 #
 
+# Extinction maps opened by get_neighbors, by filename
+_neighbor_maps = {}
+
 def get_neighbors(map_fname, pixindex, mu_anchors=None):
-	m = hputils.ExtinctionMap(map_fname, FITS=True)
+	'''
+	Return the reddening in each distance bin of the pixels neighboring
+	<pixindex>, along with the weight assigned to each neighbor. The map
+	in <map_fname> is memory-mapped the first time it is needed, and
+	only the neighboring pixels are read from it. An ExtinctionMap may
+	also be passed in place of a filename.
+	'''
+	if isinstance(map_fname, hputils.ExtinctionMap):
+		m = map_fname
+	else:
+		map_fname = abspath(map_fname)
+		if map_fname not in _neighbor_maps:
+			_neighbor_maps[map_fname] = hputils.ExtinctionMap(map_fname, FITS=True, lazy=True)
+		m = _neighbor_maps[map_fname]
 	
-	if mu_anchors == None:
+	if mu_anchors is None:
 		mu_anchors = m.mu
 	
-	# Query neighboring pixels
+	# Query neighboring pixels (healpy marks missing neighbors with -1)
 	neighbor_index = hp.pixelfunc.get_all_neighbours(m.nside, pixindex, nest=m.nested)
+	neighbor_index = neighbor_index[neighbor_index >= 0]
 	Delta_Ar = m.evaluate(mu_anchors, pix_index=neighbor_index)
 	Delta_Ar[1:] = Delta_Ar[1:] - Delta_Ar[:-1]
 	mask = np.isfinite(Delta_Ar[0,:])
@@ -602,9 +813,7 @@ def get_neighbors(map_fname, pixindex, mu_anchors=None):
 	# Assign weight to each pixel based on distance
 	theta, phi = hp.pix2ang(m.nside, neighbor_index, nest=m.nested)
 	theta_0, phi_0 = hp.pix2ang(m.nside, pixindex, nest=m.nested)
-	print theta - theta_0
-	print phi - phi_0
-	dist = np.arccos(np.sin(theta_0) * np.sin(theta) + np.cos(theta_0) * np.cos(theta) * np.cos(phi - phi_0))
+	dist = hputils.angular_distance(theta_0, phi_0, theta, phi)
 	sigma_dist = hp.pixelfunc.nside2resol(m.nside, arcmin=False)
 	weight = np.exp(-dist * dist / (2. * sigma_dist * sigma_dist))
 	weight /= np.sum(weight)
@@ -624,7 +833,7 @@ def main():
 	parser.add_argument('binfn', type=str, help='File containing binned probability density functions for each star along l.o.s. (also accepts gzipped files)')
 	parser.add_argument('statsfn', type=str, help='File containing summary statistics for each star.')
 	parser.add_argument('-N', '--N', type=int, default=20, help='# of piecewise-linear regions in DM-Ar relation (default: 20)')
-	parser.add_argument('-mtd', '--method', type=str, choices=('anneal', 'leastsq', 'brute', 'nlopt CRS', 'nlopt MLSL'), default='nlopt CRS', help='Optimization method (default: nlopt CRS)')
+	parser.add_argument('-mtd', '--method', type=str, choices=('anneal', 'leastsq', 'brute', 'nlopt CRS', 'nlopt MLSL', 'mcmc'), default='nlopt CRS', help='Optimization method (default: nlopt CRS)')
 	parser.add_argument('-cnv', '--converged', action='store_true', help='Filter out unconverged stars.')
 	parser.add_argument('-sm', '--smooth', type=float, nargs=2, default=(2,2), help='Std. dev. of smoothing kernel (in pixels) for individual pdfs (default: 2 2).')
 	parser.add_argument('-reg', '--regulator', type=float, default=1000., help='Width of support of prior on Delta_Ar (default: 1000).')
@@ -639,6 +848,13 @@ def main():
 	parser.add_argument('-ev', '--evidence_range', type=float, default=25., help='Maximum difference in ln(evidence) from max. value before star is considered outlier (default: 25).')
 	parser.add_argument('-nsp', '--nonsparse', action='store_true', help='Binned pdfs are not stored in sparse format.')
 	parser.add_argument('-pltind', '--plot_individual', type=int, nargs=2, default=None, help='Plot individual pdfs with reddening profile.')
+	parser.add_argument('-wk', '--walkers', type=int, default=None, help='# of walkers in ensemble for MCMC method (default: 4 per anchor).')
+	parser.add_argument('-bn', '--burnin', type=int, default=100, help='# of burn-in steps for MCMC method (default: 100).')
+	parser.add_argument('-st', '--steps', type=int, default=200, help='# of steps for MCMC method (default: 200).')
+	parser.add_argument('-eo', '--envelope_out', type=str, nargs=2, default=None, help='Output filename for percentiles of reddening profile (requires either --method mcmc or --bootstrap) and healpix pixel number.')
+	parser.add_argument('-bs', '--bootstrap', type=int, default=0, help='# of bootstrap replicates used to estimate percentiles of reddening profile (default: 0). Cannot be combined with --method mcmc.')
+	parser.add_argument('-np', '--procs', type=int, default=None, help='# of processes used to refit bootstrap replicates (default: # of CPUs).')
+	parser.add_argument('-pct', '--percentiles', type=float, nargs='+', default=(15.87, 50., 84.13), help='Percentiles of reddening profile to output (default: 15.87 50 84.13).')
 	parser.add_argument('-it', '--iterate', type=str, nargs=2, default=None, help='Tie pixel to neighbors in given reddening map. The healpix index of this pixel must be provided as the second argument.')
 	#parser.add_argument('-v', '--verbose', action='store_true', help='Print information on fit.')
 	if 'python' in sys.argv[0]:
@@ -647,12 +863,16 @@ def main():
 		offset = 1
 	values = parser.parse_args(sys.argv[offset:])
 	
+	if (values.method == 'mcmc') and (values.bootstrap > 0):
+		print 'Options --method mcmc and --bootstrap cannot be combined. Use one or the other to estimate percentiles of the reddening profile.'
+		return 1
+	
 	np.seterr(all='ignore')
 	
 	tstart = time()
 	
 	# Fit the line of sight
-	bounds, p, line_int, guess_line_int, measure, success, Delta_Ar, guess, Delta_Ar_mean = fit_los(values.binfn, values.statsfn, values.N, sparse=(not values.nonsparse), converged=values.converged, method=values.method, smooth=values.smooth, regulator=values.regulator, dwell=values.dwell, maxtime=values.maxtime, maxeval=values.maxeval, p0=values.floor, ev_range=values.evidence_range, iterate=values.iterate)
+	bounds, p, line_int, guess_line_int, measure, success, Delta_Ar, guess, Delta_Ar_mean, Delta_Ar_samples = fit_los(values.binfn, values.statsfn, values.N, sparse=(not values.nonsparse), converged=values.converged, method=values.method, smooth=values.smooth, regulator=values.regulator, dwell=values.dwell, maxtime=values.maxtime, maxeval=values.maxeval, p0=values.floor, ev_range=values.evidence_range, iterate=values.iterate, N_walkers=values.walkers, N_burnin=values.burnin, N_steps=values.steps, N_bootstrap=values.bootstrap, N_procs=values.procs)
 	duration = time() - tstart
 	sys.stderr.write('Time elapsed: %.1f s\n' % duration)
 	
@@ -660,6 +880,11 @@ def main():
 	N_stars = p.shape[0]
 	if values.outfn != None:
 		output_profile(values.outfn[0], int(values.outfn[1]), bounds, Delta_Ar, N_stars, line_int, measure, success)
+	if values.envelope_out != None:
+		if Delta_Ar_samples is None:
+			print 'Option --envelope_out requires --method mcmc or --bootstrap.'
+		else:
+			output_envelope(values.envelope_out[0], int(values.envelope_out[1]), bounds, Delta_Ar_samples, values.percentiles)
 	
 	# Plot individual reddening profile
 	if values.plot_individual != None:
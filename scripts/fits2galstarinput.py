@@ -24,7 +24,8 @@
 
 
 import os, sys, argparse
-from os.path import abspath
+import tempfile, shutil
+from os.path import abspath, dirname, join
 
 import healpy as hp
 import numpy as np
@@ -32,6 +33,362 @@ import pyfits
 
 import matplotlib.pyplot as plt
 
+import healpix_utils as hputils
+import input_info
+import shard_inputs
+
+
+def clean_photometry(mags, errs):
+	'''
+	Fix the photometry of stars with NaN or zero magnitude or error in
+	any band, and determine which stars to keep: those detected in some
+	band, with fewer than three uninformative bands.
+	
+	Input:
+	    mags, errs   Magnitudes and errors (N_stars x N_bands)
+	
+	Output:
+	    mags, errs   Fixed copies of the magnitudes and errors
+	    mask_keep    Stars to keep
+	'''
+	mags = np.array(mags, dtype=np.float64)
+	errs = np.array(errs, dtype=np.float64)
+	
+	mask_zero_mag = (mags == 0.)
+	mask_zero_err = (errs == 0.)
+	mask_nan_mag = np.isnan(mags)
+	mask_nan_err = np.isnan(errs)
+	
+	mags[mask_nan_mag] = 0.
+	errs[mask_zero_err | mask_nan_err | mask_zero_mag] = 1.e10
+	
+	mask_detect = np.sum(mags, axis=1).astype(np.bool)
+	mask_informative = (np.sum(errs > 1.e10, axis=1) < 3)
+	
+	return mags, errs, np.logical_and(mask_detect, mask_informative)
+
+
+# Stars in the sorted runs of out-of-core ingestion: pixel, (l, b), whether
+# the star is kept, and the fixed magnitudes and errors
+RUN_DTYPE = np.dtype([('pix_index', 'i8'), ('l', 'f8'), ('b', 'f8'), ('keep', 'u1'), ('phot', 'f8', 10)])
+
+# Maximum # of runs merged at once (each holds an open file)
+MAX_FAN_IN = 256
+
+
+def pixel_centers(pix_index, nside, nest, adaptive=False):
+	'''
+	Galactic (l, b) of the centers of the given pixels, which are unique
+	pixel numbers if <adaptive> is True.
+	'''
+	if adaptive:
+		order, ipix = hputils.uniq2nest(pix_index)
+		theta, phi = np.empty(order.size), np.empty(order.size)
+		for o in np.unique(order):
+			idx = (order == o)
+			theta[idx], phi[idx] = hp.pix2ang(2**int(o), ipix[idx], nest=True)
+	else:
+		theta, phi = hp.pix2ang(nside, pix_index, nest=nest)
+	return 180./np.pi * phi, 90. - 180./np.pi * theta
+
+
+
+def ingest(fname, fnames, nside, nest, bounds=None, min_stars=15, adaptive=False):
+	'''
+	Convert a FITS catalog into galstar input files, in memory. If
+	<adaptive> is True, the stars are grouped into nested pixels of mixed
+	order, down to <nside> (see main).
+	
+	Output:
+	    pix_index   Pixel written
+	    N_kept      # of stars in each pixel written
+	    findex      Output file of each pixel written
+	    (l_min, l_max, b_min, b_max) of the pixel centers within the bounds
+	'''
+	# Load the stars from the FITS file
+	d,h = pyfits.getdata(fname, header=True)
+	print 'Loaded %d stars.' % d.shape[0]
+	
+	# Convert (l, b) to spherical coordinates (physics convention)
+	l = d['l'].astype(np.float64)
+	b = d['b'].astype(np.float64)
+	theta = np.pi/180. * (90. - b)
+	phi = np.pi/180. * l
+	l_min = np.min(l)
+	l_max = np.max(l)
+	b_min = np.min(b)
+	b_max = np.max(b)
+	print ''
+	print 'Bounds on stars present:'
+	print '\t(l_min, l_max) = (%.3f, %.3f)' % (l_min, l_max)
+	print '\t(b_min, b_max) = (%.3f, %.3f)' % (b_min, b_max)
+	print ''
+	
+	# Convert spherical coordinates to healpix
+	N_arr = hp.ang2pix(nside, theta, phi, nest=nest)
+	
+	# Fix the photometry and determine which stars to keep, for all stars at once
+	grizy, err, mask_keep = clean_photometry(d['mean'], d['err'])
+	
+	# Assign each star to an adaptively sized pixel
+	max_order = None
+	if adaptive:
+		max_order = int(np.round(np.log2(nside)))
+		if (not nest) or (2**max_order != nside) or (max_order > 14):
+			print '--adaptive requires nested ordering, and nside a power of two no greater than 2^14.'
+			return None, None, None, None
+		
+		# Count only the stars which will be kept
+		cells, N_cell = hputils.adaptive_cells(N_arr[mask_keep], max_order, min_stars)
+		col, found = hputils.UniqIndex(cells, max_order).locate(N_arr)
+		N_arr = np.where(found, cells[col], -1)
+		print 'Adaptive pixels per order: %s' % (' '.join(['%d' % n for n in np.bincount(hputils.uniq2nest(cells)[0], minlength=max_order+1)]))
+	
+	# Sort the stars by pixel, and find the first star in each pixel
+	indices = np.argsort(N_arr, kind='mergesort')
+	N_arr = N_arr[indices]
+	start = np.concatenate(([0], np.nonzero(np.diff(N_arr))[0] + 1))
+	pix_index = N_arr[start]
+	print '%d unique healpix pixel(s) present.' % pix_index.size
+	
+	# Mean (l, b) of all stars, and # of stars kept, in each pixel
+	N_in_pix = np.diff(np.append(start, N_arr.size))
+	gal_l = np.add.reduceat(l[indices], start) / N_in_pix
+	gal_b = np.add.reduceat(b[indices], start) / N_in_pix
+	mask_keep = mask_keep[indices]
+	N_kept = np.add.reduceat(mask_keep.astype(np.int64), start)
+	
+	# Filter pixels by bounds (and drop stars outside of the adaptive pixels)
+	mask_pix = (pix_index >= 0)
+	l_min, l_max, b_min, b_max = 1.e100, -1.e100, 1.e100, -1.e100
+	if bounds is not None:
+		l_0, b_0 = pixel_centers(pix_index[mask_pix], nside, nest, adaptive)
+		in_bounds = (l_0 >= bounds[0]) & (l_0 <= bounds[1]) & (b_0 >= bounds[2]) & (b_0 <= bounds[3])
+		if np.any(in_bounds):
+			l_min, l_max = np.min(l_0[in_bounds]), np.max(l_0[in_bounds])
+			b_min, b_max = np.min(b_0[in_bounds]), np.max(b_0[in_bounds])
+		mask_pix[mask_pix] = in_bounds
+	mask_pix &= (N_kept >= min_stars)
+	
+	# Gather the magnitudes and errors of the stars to be written
+	sel = indices[mask_keep & np.repeat(mask_pix, N_in_pix)]
+	outarr = np.hstack((grizy[sel], err[sel]))
+	del grizy, err, sel
+	pix_index, gal_l, gal_b, N_kept = pix_index[mask_pix], gal_l[mask_pix], gal_b[mask_pix], N_kept[mask_pix]
+	
+	# Assign each pixel to the file with the least number of stars so far
+	findex = shard_inputs.greedy_assign(np.arange(pix_index.size), N_kept.astype(np.float64), len(fnames))
+	
+	# Write each file at once
+	star_findex = np.repeat(findex, N_kept)
+	for i,f in enumerate(fnames):
+		in_file = (findex == i)
+		input_info.write_input(f, pix_index[in_file], gal_l[in_file], gal_b[in_file], N_kept[in_file], outarr[star_findex == i])
+	
+	return pix_index, N_kept, findex, (l_min, l_max, b_min, b_max)
+
+
+def write_runs(fname, tmpdir, nside, nest, bounds=None, chunk_size=2**20):
+	'''
+	First pass of out-of-core ingestion. Read the (memory-mapped) FITS
+	table in chunks of rows, and write the stars in each chunk, sorted by
+	pixel, to a run file in <tmpdir>. Stars in pixels whose centers lie
+	outside of <bounds> are dropped.
+	
+	Output:
+	    run_fnames      Run files
+	    N_stars         # of stars read
+	    star_bounds     (l_min, l_max, b_min, b_max) of the stars read
+	    center_bounds   (l_min, l_max, b_min, b_max) of the pixel centers
+	                    within <bounds>
+	'''
+	f = pyfits.open(fname, memmap=True)
+	d = f[1].data
+	N_stars = d.shape[0]
+	
+	run_fnames = []
+	star_bounds = [1.e100, -1.e100, 1.e100, -1.e100]
+	center_bounds = [1.e100, -1.e100, 1.e100, -1.e100]
+	for start in xrange(0, N_stars, chunk_size):
+		chunk = d[start:start+chunk_size]
+		l = np.array(chunk.field('l'), dtype=np.float64)
+		b = np.array(chunk.field('b'), dtype=np.float64)
+		star_bounds = [min(star_bounds[0], np.min(l)), max(star_bounds[1], np.max(l)), min(star_bounds[2], np.min(b)), max(star_bounds[3], np.max(b))]
+		pix_index = hp.ang2pix(nside, np.pi/180. * (90. - b), np.pi/180. * l, nest=nest)
+		mags, errs, mask_keep = clean_photometry(chunk.field('mean'), chunk.field('err'))
+		
+		# Filter pixels by bounds
+		sel = np.ones(l.size, dtype=np.bool)
+		if bounds is not None:
+			pix_unique, inverse = np.unique(pix_index, return_inverse=True)
+			l_0, b_0 = pixel_centers(pix_unique, nside, nest)
+			in_bounds = (l_0 >= bounds[0]) & (l_0 <= bounds[1]) & (b_0 >= bounds[2]) & (b_0 <= bounds[3])
+			if np.any(in_bounds):
+				center_bounds = [min(center_bounds[0], np.min(l_0[in_bounds])), max(center_bounds[1], np.max(l_0[in_bounds])), min(center_bounds[2], np.min(b_0[in_bounds])), max(center_bounds[3], np.max(b_0[in_bounds]))]
+			sel = in_bounds[inverse]
+		
+		# Sort the stars by pixel, keeping stars in the same pixel in order
+		sel = np.nonzero(sel)[0]
+		sel = sel[np.argsort(pix_index[sel], kind='mergesort')]
+		if sel.size == 0:
+			continue
+		run = np.empty(sel.size, dtype=RUN_DTYPE)
+		run['pix_index'] = pix_index[sel]
+		run['l'] = l[sel]
+		run['b'] = b[sel]
+		run['keep'] = mask_keep[sel]
+		run['phot'][:,:5] = mags[sel]
+		run['phot'][:,5:] = errs[sel]
+		
+		run_fnames.append(join(tmpdir, 'run_%d.npy' % len(run_fnames)))
+		np.save(run_fnames[-1], run)
+		del run, chunk, mags, errs
+	
+	f.close()
+	
+	return run_fnames, N_stars, star_bounds, center_bounds
+
+
+def reduce_runs(run_fnames, tmpdir, chunk_size=2**20, max_fan_in=MAX_FAN_IN):
+	'''
+	Merge groups of consecutive runs into larger runs in <tmpdir>, until
+	at most <max_fan_in> runs remain, so that merge_runs never has more
+	than <max_fan_in> files open at once. Stars in the same pixel are
+	kept in their original order. About <chunk_size> stars are held in
+	memory at a time.
+	
+	Output:
+	    run_fnames      Remaining run files
+	'''
+	level = 0
+	while len(run_fnames) > max_fan_in:
+		level += 1
+		merged = []
+		for start in xrange(0, len(run_fnames), max_fan_in):
+			group = run_fnames[start:start+max_fan_in]
+			N_stars = 0
+			for fname in group:
+				N_stars += np.load(fname, mmap_mode='r').size
+			
+			merged.append(join(tmpdir, 'run_%d_%d.npy' % (level, len(merged))))
+			out = np.lib.format.open_memmap(merged[-1], mode='w+', dtype=RUN_DTYPE, shape=(N_stars,))
+			pos = 0
+			for batch in merge_runs(group, max(chunk_size // len(group), 1)):
+				out[pos:pos+batch.size] = batch
+				pos += batch.size
+			out.flush()
+			del out
+			
+			for fname in group:
+				os.remove(fname)
+		run_fnames = merged
+	
+	return run_fnames
+
+
+def merge_runs(run_fnames, window=2**16):
+	'''
+	Merge the sorted runs written by write_runs, yielding batches of
+	stars sorted by pixel. Each batch contains every star in the pixels
+	it covers. At most about <window> stars are read from each run per
+	batch (more, if a single pixel is larger than the window).
+	'''
+	runs = [np.load(fname, mmap_mode='r') for fname in run_fnames]
+	pos = [0 for run in runs]
+	active = [i for i,run in enumerate(runs) if run.size != 0]
+	
+	while len(active) != 0:
+		# Every run can supply its stars up to the last pixel in its window
+		bound = min([runs[i]['pix_index'][min(pos[i] + window, runs[i].size) - 1] for i in active])
+		
+		pieces = []
+		for i in active:
+			end = pos[i] + np.searchsorted(runs[i]['pix_index'][pos[i]:], bound, side='right')
+			pieces.append(np.array(runs[i][pos[i]:end]))
+			pos[i] = end
+		active = [i for i in active if pos[i] < runs[i].size]
+		
+		batch = np.concatenate(pieces)
+		yield batch[np.argsort(batch['pix_index'], kind='mergesort')]
+
+
+def ingest_out_of_core(fname, fnames, nside, nest, bounds=None, min_stars=15, memory=1024, tmpdir=None):
+	'''
+	Convert a FITS catalog which may not fit in memory into galstar
+	input files, using an external merge sort on pixel index. The stars
+	are written in sorted runs to a temporary directory, which are then
+	merged into the output files. If an error occurs, the partially
+	written output files are deleted.
+	
+	Input:
+	    fname       FITS catalog
+	    fnames      Output files
+	    memory      Approximate memory to use, in MB
+	    tmpdir      Directory in which to create the temporary directory
+	                (default: that of the first output file)
+	
+	Output:
+	    pix_index   Pixel written
+	    N_kept      # of stars in each pixel written
+	    findex      Output file of each pixel written
+	    N_pix       # of pixels present (within the bounds)
+	    N_stars, star_bounds, center_bounds (see write_runs)
+	'''
+	chunk_size = max(int(memory * 2**20 / (4 * RUN_DTYPE.itemsize)), 1)
+	if tmpdir is None:
+		tmpdir = dirname(fnames[0])
+	tmpdir = tempfile.mkdtemp(prefix='fits2galstarinput.', dir=tmpdir)
+	
+	writers = []
+	try:
+		run_fnames, N_stars, star_bounds, center_bounds = write_runs(fname, tmpdir, nside, nest, bounds, chunk_size)
+		print 'Wrote %d stars to %d sorted run(s).' % (N_stars, len(run_fnames))
+		run_fnames = reduce_runs(run_fnames, tmpdir, chunk_size)
+		
+		writers = [input_info.InputWriter(f) for f in fnames]
+		load = np.zeros(len(fnames), dtype=np.float64)
+		pix_written, N_written, findex_written = [], [], []
+		N_pix = 0
+		for batch in merge_runs(run_fnames, max(chunk_size // max(len(run_fnames), 1), 1)):
+			# Mean (l, b) of all stars, and # of stars kept, in each pixel
+			start = np.concatenate(([0], np.nonzero(np.diff(batch['pix_index']))[0] + 1))
+			pix_index = batch['pix_index'][start]
+			N_in_pix = np.diff(np.append(start, batch.size))
+			gal_l = np.add.reduceat(batch['l'], start) / N_in_pix
+			gal_b = np.add.reduceat(batch['b'], start) / N_in_pix
+			N_kept = np.add.reduceat(batch['keep'].astype(np.int64), start)
+			N_pix += pix_index.size
+			
+			mask_pix = (N_kept >= min_stars)
+			phot = batch['phot'][batch['keep'].astype(np.bool) & np.repeat(mask_pix, N_in_pix)]
+			pix_index, gal_l, gal_b, N_kept = pix_index[mask_pix], gal_l[mask_pix], gal_b[mask_pix], N_kept[mask_pix]
+			
+			# Assign each pixel to the file with the least number of stars so far
+			findex = shard_inputs.greedy_assign(np.arange(pix_index.size), N_kept.astype(np.float64), len(fnames), load)
+			star_findex = np.repeat(findex, N_kept)
+			for i in np.unique(findex):
+				in_file = (findex == i)
+				writers[i].write(pix_index[in_file], gal_l[in_file], gal_b[in_file], N_kept[in_file], phot[star_findex == i])
+			
+			pix_written.append(pix_index)
+			N_written.append(N_kept)
+			findex_written.append(findex)
+			del batch, phot
+		
+		for writer in writers:
+			writer.close()
+	except:
+		# Do not leave partial output files behind
+		for writer in writers:
+			writer.discard()
+		raise
+	finally:
+		shutil.rmtree(tmpdir, ignore_errors=True)
+	
+	if len(pix_written) == 0:
+		pix_written, N_written, findex_written = [np.empty(0, dtype=np.int64)], [np.empty(0, dtype=np.int64)], [np.empty(0, dtype=np.int64)]
+	
+	return np.concatenate(pix_written), np.concatenate(N_written), np.concatenate(findex_written), N_pix, N_stars, star_bounds, center_bounds
 
 
 def main():
@@ -43,154 +400,65 @@ def main():
 	parser.add_argument('-b', '--bounds', type=float, nargs=4, default=None, help='Restrict pixels to region enclosed by: l_min, l_max, b_min, b_max')
 	parser.add_argument('-sp', '--split', type=int, default=1, help='Split into an arbitrary number of tarballs.')
 	parser.add_argument('-min', '--min_stars', type=int, default=15, help='Minimum # of stars in pixel.')
+	parser.add_argument('-ad', '--adaptive', action='store_true', help='Group stars into nested pixels of mixed order, splitting pixels down to --nside as long as each part contains at least --min_stars stars. Pixels are identified by their unique pixel numbers (4*nside^2 + index).')
 	parser.add_argument('-vis', '--visualize', action='store_true', help='Show plot of footprint')
+	parser.add_argument('-oc', '--out_of_core', action='store_true', help='Stream the FITS file in chunks, sorting the stars by pixel with an external merge sort, for catalogs which do not fit in memory.')
+	parser.add_argument('-mem', '--memory', type=float, default=1024., help='Approximate memory to use with --out_of_core, in MB (default: 1024).')
+	parser.add_argument('-tmp', '--tmpdir', type=str, default=None, help='Directory for temporary files with --out_of_core (default: that of the output).')
 	if 'python' in sys.argv[0]:
 		offset = 2
 	else:
 		offset = 1
 	values = parser.parse_args(sys.argv[offset:])
 	
-	# Load the stars from the FITS file
-	d,h = pyfits.getdata(abspath(values.FITS), header=True)
-	print 'Loaded %d stars.' % d.shape[0]
-	
-	# Convert (l, b) to spherical coordinates (physics convention)
-	theta = np.pi/180. * (90. - d['b'])
-	phi = np.pi/180. * d['l']
-	l_min = np.min(d['l'])
-	l_max = np.max(d['l'])
-	b_min = np.min(d['b'])
-	b_max = np.max(d['b'])
-	print ''
-	print 'Bounds on stars present:'
-	print '\t(l_min, l_max) = (%.3f, %.3f)' % (l_min, l_max)
-	print '\t(b_min, b_max) = (%.3f, %.3f)' % (b_min, b_max)
-	print ''
-	
-	# Convert spherical coordinates to healpix
-	N_arr = hp.ang2pix(values.nside, theta, phi, nest=(not values.ring))
-	
-	# Get unique pixel numbers
-	N_unique = np.unique(N_arr)
-	print '%d unique healpix pixel(s) present.' % N_unique.size
-	
-	# Open the output files (which will be galstar .in files)
-	fout = None
 	if values.split < 1:
 		print '--split must be positive.'
 		return 1
+	if values.out_of_core and values.adaptive:
+		print '--adaptive cannot be combined with --out_of_core.'
+		return 1
+	
+	# Determine the output files (which will be galstar .in files)
 	if values.split > 1:
 		base = abspath(values.out)
 		if base.endswith('.in'):
 			base = base[:-3]
-		fout = [open('%s_%d.in' % (base, i), 'wb') for i in range(values.split)]
+		fnames = ['%s_%d.in' % (base, i) for i in range(values.split)]
+	else:
+		fnames = [abspath(values.out)]
+	
+	if values.out_of_core:
+		pix_index, N_kept, findex, N_pix, N_stars, (l_min, l_max, b_min, b_max), center_bounds = ingest_out_of_core(abspath(values.FITS), fnames, values.nside, (not values.ring), values.bounds, values.min_stars, values.memory, values.tmpdir)
+		print ''
+		print 'Bounds on stars present:'
+		print '\t(l_min, l_max) = (%.3f, %.3f)' % (l_min, l_max)
+		print '\t(b_min, b_max) = (%.3f, %.3f)' % (b_min, b_max)
+		print ''
+		print '%d unique healpix pixel(s) present.' % N_pix
+		l_min, l_max, b_min, b_max = center_bounds
 	else:
-		fout = [open(values.out, 'w')]
+		pix_index, N_kept, findex, (l_min, l_max, b_min, b_max) = ingest(abspath(values.FITS), fnames, values.nside, (not values.ring), values.bounds, values.min_stars, values.adaptive)
+		if pix_index is None:
+			return 1
 	
-	# Keep track of number of stars saved
-	N_pix_used = np.zeros(values.split, dtype=np.uint32)
-	N_saved = np.zeros(values.split, dtype=np.uint64)
-	N_stars_min = 1.e100
-	N_stars_max = -1.
+	N_pix_used = np.bincount(findex, minlength=values.split).astype(np.uint32)
+	N_saved = np.bincount(findex, weights=N_kept, minlength=values.split).astype(np.uint64)
+	if pix_index.size != 0:
+		N_stars_min = np.min(N_kept)
+		N_stars_max = np.max(N_kept)
 	
-	# Sort the stars by pixel
-	indices = N_arr.argsort()
-	N_arr = N_arr[indices]
+	# Record number of stars saved to each pixel
 	pix_map = None
 	if values.visualize:
 		pix_map = np.zeros(12 * values.nside**2, dtype=np.float64)
-	
-	# Leave space in each file to record the number of files
-	N_pix_used_str = N_pix_used.tostring()
-	for i,f in enumerate(fout):
-		f.write(N_pix_used_str[4*i:4*i+4])
-	
-	# Break data into healpix pixels
-	newblock = np.where(np.diff(N_arr))[0] + 1
-	start = 0
-	l_min, l_max, b_min, b_max = 1.e100, -1.e100, 1.e100, -1.e100
-	for end in np.concatenate((newblock,[-1])):
-		N = N_arr[start]
-		
-		# Filter pixels by bounds
-		if values.bounds != None:
-			theta_0, phi_0 = hp.pix2ang(values.nside, N, nest=(not values.ring))
-			l_0 = 180./np.pi * phi_0
-			b_0 = 90. - 180./np.pi * theta_0
-			if (l_0 < values.bounds[0]) or (l_0 > values.bounds[1]) or (b_0 < values.bounds[2]) or (b_0 > values.bounds[3]):
-				start = end
-				continue
-			else:
-				if l_0 < l_min:
-					l_min = l_0
-				if l_0 > l_max:
-					l_max = l_0
-				if b_0 < b_min:
-					b_min = b_0
-				if b_0 > b_max:
-					b_max = b_0
-		
-		sel = indices[start:end]
-		
-		#diff_tmp = N_arr[start+1:end] - N_arr[start:end-1]
-		#if np.sum(diff_tmp) != 0:
-		#	print diff_tmp
-		
-		# Get stars in this pixel
-		grizy = d['mean'][sel]
-		err = d['err'][sel]
-		
-		# Fix errors for stars with NaN or zero magnitude or error in any band
-		mask_zero_mag = (grizy == 0.)
-		mask_zero_err = (err == 0.)
-		mask_nan_mag = np.isnan(grizy)
-		mask_nan_err = np.isnan(err)
-		
-		grizy[mask_nan_mag] = 0.
-		err[mask_zero_err] = 1.e10
-		err[mask_nan_err] = 1.e10
-		err[mask_zero_mag] = 1.e10
-		
-		mask_detect = np.sum(grizy, axis=1).astype(np.bool)
-		mask_informative = (np.sum(err > 1.e10, axis=1) < 3).astype(np.bool)
-		mask_keep = np.logical_and(mask_detect, mask_informative)
-		
-		# Create the output matrix
-		outarr = np.hstack((grizy[mask_keep], err[mask_keep])).astype(np.float64)
-		
-		# Write Header
-		N_stars = np.array([outarr.shape[0]], np.uint32)
-		if N_stars < values.min_stars:
-			start = end
-			continue
-		findex = np.argmin(N_saved)
-		pix_index = np.array([N], dtype=np.uint32)
-		gal_lb = np.array([np.mean(d['l'][sel]), np.mean(d['b'][sel])], dtype=np.float64)
-		fout[findex].write(pix_index.tostring())	# Pixel index	(uint32)
-		fout[findex].write(gal_lb.tostring())		# (l, b)		(2 x float64)
-		fout[findex].write(N_stars.tostring())		# N_stars		(uint32)
-		
-		# Write magnitudes and errors
-		fout[findex].write(outarr.tostring())		# 5xmag, 5xerr	(10 x float64)
-		
-		# Record number of stars saved to pixel
-		N_pix_used[findex] += 1
-		N_saved[findex] += outarr.shape[0]
-		if outarr.shape[0] < N_stars_min:
-			N_stars_min = outarr.shape[0]
-		if outarr.shape[0] > N_stars_max:
-			N_stars_max = outarr.shape[0]
-		if values.visualize:
-			pix_map[N] = outarr.shape[0]
-		
-		start = end
-	
-	# Return to beginning of each file and write number of pixels in file
-	N_pix_used_str = N_pix_used.tostring()
-	for i,f in enumerate(fout):
-		f.seek(0)
-		f.write(N_pix_used_str[4*i:4*i+4])
-		f.close()
+		if values.adaptive:
+			max_order = int(np.round(np.log2(values.nside)))
+			order, ipix = hputils.uniq2nest(pix_index)
+			for o, p, N in zip(order, ipix, N_kept):
+				shift = 2 * (max_order - int(o))
+				pix_map[int(p) << shift:(int(p) + 1) << shift] = N
+		else:
+			pix_map[pix_index] = N_kept
 	
 	if np.sum(N_pix_used) != 0:
 		print 'Saved %d stars from %d healpix pixels to %d galstar input file(s) (per pixel min: %d, max: %d, mean: %.1f).' % (np.sum(N_saved), np.sum(N_pix_used), values.split, N_stars_min, N_stars_max, float(np.sum(N_saved))/float(np.sum(N_pix_used)))
@@ -25,11 +25,16 @@ scriptsdir=`readlink -m ${SCRIPTSDIR%/}`
 # Determine filename for std. output/error
 outfn="out-err.txt"
 
+# Runtime of each pixel (input file, pixel #, healpix index, seconds), used
+# by shard_inputs.py --fit to calibrate its cost model
+timefn="timings.txt"
+
 # Get the absolute path of the input file
 infile=`readlink -m $INFILE`
 
-# Determine number of pixels in the input
-npix=`$scriptsdir/input_info.py $infile --npix`
+# Read the healpix index of every pixel in the input at once
+pixindices=(`$scriptsdir/input_info.py $infile --list | grep -v '^#' | awk '{print $2}'`)
+npix=${#pixindices[@]}
 maxpix=`expr $npix - 1`
 
 echo "Moving to temporary folder $tmpdir"
@@ -38,7 +43,7 @@ cd $tmpdir
 # Give each pixel in input file to galstar
 for ((n=0; n<=$maxpix; n++)); do
 	# Determine healpix number of this pixel
-	pixindex=`$scriptsdir/input_info.py $infile --pix_index $n`
+	pixindex=${pixindices[$n]}
 	
 	# Name galstar output files by healpix number
 	pixname=${infile%.in}
@@ -48,16 +53,19 @@ for ((n=0; n<=$maxpix; n++)); do
 	# Run galstar with the current pixel
 	m=`expr $n + 1`
 	echo "$m of $npix: Running galstar on healpix pixel $pixindex..."
+	tstart=`date +%s.%N`
 	$galstardir/galstar $binfn:DM[5,20,120],Ar[0,16,1000] --statsfile $statsfn --infile $infile $n --errfloor 20 --giant &> $outfn
+	tend=`date +%s.%N`
+	echo "$infile $n $pixindex `echo "$tend - $tstart" | bc`" >> $timefn
 	
 	# Archive output, removing temporary files
 	tar -rf $tarfn $binfn $statsfn
 	rm $binfn $statsfn
 done
 
-# Add ASCII file containing std. out/err to tar archive and compress archive
-tar -rf $tarfn $outfn
-rm $outfn
+# Add ASCII files containing std. out/err and timings to tar archive and compress archive
+tar -rf $tarfn $outfn $timefn
+rm $outfn $timefn
 gzip -1 $tarfn
 
 cd $workingdir
@@ -29,6 +29,12 @@ import numpy as np
 import scipy.ndimage.filters as filters
 import scipy.weave as weave
 
+import input_info
+
+
+# Star in a galstar input file, as read by galstar
+INPUT_STAR_DTYPE = np.dtype([('obj_id', 'u8'), ('l', 'f8'), ('b', 'f8'), ('mag', 'f8', 5), ('err', 'f8', 5)])
+
 
 def load_true(fname):
 	'''
@@ -386,6 +392,81 @@ def smooth_bins(p, sigma):
 	return p_smooth
 
 
+class GalstarInput():
+	'''
+	Memory-mapped galstar input file. The stars in each pixel are exposed
+	as a structured array (see INPUT_STAR_DTYPE) which is a view into the
+	file, so that only the pages which are accessed are read.
+	
+	Indexing returns the stars in the given pixel. Iterating yields
+	(pix_index, (l, b), stars) for each pixel, lazily.
+	
+	Attributes:
+		fname - filename of input file
+		toc - table of contents (see input_info.TOC_DTYPE)
+		star_dtype - data type of each star
+	'''
+	
+	def __init__(self, fname, star_dtype=INPUT_STAR_DTYPE):
+		self.fname = abspath(fname)
+		self.star_dtype = np.dtype(star_dtype)
+		self.toc, from_sidecar = input_info.load_toc(self.fname, self.star_dtype.itemsize)
+		self.data = np.memmap(self.fname, dtype=np.uint8, mode='r')
+		
+		# Check that the pixels exactly fill the file
+		size = 4
+		if self.toc.size != 0:
+			size = int(self.toc['offset'][-1]) + input_info.HEADER_BYTES + int(self.toc['N_stars'][-1]) * self.star_dtype.itemsize
+		if size != self.data.size:
+			raise Exception('Input file %s is %d bytes, but its pixels take up %d bytes. The file may be corrupt, or use a different star format.' % (fname, self.data.size, size))
+	
+	def __len__(self):
+		return self.toc.size
+	
+	def __getitem__(self, index):
+		return self.stars(index)
+	
+	def __iter__(self):
+		for index in xrange(self.toc.size):
+			pix_index, gal_lb, N_stars = self.header(index)
+			yield pix_index, gal_lb, self.stars(index)
+	
+	def header(self, index):
+		'''
+		Return the healpix index, (l, b) and number of stars of the given
+		pixel.
+		'''
+		row = self.toc[index]
+		return row['pix_index'], np.array([row['l'], row['b']]), row['N_stars']
+	
+	def stars(self, index):
+		'''
+		Return a (read-only) view of the stars in the given pixel.
+		'''
+		row = self.toc[index]
+		return np.ndarray(shape=(int(row['N_stars']),), dtype=self.star_dtype, buffer=self.data, offset=int(row['offset']) + input_info.HEADER_BYTES)
+	
+	def close(self):
+		del self.data
+
+
+def load_input(fname, star_dtype=INPUT_STAR_DTYPE):
+	'''
+	Open a galstar input file, as written by query_lsd.py, for lazy
+	access to the stars in each pixel. The pixel headers are read in a
+	single pass (or from the table of contents, if present). Files
+	written by fits2galstarinput.py contain only magnitudes and errors,
+	and can be read with star_dtype = [('mag', 'f8', 5), ('err', 'f8', 5)].
+	
+	Input:
+		fname - filename of galstar input file
+		star_dtype - data type of each star
+	
+	Output:
+		GalstarInput object
+	'''
+	return GalstarInput(fname, star_dtype)
+
 
 def main():
 	print 'galstar_io.py contains routines to load galstar output.'
@@ -31,7 +31,10 @@ import numpy as np
 import healpy as hp
 import pyfits
 
-from os.path import abspath
+from os.path import abspath, exists, splitext
+from collections import OrderedDict
+
+import reddening_io
 
 
 def lb2thetaphi(l, b):
@@ -94,9 +97,120 @@ def rad2deg(theta):
 	return 180./np.pi * theta
 
 
-def healmap_rasterize(m, nside, nest=True, lb_bounds=[0., 360., -90., 90.], size=[1000,1000], center_gal=False, return_theta_phi=False):
+def angular_distance(theta_0, phi_0, theta, phi):
+	'''
+	Angular distance between points given in spherical coordinates
+	(physics convention), in radians.
+	'''
+	cos_dist = np.cos(theta_0) * np.cos(theta) + np.sin(theta_0) * np.sin(theta) * np.cos(phi - phi_0)
+	return np.arccos(np.clip(cos_dist, -1., 1.))
+
+
+# Maximum # of projection grids kept by get_projection
+PROJECTION_CACHE_SIZE = 16
+_projection_cache = OrderedDict()
+
+
+class RasterProjection():
+	'''
+	Grid of healpix pixel indices covering a Cartesian projection of the
+	sky, so that any number of healpix maps can be rasterized by a single
+	gather, m[..., pix].
+	'''
+	
+	def __init__(self, nside, nest=True, lb_bounds=[0., 360., -90., 90.], size=[1000,1000], center_gal=False):
+		self.nside = nside
+		self.nest = nest
+		self.lb_bounds = lb_bounds
+		self.size = size
+		self.center_gal = center_gal
+		self.theta, self.phi = None, None
+		
+		# Convert coordinates to healpix pixels
+		theta, phi = self.grid_theta_phi()
+		pix = hp.ang2pix(nside, theta, phi, nest=nest)
+		if hp.nside2npix(nside) < 2**31:
+			pix = pix.astype(np.int32)
+		
+		# Center map on l=0
+		self.shift = 0
+		if center_gal:
+			self.shift = int(np.round(size[0]/2. - np.unravel_index(np.argmin(np.abs(phi)), phi.shape)[0]))
+			pix = np.roll(pix, self.shift, axis=0)
+		del theta, phi
+		self.pix = pix
+	
+	def grid_theta_phi(self):
+		'''
+		Compute the spherical coordinates (theta, phi) of each pixel in
+		the (unshifted) grid, in radians (physics convention).
+		'''
+		xsize, ysize = self.size
+		l, b = np.mgrid[0:xsize, 0:ysize].astype(np.float32) + 0.5
+		l = self.lb_bounds[1] - (self.lb_bounds[1] - self.lb_bounds[0]) * l / float(xsize)
+		b = self.lb_bounds[2] + (self.lb_bounds[3] - self.lb_bounds[2]) * b / float(ysize)
+		return lb2thetaphi(l, b)
+	
+	def theta_phi(self):
+		'''
+		Return the spherical coordinates (theta, phi) of each pixel in
+		the (unshifted) grid, computing them on the first call.
+		'''
+		if self.theta is None:
+			self.theta, self.phi = self.grid_theta_phi()
+		return self.theta, self.phi
+	
+	def rasterize(self, m, valid_pix=None):
+		'''
+		Rasterize a healpix map, list of maps, or ndarray with first index
+		identifying separate maps. If <valid_pix> is given, the maps only
+		store the values of these (sorted) pixels along their last axis,
+		and other pixels are rasterized as NaN.
+		'''
+		pix = self.pix
+		missing = None
+		if valid_pix is not None:
+			pix, found = pixel_columns(valid_pix, pix)
+			if not np.all(found):
+				missing = ~found
+			del found
+		
+		if type(m) == list:
+			img = [submap[pix] for submap in m]
+			if missing is not None:
+				for subimg in img:
+					subimg[missing] = np.NaN
+		else:
+			img = m[...,pix]
+			if missing is not None:
+				img[...,missing] = np.NaN
+		
+		return img
+
+
+def get_projection(nside, nest=True, lb_bounds=[0., 360., -90., 90.], size=[1000,1000], center_gal=False):
+	'''
+	Return the RasterProjection with the given parameters, reusing one of
+	the PROJECTION_CACHE_SIZE most recently used projections if possible.
+	'''
+	key = (int(nside), bool(nest), tuple([float(x) for x in lb_bounds]), tuple([int(x) for x in size]), bool(center_gal))
+	
+	if key in _projection_cache:
+		proj = _projection_cache.pop(key)
+	else:
+		proj = RasterProjection(key[0], key[1], list(key[2]), list(key[3]), key[4])
+		while len(_projection_cache) >= PROJECTION_CACHE_SIZE:
+			_projection_cache.popitem(last=False)
+	_projection_cache[key] = proj
+	
+	return proj
+
+
+def healmap_rasterize(m, nside, nest=True, lb_bounds=[0., 360., -90., 90.], size=[1000,1000], center_gal=False, return_theta_phi=False, valid_pix=None):
 	'''
-	Rasterize a healpix map in Cartesian projection.
+	Rasterize a healpix map in Cartesian projection. The grid of healpix
+	pixels covered by the image is cached (see get_projection), so that
+	repeated calls with the same projection only gather from the map.
 	
 	Input:
 	    m           Healpix map, list of maps, or ndarray with first index
@@ -111,6 +225,9 @@ def healmap_rasterize(m, nside, nest=True, lb_bounds=[0., 360., -90., 90.], size
 	    return_theta_phi  If True, spherical theta and phi (physics
 	                      convention) for each rasterized pixel are
 	                      returned.
+	    valid_pix   Sorted healpix pixel numbers, if m only stores the
+	                values of these pixels (along its last axis). Other
+	                pixels are rasterized as NaN.
 	
 	Output:
 	    img         Rasterized image of healpix map in Cartesian projection.
@@ -120,47 +237,11 @@ def healmap_rasterize(m, nside, nest=True, lb_bounds=[0., 360., -90., 90.], size
 	    phi         Spherical phi coordinate in rad (physics convention).
 	'''
 	
-	# Make grid of pixels to plot
-	xsize, ysize = size
-	l, b = np.mgrid[0:xsize, 0:ysize].astype(np.float32) + 0.5
-	#print xsize, ysize
-	#print l.shape, b.shape
-	l = lb_bounds[1] - (lb_bounds[1] - lb_bounds[0]) * l / float(xsize)
-	b = lb_bounds[2] + (lb_bounds[3] - lb_bounds[2]) * b / float(ysize)
-	theta, phi = lb2thetaphi(l, b)
-	del l, b
-	#print size
-	
-	# Convert coordinates to healpix pixels and create 2D map
-	pix = hp.ang2pix(nside, theta, phi, nest=nest)
-	img = None
-	if type(m) == list:
-		img = []
-		for submap in m:
-			img.append(m[pix])
-			img[-1].shape = (xsize, ysize)
-	elif len(m.shape) == 2:
-		img = m[:,pix]
-		img.shape = (img.shape[0], xsize, ysize)
-	else:
-		img = m[pix]
-		img.shape = (xsize, ysize)
-	del pix
-	
-	# Center map on l=0
-	if center_gal:
-		phi[phi >= 360.] -= 360.
-		shift = int(np.round(xsize/2. - np.unravel_index(np.argmin(np.abs(phi)), img.shape)[0]))
-		#print 'Rolling by %d pixels (%.2f%% of xsize)' % (shift, 100.*float(shift)/xsize)
-		if type(m) == list:
-			for i,subimg in enumerate(img):
-				img[i] = np.roll(subimg, shift, axis=0)
-		elif len(m.shape) == 2:
-			img = np.roll(img, shift, axis=1)
-		else:
-			img = np.roll(img, shift, axis=0)
+	proj = get_projection(nside, nest, lb_bounds, size, center_gal)
+	img = proj.rasterize(m, valid_pix=valid_pix)
 	
 	if return_theta_phi:
+		theta, phi = proj.theta_phi()
 		return img, theta, phi
 	else:
 		return img
@@ -229,40 +310,427 @@ def healmap_to_axes(ax, m, nside, nest=True, lb_bounds=[0., 360., -90., 90.], si
 	return image
 
 
+def pixel_columns(valid_pix, pix_index):
+	'''
+	Locate healpix pixels in a map which stores only a sorted subset of
+	pixels.
+	
+	Input:
+	    valid_pix  Sorted healpix pixel numbers stored by the map
+	    pix_index  Healpix pixel number, or array of pixel numbers
+	
+	Output:
+	    col        Position of each pixel in <valid_pix> (0 for missing
+	               pixels)
+	    found      True where the pixel is stored by the map
+	'''
+	pix_index = np.asarray(pix_index)
+	if valid_pix.size == 0:
+		return np.zeros(pix_index.shape, dtype=np.int64), np.zeros(pix_index.shape, dtype=np.bool)
+	col = np.searchsorted(valid_pix, pix_index)
+	col = np.minimum(col, valid_pix.size-1)
+	found = (valid_pix[col] == pix_index)
+	col = np.where(found, col, 0)
+	return col, found
+
+
+def nest2uniq(order, ipix):
+	'''
+	Convert nested pixel numbers at the given order (nside = 2^order)
+	to unique pixel numbers, uniq = 4 * 4^order + ipix, which identify
+	pixels of any order.
+	'''
+	order = np.asarray(order, dtype=np.int64)
+	return 4 * 4**order + np.asarray(ipix, dtype=np.int64)
+
+
+def uniq2nest(uniq):
+	'''
+	Convert unique pixel numbers to (order, nested pixel number).
+	'''
+	uniq = np.asarray(uniq, dtype=np.int64)
+	order = np.zeros(uniq.shape, dtype=np.int64)
+	for o in xrange(1, 30):
+		order[uniq >= 4 * 4**o] = o
+	return order, uniq - 4 * 4**order
+
+
+def adaptive_cells(pix_index, max_order, min_stars, N_stars=None):
+	'''
+	Tile the sky adaptively with nested healpix cells of mixed order,
+	according to the number of stars in each cell. Starting from the 12
+	base pixels, each cell is split into its four children as long as
+	every non-empty child contains at least <min_stars> stars, down to
+	<max_order>. Sparse regions are thus covered by large cells, while
+	dense regions are resolved down to nside = 2^max_order. Only cells
+	at order 0 can contain fewer than <min_stars> stars, and these are
+	dropped.
+	
+	Input:
+	    pix_index  Nested pixel number at nside = 2^max_order of each
+	               star (or of each pixel, if N_stars is given)
+	    max_order  Finest order of the tiling
+	    min_stars  Minimum # of stars in each cell
+	    N_stars    # of stars in each pixel in <pix_index> (optional)
+	
+	Output:
+	    uniq       Sorted unique pixel numbers of the cells (see nest2uniq)
+	    N_stars    # of stars in each cell
+	'''
+	pix, inverse = np.unique(np.asarray(pix_index, dtype=np.int64), return_inverse=True)
+	if N_stars is None:
+		N_pix = np.bincount(inverse, minlength=pix.size).astype(np.float64)
+	else:
+		N_pix = np.bincount(inverse, weights=N_stars, minlength=pix.size)
+	
+	# Cells at order 0
+	ipix, inverse = np.unique(pix >> (2*max_order), return_inverse=True)
+	N_cell = np.bincount(inverse, weights=N_pix, minlength=ipix.size)
+	
+	uniq_list, N_list = [], []
+	for order in xrange(max_order):
+		shift = 2 * (max_order - order - 1)
+		
+		# Children of the current cells, which contain stars
+		child, inverse = np.unique(pix >> shift, return_inverse=True)
+		N_child = np.bincount(inverse, weights=N_pix, minlength=child.size)
+		
+		# Split each cell whose least-populated (non-empty) child is above threshold
+		parent, first = np.unique(child >> 2, return_index=True)
+		N_least = np.minimum.reduceat(N_child, first)
+		split = np.in1d(ipix, parent[N_least >= min_stars])
+		uniq_list.append(nest2uniq(order, ipix[~split]))
+		N_list.append(N_cell[~split])
+		
+		sel = np.in1d(child >> 2, ipix[split])
+		ipix, N_cell = child[sel], N_child[sel]
+		sel = np.in1d(pix >> shift, ipix)
+		pix, N_pix = pix[sel], N_pix[sel]
+	
+	uniq_list.append(nest2uniq(max_order, ipix))
+	N_list.append(N_cell)
+	
+	uniq = np.concatenate(uniq_list)
+	N_cell = np.rint(np.concatenate(N_list)).astype(np.int64)
+	keep = (N_cell >= min_stars)
+	uniq, N_cell = uniq[keep], N_cell[keep]
+	order = np.argsort(uniq)
+	
+	return uniq[order], N_cell[order]
+
+
+class UniqIndex():
+	'''
+	Lookup structure for a set of non-overlapping, mixed-order nested
+	healpix cells, given by their unique pixel numbers. Each cell covers
+	a contiguous range of nested pixel numbers at the finest order, so
+	that the cell containing a point is found by a binary search over
+	the sorted starts of the ranges, in O(log n).
+	'''
+	
+	def __init__(self, uniq, max_order=None):
+		order, ipix = uniq2nest(uniq)
+		if max_order is None:
+			max_order = int(np.max(order)) if order.size != 0 else 0
+		if np.any(order > max_order):
+			raise ValueError('Cells finer than <max_order> are present.')
+		self.max_order = max_order
+		
+		# Range of nested pixels at max_order covered by each cell
+		shift = 2 * (max_order - order)
+		start = ipix << shift
+		self.sort_idx = np.argsort(start, kind='mergesort')
+		self.start = start[self.sort_idx]
+		self.end = ((ipix + 1) << shift)[self.sort_idx]
+		if np.any(self.start[1:] < self.end[:-1]):
+			raise ValueError('Cells overlap.')
+	
+	def __len__(self):
+		return self.start.size
+	
+	def locate(self, pix_index):
+		'''
+		Locate nested pixels at max_order among the cells.
+		
+		Input:
+		    pix_index  Nested pixel number, or array of pixel numbers, at
+		               nside = 2^max_order
+		
+		Output:
+		    col        Position of the cell containing each pixel in the
+		               list of cells (0 for uncovered pixels)
+		    found      True where the pixel is covered by a cell
+		'''
+		pix_index = np.asarray(pix_index, dtype=np.int64)
+		if self.start.size == 0:
+			return np.zeros(pix_index.shape, dtype=np.int64), np.zeros(pix_index.shape, dtype=np.bool)
+		k = np.searchsorted(self.start, pix_index, side='right') - 1
+		k = np.maximum(k, 0)
+		found = (pix_index >= self.start[k]) & (pix_index < self.end[k])
+		col = np.where(found, self.sort_idx[k], 0)
+		return col, found
+
+
+def interpolate_anchors(mu_anchors, Ar_anchors, mu_eval, out=None, chunk_size=2**14):
+	'''
+	Linearly interpolate reddening profiles which share a common set of
+	distance-modulus anchors. All distances are located among the
+	anchors with one call to np.searchsorted. The pixels are then
+	processed in chunks of <chunk_size>, so that the two bracketing
+	anchor planes stay in cache while every distance is interpolated
+	in place.
+	
+	Input:
+	    mu_anchors  Distance moduli of the anchors, in ascending order.
+	    Ar_anchors  Ar at each anchor (first index), for each pixel.
+	    mu_eval     Distance modulus or moduli at which to evaluate Ar.
+	    out         Optional array in which to place the output.
+	    chunk_size  # of pixels to process at once.
+	
+	Output:
+	    Ar          Ar at each distance (first index) and pixel. Distances
+	                outside the range of the anchors evaluate to NaN.
+	'''
+	mu_anchors = np.asarray(mu_anchors, dtype=np.float64)
+	mu_eval = np.atleast_1d(np.asarray(mu_eval, dtype=np.float64))
+	
+	# Locate the bracketing anchors for each distance
+	idx = np.searchsorted(mu_anchors, mu_eval, side='left') - 1
+	idx = np.clip(idx, 0, mu_anchors.size-2)
+	weight = (mu_eval - mu_anchors[idx]) / (mu_anchors[idx+1] - mu_anchors[idx])
+	in_range = (mu_eval >= mu_anchors[0]) & (mu_eval <= mu_anchors[-1])
+	
+	shape = (mu_eval.size,) + Ar_anchors.shape[1:]
+	if out is None:
+		out = np.empty(shape, dtype=np.float64)
+	elif out.shape != shape:
+		raise ValueError('<out> must have shape %s.' % str(shape))
+	
+	# Flatten the pixel axes, so that they can be processed in chunks
+	Ar_flat = Ar_anchors.reshape(Ar_anchors.shape[0], -1)
+	out_flat = out.reshape(mu_eval.size, -1)
+	N_pix = Ar_flat.shape[1]
+	
+	for start in xrange(0, N_pix, chunk_size):
+		end = min(start + chunk_size, N_pix)
+		for k in xrange(mu_eval.size):
+			out_chunk = out_flat[k, start:end]
+			if not in_range[k]:
+				out_chunk.fill(np.NaN)
+				continue
+			Ar_lower = Ar_flat[idx[k], start:end]
+			np.subtract(Ar_flat[idx[k]+1, start:end], Ar_lower, out=out_chunk)
+			out_chunk *= weight[k]
+			out_chunk += Ar_lower
+	
+	if not np.may_share_memory(out_flat, out):
+		out[...] = out_flat.reshape(shape)
+	
+	return out
+
+
+# Flags set by ExtinctionMap.query for stars outside the map's coverage
+QUERY_NO_PIXEL = 1	# Star lies in a pixel which is not in the map
+QUERY_MU_RANGE = 2	# Star's distance modulus lies outside the anchors
+
+
+class LazyPlanes():
+	'''
+	Read-only stand-in for a stack of healpix maps (one per distance),
+	backed by memory-mapped FITS image HDUs. Each plane is read into
+	memory (and cached) the first time it is accessed in full. Indexing
+	a subset of pixels reads only those pixels from the file, unless
+	the plane has already been cached.
+	'''
+	
+	def __init__(self, hdus, N_pix):
+		self.hdus = list(hdus)
+		self.planes = [None for hdu in self.hdus]
+		self.shape = (len(self.hdus), N_pix)
+		self.ndim = 2
+		self.dtype = np.dtype(np.float64)
+	
+	def __len__(self):
+		return self.shape[0]
+	
+	def plane(self, i):
+		'''
+		Return the full map at distance index <i>, reading it from disk
+		if it has not yet been cached.
+		'''
+		if self.planes[i] is None:
+			self.planes[i] = np.array(self.hdus[i].data, dtype=np.float64)
+		return self.planes[i]
+	
+	def pixels(self, i, pix_index):
+		'''
+		Return the given pixel(s) of the map at distance index <i>.
+		'''
+		if self.planes[i] is not None:
+			return self.planes[i][pix_index]
+		return np.array(self.hdus[i].data[pix_index], dtype=np.float64)
+	
+	def __iter__(self):
+		for i in xrange(self.shape[0]):
+			yield self.plane(i)
+	
+	def __getitem__(self, key):
+		if type(key) is not tuple:
+			key = (key,)
+		if len(key) > 2:
+			raise IndexError('Too many indices.')
+		rows = key[0]
+		cols = key[1] if len(key) == 2 else slice(None)
+		full = (type(cols) is slice) and (cols == slice(None))
+		
+		if isinstance(rows, (int, long, np.integer)):
+			i = range(self.shape[0])[rows]
+			if full:
+				return self.plane(i)
+			return self.pixels(i, cols)
+		
+		i_list = np.arange(self.shape[0])[rows]
+		if full:
+			return np.array([self.plane(i) for i in i_list])
+		return np.array([self.pixels(i, cols) for i in i_list])
+	
+	def __array__(self, dtype=None):
+		Ar = self[:]
+		if dtype is not None:
+			Ar = Ar.astype(dtype)
+		return Ar
+
+
+def pyramid_fname(fname, nside):
+	'''
+	Filename of the level of a map pyramid with the given nside.
+	'''
+	base, ext = splitext(fname)
+	if ext == '':
+		ext = '.fits'
+	return '%s.nside%d%s' % (base, nside, ext)
+
+
 class ExtinctionMap():
 	'''
 	Class representing a set of extinction maps at increasing distance.
 	The maps are stored internally in healpix ordering.
+	
+	In dense mode, Ar has shape (# of distances, # of healpix pixels),
+	with NaN in pixels that have not been loaded. In sparse mode, only
+	the pixels listed (in ascending order) in sparse_index are stored,
+	and Ar has shape (# of distances, # of stored pixels), with N_stars
+	and measure similarly compacted. In dense mode, sparse_index is None.
 	'''
 	
-	def __init__(self):
+	def __init__(self, fname=None, FITS=True, nside=512, nested=True, mu=None, sparse=None, lazy=False):
 		'''
-		Initiate a dummy extinction map with nside=1.
+		Load an extinction map from a FITS file, or from a set of binary
+		files produced by fit_pdfs.py. If no filename is given, initiate
+		an empty map (with Ar = NaN everywhere), with the given nside,
+		ordering and distance moduli <mu>.
+		
+		If <sparse> is True (False), the map is stored in sparse (dense)
+		mode. If None, FITS files are kept in the mode in which they were
+		saved, while all other maps are dense.
+		
+		If <lazy> is True, dense FITS maps are memory-mapped, and each
+		distance is only read when first needed (see LazyPlanes).
 		'''
-		self.nested = True
-		self.nside = 1
-		self.Ar = np.zeros((1, hp.nside2npix(self.nside)), dtype=np.float64)
-		self.mu = np.zeros(1, dtype=np.float64)
-		self.N_stars = np.zeros(hp.nside2npix(self.nside), dtype=np.uint32)
-		self.measure = np.zeros(hp.nside2npix(self.nside), dtype=np.float64)
-	
-	def __init__(self, fname, FITS=True, nside=512, nested=True):
-		if FITS:
-			self.load(fname)
+		self.pyramid = []
+		if fname is None:
+			self.nested = nested
+			self.nside = nside
+			if mu is None:
+				mu = np.zeros(1, dtype=np.float64)
+			self.mu = np.array(mu, dtype=np.float64)
+			if sparse:
+				N_pix = 0
+				self.sparse_index = np.zeros(0, dtype=np.int64)
+			else:
+				N_pix = hp.nside2npix(self.nside)
+				self.sparse_index = None
+			self.Ar = np.empty((self.mu.size, N_pix), dtype=np.float64)
+			self.Ar.fill(np.NaN)
+			self.N_stars = np.zeros(N_pix, dtype=np.uint32)
+			self.measure = np.empty(N_pix, dtype=np.float64)
+			self.measure.fill(np.NaN)
+		elif FITS:
+			self.load(fname, lazy=lazy)
+			if sparse == True:
+				self.to_sparse()
+			elif sparse == False:
+				self.to_dense()
 		else:
-			self.load_from_binaries(fname, nside, nested)
+			self.load_from_binaries(fname, nside, nested, sparse=bool(sparse))
+	
+	def close(self):
+		'''
+		Close the FITS file backing a lazily loaded map. Distances which
+		have not yet been accessed are read into memory first.
+		'''
+		if getattr(self, 'fits', None) is None:
+			return
+		self.Ar = np.asarray(self.Ar)
+		self.N_stars = np.array(self.N_stars)
+		self.measure = np.array(self.measure)
+		self.fits.close()
+		self.fits = None
+	
+	def ordering_scheme(self):
+		'''
+		Healpix ordering scheme of the map, as written to FITS headers.
+		'''
+		if self.nested:
+			return 'NESTED'
+		return 'RING'
+	
+	def is_sparse(self):
+		'''
+		Return True if the map is stored in sparse mode.
+		'''
+		return self.sparse_index is not None
+	
+	def to_sparse(self):
+		'''
+		Convert the map to sparse mode, keeping only the valid pixels.
+		'''
+		if self.is_sparse():
+			return
+		pix_index = self.valid_pixels()
+		self.Ar = self.Ar[:, pix_index]
+		self.N_stars = self.N_stars[pix_index]
+		self.measure = self.measure[pix_index]
+		self.sparse_index = pix_index.astype(np.int64)
+	
+	def to_dense(self):
+		'''
+		Convert the map to dense mode, with NaN in the pixels that have
+		not been loaded.
+		'''
+		if not self.is_sparse():
+			return
+		N_pix = hp.nside2npix(self.nside)
+		Ar = np.empty((self.mu.size, N_pix), dtype=np.float64)
+		Ar.fill(np.NaN)
+		Ar[:, self.sparse_index] = self.Ar
+		N_stars = np.zeros(N_pix, dtype=np.uint32)
+		N_stars[self.sparse_index] = self.N_stars
+		measure = np.empty(N_pix, dtype=np.float64)
+		measure.fill(np.NaN)
+		measure[self.sparse_index] = self.measure
+		self.Ar, self.N_stars, self.measure = Ar, N_stars, measure
+		self.sparse_index = None
 	
 	def save(self, fname):
 		'''
-		Save the extinction map to a FITS file.
+		Save the extinction map to a FITS file. Sparse maps are saved
+		as a partial-sky (explicitly indexed) binary table.
 		'''
 		# Primary HDU with list of distance moduli
 		primary = pyfits.PrimaryHDU(self.mu)
 		primary.header.update('PIXTYPE', 'HEALPIX')
-		if self.nested:
-			primary.header.update('ORDERING', 'NESTED')
-		else:
-			primary.header.update('ORDERING', 'RING')
+		primary.header.update('ORDERING', self.ordering_scheme())
 		primary.header.update('NSIDE', self.nside)
 		primary.header.update('FIRSTPIX', 0)
 		primary.header.update('LASTPIX', hp.nside2npix(self.nside))
@@ -273,6 +741,29 @@ class ExtinctionMap():
 		hdu = []
 		hdu.append(primary)
 		
+		if self.is_sparse():
+			primary.header.update('INDXSCHM', 'EXPLICIT')
+			primary.header.update('OBJECT', 'PARTIAL')
+			
+			# Binary table with one row per stored pixel
+			cols = []
+			cols.append(pyfits.Column(name='PIXEL', format='K', array=self.sparse_index))
+			cols.append(pyfits.Column(name='NSTARS', format='J', array=self.N_stars.astype(np.int32)))
+			cols.append(pyfits.Column(name='MEASURE', format='D', array=self.measure))
+			cols.append(pyfits.Column(name='AR', format='%dD' % self.mu.size, unit='MAGS', array=self.Ar.T))
+			table = pyfits.new_table(pyfits.ColDefs(cols))
+			table.header.update('PIXTYPE', 'HEALPIX')
+			table.header.update('ORDERING', primary.header['ORDERING'])
+			table.header.update('NSIDE', self.nside)
+			table.header.update('INDXSCHM', 'EXPLICIT')
+			table.header.update('OBJECT', 'PARTIAL')
+			table.header.update('BAND', 'PS r')
+			hdu.append(table)
+			
+			hdulist = pyfits.HDUList(hdu)
+			hdulist.writeto(abspath(fname), clobber=True)
+			return
+		
 		# Image HDUs with # of stars and fit measure
 		img = pyfits.ImageHDU(self.N_stars)
 		img.header.update('DESC', 'NSTARS')
@@ -296,12 +787,16 @@ class ExtinctionMap():
 		hdulist = pyfits.HDUList(hdu)
 		hdulist.writeto(abspath(fname), clobber=True)
 	
-	def load(self, fname):
+	def load(self, fname, lazy=False):
 		'''
-		Load an extinction map from a FITS file.
+		Load an extinction map from a FITS file. If <lazy> is True, the
+		file is memory-mapped and kept open, and Ar is a LazyPlanes
+		object, from which distances are read as they are needed.
+		Partial-sky maps are always loaded in full.
 		'''
+		self.fits = None
 		try:
-			f = pyfits.open(abspath(fname))
+			f = pyfits.open(abspath(fname), memmap=lazy, do_not_scale_image_data=lazy)
 		except:
 			print 'Could not load %s' % fname
 			return
@@ -311,83 +806,352 @@ class ExtinctionMap():
 			self.nested = False
 		self.nside = int(f[0].header['NSIDE'])
 		self.mu = f[0].data
+		
+		# Partial-sky map, stored as a binary table
+		if f[0].header.get('INDXSCHM', 'IMPLICIT') == 'EXPLICIT':
+			data = f[1].data
+			pix_index = np.array(data.field('PIXEL'), dtype=np.int64)
+			order = np.argsort(pix_index, kind='mergesort')
+			self.sparse_index = pix_index[order]
+			self.N_stars = np.array(data.field('NSTARS'), dtype=np.uint32)[order]
+			self.measure = np.array(data.field('MEASURE'), dtype=np.float64)[order]
+			Ar = np.array(data.field('AR'), dtype=np.float64).reshape(pix_index.size, self.mu.size)
+			self.Ar = np.ascontiguousarray(Ar[order].T)
+			f.close()
+			return
+		
+		self.sparse_index = None
 		self.N_stars = f[1].data
 		self.measure = f[2].data
+		
+		if lazy:
+			# Scaled (unsigned integer) images cannot be memory-mapped, so N_stars is scaled here
+			header = f[1].header
+			self.N_stars = (np.asarray(self.N_stars, dtype=np.int64) * int(header.get('BSCALE', 1)) + int(header.get('BZERO', 0))).astype(np.uint32)
+			self.Ar = LazyPlanes(f[3:3+int(f[0].header['NDIST'])], hp.nside2npix(self.nside))
+			self.fits = f
+			return
+		
 		self.Ar = np.empty((int(f[0].header['NDIST']), hp.nside2npix(self.nside)), dtype=np.float64)
 		for i,img in enumerate(f[3:]):
 			self.Ar[i,:] = img.data
 		f.close()
 	
-	def load_from_binaries(self, fname, nside=512, nested=True):
+	def load_from_binaries(self, fname, nside=512, nested=True, N_procs=None, sparse=False):
 		'''
 		Load an extinction map from a set of binary files produced by
-		fit_pdfs.py.
+		fit_pdfs.py. The files are loaded concurrently in a pool of
+		<N_procs> processes. If <sparse> is True, only the pixels present
+		in the files are stored.
 		'''
 		self.nside = nside
 		self.nested = nested
 		self.mu = None
 		self.Ar = None
+		self.sparse_index = None
+		
+		if type(fname) is str:
+			fname = [fname]
+		
+		if sparse:
+			tables = [t for t in reddening_io.load_tables(fname, N_procs) if (t is not None) and (t.size != 0)]
+			if len(tables) == 0:
+				self.mu = np.zeros(1, dtype=np.float64)
+				table = np.zeros(0, dtype=reddening_io.profile_dtype(1))
+			else:
+				self.mu = tables[0]['mu_anchors'][0].copy()
+				table = np.concatenate(tables)
+			del tables
+			
+			# Pixels in later files take precedence
+			pix_index = table['pix_index'][::-1].astype(np.int64)
+			self.sparse_index, idx = np.unique(pix_index, return_index=True)
+			idx = table.size - 1 - idx
+			self.N_stars = table['N_stars'][idx].astype(np.uint32)
+			self.measure = table['measure'][idx].astype(np.float64)
+			self.Ar = np.ascontiguousarray(table['Ar_anchors'][idx].T)
+			return
+		
 		self.N_stars = np.zeros(hp.nside2npix(self.nside), dtype=np.uint32)
 		self.measure = np.empty(hp.nside2npix(self.nside), dtype=np.float64)
 		self.measure.fill(np.NaN)
 		
-		if type(fname) is str:
-			fname = [fname]
+		# Store (DM, Ar) fit for each healpix pixel, scattering each file into the map in one pass
+		for table in reddening_io.load_tables(fname, N_procs):
+			if (table is None) or (table.size == 0):
+				continue
+			pix_index = table['pix_index'].astype(np.int64)
+			self.N_stars[pix_index] = table['N_stars']
+			self.measure[pix_index] = table['measure']
+			if self.mu is None:
+				self.mu = table['mu_anchors'][0].copy()
+				self.Ar = np.empty((self.mu.size, hp.nside2npix(self.nside)), dtype=np.float64)
+				self.Ar.fill(np.NaN)
+			self.Ar[:, pix_index] = table['Ar_anchors'].T
+	
+	def degrade(self, nside_out):
+		'''
+		Return a copy of the map at a lower resolution, <nside_out>, in
+		nested ordering. In nested ordering, the children of each coarse
+		pixel are contiguous, so that the parent of pixel i is simply
+		i / (nside/nside_out)^2. Ar in each coarse pixel is the average of
+		its valid children, weighted by # of stars (or equally weighted,
+		if none of the children contain stars), while N_stars and measure
+		are summed. The copy is sparse if the map is sparse.
+		'''
+		ratio = self.nside // nside_out
+		if (nside_out < 1) or (ratio * nside_out != self.nside) or (ratio & (ratio - 1) != 0):
+			raise ValueError('<nside_out> must be a power of two smaller than or equal to nside.')
 		
-		# Store (DM, Ar) fit for each healpix pixel
-		for filename in fname:
-			#print 'Opening %s ...' % filename
-			f = open(abspath(filename), 'rb')
-			while True:
-				try:	# Load in individual pixels until the EOF, or until something goes wrong
-					pix_index = np.fromfile(f, dtype=np.uint64, count=1)[0]
-					self.N_stars[pix_index] = np.fromfile(f, dtype=np.uint32, count=1)[0]
-					self.measure[pix_index] = np.fromfile(f, dtype=np.float64, count=1)[0]
-					success = np.fromfile(f, dtype=np.uint16, count=1)[0]
-					N_regions = np.fromfile(f, dtype=np.uint16, count=1)[0]
-					line_int = np.fromfile(f, dtype=np.float64, count=self.N_stars[pix_index])
-					if self.mu == None:
-						self.mu = np.fromfile(f, dtype=np.float64, count=N_regions+1)
-						self.Ar = np.empty((N_regions+1, hp.nside2npix(self.nside)), dtype=np.float64)
-						self.Ar.fill(np.NaN)
-					else:
-						mu_anchors = np.fromfile(f, dtype=np.float64, count=N_regions+1)
-					self.Ar[:, pix_index] = np.fromfile(f, dtype=np.float64, count=N_regions+1)
-				except:
-					f.close()
-					break
-			f.close()
+		# Parent of each valid pixel
+		col = np.where(np.isfinite(self.Ar[0]))[0]
+		pix_index = col
+		if self.is_sparse():
+			pix_index = self.sparse_index[col]
+		if not self.nested:
+			pix_index = hp.ring2nest(self.nside, pix_index)
+		parent, inverse = np.unique(pix_index // (ratio * ratio), return_inverse=True)
+		
+		return self.bin_columns(col, parent, inverse, nside_out, sparse=self.is_sparse())
 	
-	def evaluate(self, mu_eval, pix_index=None):
+	def bin_columns(self, col, pix_index, inverse, nside_out, frac=None, sparse=True):
+		'''
+		Combine columns of the map into the pixels of a new map, in
+		nested ordering. Ar in each output pixel is the average of the
+		columns binned into it, weighted by # of stars (or equally
+		weighted, if none of the columns contain stars), while N_stars
+		and measure are summed.
+		
+		Input:
+		    col        Columns of Ar to combine
+		    pix_index  Pixel numbers (at nside_out) of the new map
+		    inverse    Index into <pix_index> of each column in <col>
+		    nside_out  nside of the new map
+		    frac       Fraction of the stars (and measure) of each column
+		               assigned to its output pixel (default: 1)
+		    sparse     Store the new map in sparse mode
+		'''
+		N_bins = pix_index.size
+		
+		# Star-count weights
+		N_stars = np.asarray(self.N_stars)[col].astype(np.float64)
+		measure = np.asarray(self.measure)[col].astype(np.float64)
+		if frac is not None:
+			N_stars *= frac
+			measure *= frac
+		weight = N_stars.copy()
+		total_weight = np.bincount(inverse, weights=weight, minlength=N_bins)
+		weight[total_weight[inverse] <= 0.] = 1.
+		total_weight = np.bincount(inverse, weights=weight, minlength=N_bins)
+		
+		Ar_anchors = np.asarray(self.Ar[:, col], dtype=np.float64)
+		Ar = np.empty((self.mu.size, N_bins), dtype=np.float64)
+		for k in xrange(self.mu.size):
+			Ar[k] = np.bincount(inverse, weights=weight*Ar_anchors[k], minlength=N_bins) / total_weight
+		del Ar_anchors
+		N_stars = np.rint(np.bincount(inverse, weights=N_stars, minlength=N_bins))
+		measure = np.bincount(inverse, weights=measure, minlength=N_bins)
+		
+		m = ExtinctionMap(nside=nside_out, nested=True, mu=self.mu, sparse=sparse)
+		if m.is_sparse():
+			m.sparse_index = pix_index.astype(np.int64)
+			m.Ar, m.N_stars, m.measure = Ar, N_stars.astype(np.uint32), measure
+		else:
+			m.Ar[:, pix_index] = Ar
+			m.N_stars[pix_index] = N_stars
+			m.measure[pix_index] = measure
+		
+		return m
+	
+	def build_pyramid(self):
+		'''
+		Build lower-resolution copies of the map at nside/2, nside/4, ...
+		1 (see degrade), stored in self.pyramid, from finest to coarsest.
+		'''
+		self.pyramid = []
+		m = self
+		while m.nside > 1:
+			m = m.degrade(m.nside // 2)
+			self.pyramid.append(m)
+		return self.pyramid
+	
+	def save_pyramid(self, fname):
+		'''
+		Save each level of the pyramid to its own FITS file, named by
+		pyramid_fname.
+		'''
+		for m in self.pyramid:
+			m.save(pyramid_fname(fname, m.nside))
+	
+	def load_pyramid(self, fname, lazy=True):
+		'''
+		Load the levels of the pyramid saved by save_pyramid, from finest
+		to coarsest, stopping at the first missing level.
+		'''
+		self.pyramid = []
+		nside = self.nside // 2
+		while nside >= 1:
+			level_fname = pyramid_fname(fname, nside)
+			if not exists(level_fname):
+				break
+			self.pyramid.append(ExtinctionMap(level_fname, FITS=True, lazy=lazy))
+			nside //= 2
+		return self.pyramid
+	
+	def select_level(self, resolution):
+		'''
+		Return the coarsest level of the pyramid (or the map itself) with
+		pixels no larger than <resolution> (in degrees).
+		'''
+		for m in self.pyramid[::-1]:
+			if rad2deg(hp.pixelfunc.nside2resol(m.nside)) <= resolution:
+				return m
+		return self
+	
+	def evaluate(self, mu_eval, pix_index=None, out=None):
 		'''
 		Evaluate Ar at the given distance modulus, or list of distance
-		moduli, mu_eval.
+		moduli, mu_eval. Distances outside the range of the anchors
+		evaluate to NaN.
+		
+		Input:
+		    mu_eval    Distance modulus, or list of distance moduli
+		    pix_index  Healpix pixel number, or list of pixel numbers, at
+		               which to evaluate the map. If None, the entire
+		               map is evaluated (in sparse mode, only the stored
+		               pixels, in the order given by sparse_index).
+		    out        Optional array in which to place the output, with
+		               shape (# of distances, # of pixels).
+		
+		Output:
+		    Ar_map     Ar at each distance (first index) and pixel
 		'''
 		if type(mu_eval) not in [list, np.ndarray]:
 			mu_eval = [mu_eval]
 		
-		query_map = self.Ar
-		if pix_index != None:
-			query_map = self.Ar[:,pix_index]
-		
-		# Create an empty map for each value of mu
-		Ar_map = None
-		if (pix_index == None) or (type(pix_index) in [list, np.ndarray]):
-			Ar_map = np.empty((len(mu_eval), query_map.shape[1]), dtype=np.float64)
-		else:
-			Ar_map = np.empty(len(mu_eval), dtype=np.float64)
-		Ar_map.fill(np.NaN)
+		if pix_index is None:
+			return interpolate_anchors(self.mu, np.asarray(self.Ar), mu_eval, out=out)
 		
-		for k,m in enumerate(mu_eval):
-			if (m >= self.mu[0]) and (m <= self.mu[-1]):
-				for i,mu_anchor in enumerate(self.mu[1:]):
-					if mu_anchor >= m:
-						slope = (query_map[i+1] - query_map[i]) / (self.mu[i+1] - self.mu[i])
-						Ar_map[k] = query_map[i] + slope * (m - self.mu[i])
-						break
+		if not self.is_sparse():
+			return interpolate_anchors(self.mu, self.Ar[:,pix_index], mu_eval, out=out)
 		
+		# Pixels which are not stored evaluate to NaN
+		if self.sparse_index.size == 0:
+			query_map = np.empty((self.mu.size,) + np.shape(pix_index), dtype=np.float64)
+			query_map.fill(np.NaN)
+			return interpolate_anchors(self.mu, query_map, mu_eval, out=out)
+		col, found = pixel_columns(self.sparse_index, pix_index)
+		Ar_map = interpolate_anchors(self.mu, self.Ar[:,col], mu_eval, out=out)
+		if np.ndim(found) == 0:
+			if not found:
+				Ar_map.fill(np.NaN)
+		elif not np.all(found):
+			Ar_map[:,~found] = np.NaN
 		return Ar_map
 	
+	def query(self, l, b, mu, chunk_size=2**20, out=None, resolution=None):
+		'''
+		Evaluate Ar for individual stars, each at its own position and
+		distance modulus. Stars are processed in chunks of <chunk_size>,
+		so that the temporary memory used does not grow with the number
+		of stars.
+		
+		Input:
+		    l           Galactic longitude of each star, in degrees
+		    b           Galactic latitude of each star, in degrees
+		    mu          Distance modulus of each star
+		    chunk_size  # of stars to process at once
+		    out         Optional array in which to place Ar
+		    resolution  Required resolution (in degrees). If given, the
+		                coarsest sufficient level of the pyramid is used.
+		
+		Output:
+		    Ar          Ar for each star (NaN where not covered by the map)
+		    flags       Bitmask (uint8) of QUERY_NO_PIXEL and QUERY_MU_RANGE,
+		                which is zero for stars covered by the map
+		'''
+		if resolution is not None:
+			m = self.select_level(resolution)
+			if m is not self:
+				return m.query(l, b, mu, chunk_size=chunk_size, out=out)
+		
+		l = np.atleast_1d(l)
+		b = np.atleast_1d(b)
+		mu = np.atleast_1d(mu)
+		N_stars = max(l.size, b.size, mu.size)
+		if (l.size not in (1, N_stars)) or (b.size not in (1, N_stars)) or (mu.size not in (1, N_stars)):
+			raise ValueError('<l>, <b> and <mu> must have the same length.')
+		
+		if out is None:
+			out = np.empty(N_stars, dtype=np.float64)
+		elif out.shape != (N_stars,):
+			raise ValueError('<out> must have shape (%d,).' % N_stars)
+		flags = np.zeros(N_stars, dtype=np.uint8)
+		
+		N_anchors = self.mu.size
+		N_cols = self.Ar.shape[1]
+		gather_pairs = isinstance(self.Ar, np.ndarray)
+		
+		for start in xrange(0, N_stars, chunk_size):
+			end = min(start + chunk_size, N_stars)
+			l_chunk = l[start:end] if l.size > 1 else np.repeat(l, end-start)
+			b_chunk = b[start:end] if b.size > 1 else np.repeat(b, end-start)
+			mu_chunk = mu[start:end] if mu.size > 1 else np.repeat(mu, end-start)
+			
+			# Locate each star in the map
+			col, found = self.locate(l_chunk, b_chunk)
+			
+			# Locate each star's distance modulus among the anchors
+			idx = np.searchsorted(self.mu, mu_chunk, side='left') - 1
+			idx = np.clip(idx, 0, N_anchors-2)
+			weight = (mu_chunk - self.mu[idx]) / (self.mu[idx+1] - self.mu[idx])
+			in_range = (mu_chunk >= self.mu[0]) & (mu_chunk <= self.mu[-1])
+			
+			# Gather the two bracketing anchors of each star
+			if N_cols == 0:
+				Ar_lower = np.empty(end-start, dtype=np.float64)
+				Ar_lower.fill(np.NaN)
+				Ar_upper = Ar_lower
+			elif gather_pairs:
+				Ar_lower = self.Ar[idx, col]
+				Ar_upper = self.Ar[idx+1, col]
+			else:
+				Ar_lower = np.empty(end-start, dtype=np.float64)
+				Ar_upper = np.empty(end-start, dtype=np.float64)
+				for k in np.unique(idx):
+					sel = (idx == k)
+					Ar_lower[sel] = self.Ar[k, col[sel]]
+					Ar_upper[sel] = self.Ar[k+1, col[sel]]
+			
+			Ar_chunk = out[start:end]
+			np.subtract(Ar_upper, Ar_lower, out=Ar_chunk)
+			Ar_chunk *= weight
+			Ar_chunk += Ar_lower
+			
+			# Flag stars outside of the map
+			found &= np.isfinite(Ar_lower) & np.isfinite(Ar_upper)
+			flags[start:end][~found] |= QUERY_NO_PIXEL
+			flags[start:end][~in_range] |= QUERY_MU_RANGE
+			Ar_chunk[(~found) | (~in_range)] = np.NaN
+		
+		return out, flags
+	
+	def locate(self, l, b):
+		'''
+		Locate points, given in Galactic coordinates (in degrees), in
+		the map.
+		
+		Output:
+		    col    Column of Ar containing each point (0 for points in
+		           pixels which are not stored)
+		    found  True where the point lies in a stored pixel
+		'''
+		theta, phi = lb2thetaphi(np.asarray(l), np.asarray(b))
+		pix = np.asarray(hp.ang2pix(self.nside, theta, phi, nest=self.nested), dtype=np.int64)
+		if self.is_sparse():
+			return pixel_columns(self.sparse_index, pix)
+		return pix, np.ones(pix.shape, dtype=np.bool)
+	
 	def chi2dof(self):
 		'''
 		Return something like the chi^2/d.o.f. This is not strictly the
@@ -407,7 +1171,10 @@ class ExtinctionMap():
 		'''
 		Return the healpix numbers of the pixels which have been loaded.
 		'''
-		return np.where(np.isfinite(self.Ar[0]))[0]
+		idx = np.where(np.isfinite(self.Ar[0]))[0]
+		if self.is_sparse():
+			return self.sparse_index[idx]
+		return idx
 	
 	def pixel_bounds(self):
 		'''
@@ -417,11 +1184,33 @@ class ExtinctionMap():
 		Output:
 		    l_min, l_max, b_min, b_max
 		'''
-		pix_index = self.valid_pixels()
+		col, l, b = self.valid_lb()
+		return np.min(l), np.max(l), np.min(b), np.max(b)
+	
+	def valid_lb(self):
+		'''
+		Return the columns of Ar holding valid pixels, along with the
+		Galactic (l, b) of these pixels, in degrees. The coordinates are
+		cached until the set of valid pixels changes.
+		
+		Output:
+		    col   Columns of Ar (equal to the healpix numbers in dense mode)
+		    l, b  Galactic coordinates of the pixel centers
+		'''
+		col = np.where(np.isfinite(self.Ar[0]))[0]
+		cache = getattr(self, 'lb_cache', None)
+		if (cache is not None) and (cache[0] == (self.nside, self.nested, self.is_sparse())) and np.array_equal(cache[1], col):
+			return cache[1], cache[2], cache[3]
+		
+		pix_index = col
+		if self.is_sparse():
+			pix_index = self.sparse_index[col]
 		theta, phi = hp.pix2ang(self.nside, pix_index, nest=self.nested)
 		l, b = thetaphi2lb(theta, phi)
 		del theta, phi
-		return np.min(l), np.max(l), np.min(b), np.max(b)
+		self.lb_cache = ((self.nside, self.nested, self.is_sparse()), col, l, b)
+		
+		return col, l, b
 	
 	def Ar_percentile(self, percentile, lb_bounds=None, mu_eval=None):
 		'''
@@ -436,22 +1225,22 @@ class ExtinctionMap():
 		Output:
 		    Ar threshold, or list of thresholds
 		'''
-		pix_index = self.valid_pixels()
-		theta, phi = hp.pix2ang(self.nside, pix_index, nest=self.nested)
-		l, b = thetaphi2lb(theta, phi)
-		del theta, phi
-		Ar_map_clipped = None
-		if mu_eval == None:
-			Ar_map_clipped = self.Ar[-1]
-		else:
-			Ar_map_clipped = self.evaluate(mu_eval)[0]
-		if lb_bounds != None:
+		col, l, b = self.valid_lb()
+		if lb_bounds is not None:
 			pix_mask = (l >= lb_bounds[0]) & (l <= lb_bounds[1]) & (b >= lb_bounds[2]) & (b <= lb_bounds[3])
-			Ar_map_clipped = Ar_map_clipped[pix_index[pix_mask]]
+			col = col[pix_mask]
+		
+		# Evaluate Ar at the selected pixels, using only the bracketing anchors
+		if mu_eval is None:
+			Ar_map_clipped = self.Ar[-1, col]
 		else:
-			Ar_map_clipped = Ar_map_clipped[pix_index]
+			mu_eval = np.atleast_1d(mu_eval)[0]
+			k = np.searchsorted(self.mu, mu_eval, side='left') - 1
+			k = min(max(k, 0), self.mu.size-2)
+			Ar_map_clipped = interpolate_anchors(self.mu[k:k+2], self.Ar[k:k+2, col], mu_eval)[0]
 		Ar_map_clipped = Ar_map_clipped[np.isfinite(Ar_map_clipped)]
-		Ar_map_clipped.sort()
+		
+		# Select the requested ranks, without sorting the whole array
 		if type(percentile) is list:
 			percentile = np.array(percentile)
 		index = percentile/100. * (Ar_map_clipped.size-1.)
@@ -459,11 +1248,13 @@ class ExtinctionMap():
 			index = index.astype(np.uint32)
 		else:
 			index = int(index)
-		return Ar_map_clipped[index]
+		return np.partition(Ar_map_clipped, index)[index]
 		
 	def rasterize(self, mu_eval, size='native', lb_bounds='auto', center_gal=False, **kwargs):
 		'''
-		Rasterize the extinction map.
+		Rasterize the extinction map. If a pyramid has been built (or
+		loaded), the coarsest level which resolves the image pixels is
+		rasterized.
 		
 		Input:
 			mu_eval     Distance modulus or moduli at which to rasterize map
@@ -514,9 +1305,15 @@ class ExtinctionMap():
 			lb_bounds[0] -= 180.
 			lb_bounds[1] -= 180.
 		
+		# Choose the level of the pyramid to rasterize
+		img_resolution = min((lb_bounds[1] - lb_bounds[0]) / float(size[0]), (lb_bounds[3] - lb_bounds[2]) / float(size[1]))
+		level = self.select_level(img_resolution)
+		
 		# Evaluate healpix map and pass to rasterizing function
-		m = self.evaluate(mu_eval)
-		return healmap_rasterize(m, self.nside, nest=self.nested, lb_bounds=lb_bounds, size=size, center_gal=center_gal, **kwargs), lb_bounds
+		m = level.evaluate(mu_eval)
+		if level.is_sparse():
+			kwargs['valid_pix'] = level.sparse_index
+		return healmap_rasterize(m, level.nside, nest=level.nested, lb_bounds=lb_bounds, size=size, center_gal=center_gal, **kwargs), lb_bounds
 	
 	def to_axes(self, ax, mu_eval, size='native', lb_bounds='auto', center_gal=False, log_scale=False, diff=False, **kwargs):
 		'''
@@ -612,6 +1409,153 @@ class ExtinctionMap():
 		return image
 
 
+class AdaptiveExtinctionMap(ExtinctionMap):
+	'''
+	Extinction map stored on mixed-order (MOC-style) nested healpix
+	cells, such as those produced by adaptive_cells. The map is always
+	in sparse mode, with the unique pixel numbers of the cells (see
+	nest2uniq) taking the place of healpix pixel numbers in sparse_index,
+	while nside is that of the finest order, max_order. Points are
+	located in the map through a UniqIndex.
+	
+	Operations which require a fixed resolution (rasterizing, degrading)
+	act on the regular healpix map produced by to_healpix.
+	'''
+	
+	def __init__(self, fname=None, FITS=True, max_order=9, mu=None, N_procs=None):
+		'''
+		Load an adaptive map from a FITS file written by save, or from a
+		set of binary files produced by fit_pdfs.py from input files
+		indexed by unique pixel number (see fits2galstarinput.py
+		--adaptive). If no filename is given, initiate an empty map with
+		the given finest order and distance moduli <mu>.
+		'''
+		if fname is None:
+			ExtinctionMap.__init__(self, nside=2**max_order, nested=True, mu=mu, sparse=True)
+			self.max_order = max_order
+			self.update_index()
+		elif FITS:
+			self.pyramid = []
+			self.load(fname)
+		else:
+			self.pyramid = []
+			self.load_from_binaries(fname, max_order=max_order, N_procs=N_procs)
+	
+	def update_index(self):
+		'''
+		Rebuild the lookup structure. Must be called whenever the set of
+		cells in sparse_index changes.
+		'''
+		self.nside = 2**self.max_order
+		self.nested = True
+		self.index = UniqIndex(self.sparse_index, self.max_order)
+	
+	def ordering_scheme(self):
+		return 'NUNIQ'
+	
+	def load(self, fname, lazy=False):
+		'''
+		Load an adaptive map from a FITS file written by save.
+		'''
+		if pyfits.getheader(abspath(fname)).get('ORDERING') != 'NUNIQ':
+			raise ValueError('%s does not contain an adaptive (NUNIQ) map.' % fname)
+		ExtinctionMap.load(self, fname)
+		self.max_order = int(np.round(np.log2(self.nside)))
+		self.update_index()
+	
+	def load_from_binaries(self, fname, max_order=9, N_procs=None):
+		'''
+		Load an adaptive map from a set of binary files produced by
+		fit_pdfs.py, in which pixels are identified by unique pixel
+		number. The finest order is <max_order>, or the finest order of
+		any cell, if greater.
+		'''
+		ExtinctionMap.load_from_binaries(self, fname, N_procs=N_procs, sparse=True)
+		order = uniq2nest(self.sparse_index)[0]
+		if order.size != 0:
+			max_order = max(max_order, int(np.max(order)))
+		self.max_order = max_order
+		self.update_index()
+	
+	def to_dense(self):
+		raise ValueError('Adaptive maps cannot be stored in dense mode (see to_healpix).')
+	
+	def locate(self, l, b):
+		'''
+		Locate points, given in Galactic coordinates (in degrees), among
+		the cells of the map, in O(log n) per point.
+		
+		Output:
+		    col    Column of Ar containing each point (0 for points not
+		           covered by the map)
+		    found  True where the point lies in a cell of the map
+		'''
+		theta, phi = lb2thetaphi(np.asarray(l), np.asarray(b))
+		pix = hp.ang2pix(self.nside, theta, phi, nest=True)
+		return self.index.locate(pix)
+	
+	def valid_lb(self):
+		'''
+		Return the columns of Ar holding valid cells, along with the
+		Galactic (l, b) of the cell centers, in degrees.
+		'''
+		col = np.where(np.isfinite(self.Ar[0]))[0]
+		order, ipix = uniq2nest(self.sparse_index[col])
+		l = np.empty(col.size, dtype=np.float64)
+		b = np.empty(col.size, dtype=np.float64)
+		for o in np.unique(order):
+			sel = (order == o)
+			theta, phi = hp.pix2ang(2**int(o), ipix[sel], nest=True)
+			l[sel], b[sel] = thetaphi2lb(theta, phi)
+		return col, l, b
+	
+	def to_healpix(self, nside=None):
+		'''
+		Resample the map onto a regular healpix map, in nested ordering
+		and sparse mode, at <nside> (by default, that of the finest
+		cells). Each cell coarser than <nside> is copied into all of its
+		descendants, among which its stars are divided evenly, while
+		cells finer than <nside> are averaged as in degrade.
+		'''
+		if nside is None:
+			nside = self.nside
+		order_out = int(np.round(np.log2(nside)))
+		if (nside < 1) or (2**order_out != nside):
+			raise ValueError('<nside> must be a power of two.')
+		
+		col = np.where(np.isfinite(self.Ar[0]))[0]
+		order, ipix = uniq2nest(self.sparse_index[col])
+		pix_list, col_list, frac_list = [], [], []
+		for o in np.unique(order):
+			sel = np.where(order == o)[0]
+			if o <= order_out:
+				N_child = 4**(order_out - int(o))
+				pix_list.append((N_child * ipix[sel][:,None] + np.arange(N_child)[None,:]).flatten())
+				col_list.append(np.repeat(col[sel], N_child))
+				frac_list.append(np.repeat(1. / N_child, sel.size * N_child))
+			else:
+				pix_list.append(ipix[sel] >> (2 * (int(o) - order_out)))
+				col_list.append(col[sel])
+				frac_list.append(np.ones(sel.size, dtype=np.float64))
+		if len(pix_list) == 0:
+			return ExtinctionMap(nside=nside, nested=True, mu=self.mu, sparse=True)
+		
+		pix_index, inverse = np.unique(np.concatenate(pix_list), return_inverse=True)
+		return self.bin_columns(np.concatenate(col_list), pix_index, inverse, nside, frac=np.concatenate(frac_list))
+	
+	def degrade(self, nside_out):
+		'''
+		Return a regular healpix map at <nside_out> (see to_healpix).
+		'''
+		return self.to_healpix(nside_out)
+	
+	def rasterize(self, mu_eval, **kwargs):
+		'''
+		Rasterize the map at the resolution of its finest cells (see
+		ExtinctionMap.rasterize and to_healpix).
+		'''
+		return self.to_healpix().rasterize(mu_eval, **kwargs)
+
 
 def main():
 	fname = ['../output/gal_plane_reddening_pt1_500%d.dat' % i for i in range(3)]
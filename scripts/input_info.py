@@ -23,11 +23,177 @@
 #       
 
 import numpy as np
-import sys, argparse
-from os.path import abspath
+import os, sys, argparse
+from os.path import abspath, exists, getmtime
 
 
-def seek_to_pixel(f, index):
+# Size of each pixel header (healpix index, (l, b), N_stars) and of each
+# star (obj_id, l, b, 5 x mag, 5 x err) in a galstar input file
+HEADER_BYTES = 4 + 2*8 + 4
+STAR_BYTES = 13 * 8
+
+# Table of contents of a galstar input file: one row per pixel, giving the
+# byte offset of the pixel header from the start of the file
+TOC_DTYPE = np.dtype([('pix_index', 'u4'), ('l', 'f8'), ('b', 'f8'), ('N_stars', 'u4'), ('offset', 'u8')])
+
+# Pixel header, as laid out in the file
+HEADER_DTYPE = np.dtype([('pix_index', 'u4'), ('l', 'f8'), ('b', 'f8'), ('N_stars', 'u4')])
+
+
+def toc_fname(infile):
+	'''
+	Filename of the table of contents accompanying a galstar input file.
+	'''
+	return '%s.toc' % infile
+
+
+def write_toc(infile, toc):
+	'''
+	Write the table of contents of the galstar input file <infile>, as
+	a sidecar file next to it.
+	
+	Inputs:
+		infile		filename of galstar input file
+		toc			TOC_DTYPE array, or list of tuples
+					(pix_index, l, b, N_stars, offset), one per pixel
+	'''
+	toc = np.array(toc, dtype=TOC_DTYPE).reshape(-1)
+	fname = toc_fname(infile)
+	f = open(fname + '.tmp', 'wb')
+	np.save(f, toc)
+	f.close()
+	os.rename(fname + '.tmp', fname)
+
+
+class InputWriter():
+	'''
+	Write a galstar input file in blocks of pixels, along with its table
+	of contents. Each block is assembled in memory and written at once.
+	'''
+	
+	def __init__(self, fname):
+		self.fname = fname
+		self.f = open(fname, 'wb')
+		self.f.write(np.array([0], dtype=np.uint32).tostring())
+		self.offset = 4
+		self.toc = []
+	
+	def write(self, pix_index, l, b, N_stars, stars):
+		'''
+		Append a block of pixels to the file.
+		
+		Inputs:
+			pix_index	healpix index of each pixel
+			l, b		galactic (l, b) of each pixel
+			N_stars		# of stars in each pixel
+			stars		data for all stars, pixel by pixel (one row per
+						star, with a whole number of float64 per row)
+		'''
+		npix = len(N_stars)
+		header = np.empty(npix, dtype=HEADER_DTYPE)
+		header['pix_index'] = pix_index
+		header['l'] = l
+		header['b'] = b
+		header['N_stars'] = N_stars
+		
+		# Insert each header in front of the first star of its pixel
+		stars = np.ascontiguousarray(stars)
+		star_words = stars.view(np.uint64).reshape(-1)
+		words_per_star = star_words.size // max(stars.shape[0], 1)
+		first_star = np.cumsum(header['N_stars'], dtype=np.int64) - header['N_stars']
+		words = np.insert(star_words, np.repeat(first_star * words_per_star, HEADER_BYTES // 8), header.view(np.uint64))
+		words.tofile(self.f)
+		
+		toc = np.empty(npix, dtype=TOC_DTYPE)
+		for name in HEADER_DTYPE.names:
+			toc[name] = header[name]
+		toc['offset'] = self.offset + HEADER_BYTES * np.arange(npix) + 8 * words_per_star * first_star
+		self.toc.append(toc)
+		self.offset += 8 * words.size
+	
+	def close(self):
+		'''
+		Record the number of pixels at the start of the file, close it and
+		write its table of contents, which is returned.
+		'''
+		toc = np.concatenate(self.toc) if len(self.toc) != 0 else np.empty(0, dtype=TOC_DTYPE)
+		self.f.seek(0)
+		self.f.write(np.array([toc.size], dtype=np.uint32).tostring())
+		self.f.close()
+		write_toc(self.fname, toc)
+		return toc
+	
+	def discard(self):
+		'''
+		Close and delete the (partially written) file, along with any
+		table of contents left next to it.
+		'''
+		self.f.close()
+		for fname in (self.fname, toc_fname(self.fname)):
+			if exists(fname):
+				os.remove(fname)
+
+
+def write_input(fname, pix_index, l, b, N_stars, stars):
+	'''
+	Write a galstar input file, and its table of contents, in a single
+	block. See InputWriter.write for the inputs.
+	
+	Output:
+		toc (TOC_DTYPE array)
+	'''
+	writer = InputWriter(fname)
+	writer.write(pix_index, l, b, N_stars, stars)
+	return writer.close()
+
+
+def scan_toc(f, star_bytes=STAR_BYTES):
+	'''
+	Build the table of contents of an open galstar input file by reading
+	every pixel header. Each star is assumed to take up <star_bytes>
+	bytes. Raises ValueError if a pixel header lies past the end of the
+	file.
+	'''
+	f.seek(0, 0)
+	npix = np.fromfile(f, dtype=np.uint32, count=1)[0]
+	toc = np.empty(npix, dtype=TOC_DTYPE)
+	for i in xrange(npix):
+		toc['offset'][i] = f.tell()
+		header = np.fromfile(f, dtype=HEADER_DTYPE, count=1)
+		if header.size != 1:
+			raise ValueError('Header of pixel %d lies past the end of the file. The file may be corrupt, or use a different star format than %d bytes per star.' % (i, star_bytes))
+		for name in HEADER_DTYPE.names:
+			toc[name][i] = header[name][0]
+		f.seek(int(toc['N_stars'][i]) * star_bytes, 1)
+	return toc
+
+
+def load_toc(infile, star_bytes=STAR_BYTES):
+	'''
+	Load the table of contents of a galstar input file. The sidecar
+	file is used if it is at least as new as the input file and lists
+	every pixel. Otherwise, the input file is scanned.
+	
+	Outputs:
+		toc (TOC_DTYPE array)	one row per pixel in the input file
+		from_sidecar (bool)		True if the sidecar file was used
+	'''
+	f = open(infile, 'rb')
+	npix = np.fromfile(f, dtype=np.uint32, count=1)[0]
+	
+	fname = toc_fname(infile)
+	if exists(fname) and (getmtime(fname) >= getmtime(infile)):
+		toc = np.load(fname)
+		if (toc.dtype == TOC_DTYPE) and (toc.size == npix):
+			f.close()
+			return toc, True
+	
+	toc = scan_toc(f, star_bytes)
+	f.close()
+	return toc, False
+
+
+def seek_to_pixel(f, index, toc=None):
 	'''
 	Seek to the beginning of the data (i.e. past header) in pixel #index,
 	returning the header for the given pixel.
@@ -35,6 +201,9 @@ def seek_to_pixel(f, index):
 	Inputs:
 		f (open 'rb' file object)	open galstar input file
 		index						index of pixel to seek to
+		toc (optional)				table of contents of the file, from
+									load_toc. If not given, every
+									preceding pixel header is read.
 	
 	Outputs:
 		pix_index (uint32)		healpix index of pixel
@@ -44,6 +213,13 @@ def seek_to_pixel(f, index):
 	if index < 0:
 		raise ValueError('Pixel index must be non-negative.')
 	
+	if toc is not None:
+		if index >= toc.size:
+			raise Exception('Not enough pixels in input file.')
+		row = toc[index]
+		f.seek(int(row['offset']) + HEADER_BYTES, 0)
+		return row['pix_index'], np.array([row['l'], row['b']]), row['N_stars']
+	
 	try:
 		f.seek(0, 0)
 	except:
@@ -58,7 +234,7 @@ def seek_to_pixel(f, index):
 		gal_lb = np.fromfile(f, dtype=np.float64, count=2)
 		N_stars = np.fromfile(f, dtype=np.uint32, count=1)[0]
 		if i != index:
-			f.seek(N_stars * 13 * 8, 1)
+			f.seek(N_stars * STAR_BYTES, 1)
 	
 	return pix_index, gal_lb, N_stars
 
@@ -68,30 +244,46 @@ def main():
 	parser.add_argument('--npix', action='store_true', help='Print # of pixels in the given input file.')
 	parser.add_argument('--pix_index', type=int, help='Print healpix index of the specified pixel.')
 	parser.add_argument('--nstars', type=int, help='Print # of stars in the specified pixel.') 
+	parser.add_argument('--list', action='store_true', help='Print the table of contents: index, healpix index, l, b, # of stars and byte offset of each pixel.')
+	parser.add_argument('--write_toc', action='store_true', help='Write the table of contents to <infile>.toc, if it is missing or out of date.')
+	parser.add_argument('--star_bytes', type=int, default=STAR_BYTES, help='# of bytes per star, used if the file must be scanned (default: %d).' % STAR_BYTES)
 	if 'python' in sys.argv[0]:
 		offset = 2
 	else:
 		offset = 1
 	values = parser.parse_args(sys.argv[offset:])
 	
-	f = open(abspath(values.infile), 'rb')
+	infile = abspath(values.infile)
+	f = open(infile, 'rb')
 	npix = np.fromfile(f, dtype=np.uint32, count=1)[0]
+	f.close()
 	
 	if values.npix:
 		print npix
 	
+	toc = None
+	if values.list or values.write_toc or (values.pix_index != None) or (values.nstars != None):
+		toc, from_sidecar = load_toc(infile, values.star_bytes)
+		if values.write_toc and not from_sidecar:
+			write_toc(infile, toc)
+	
+	for index in (values.pix_index, values.nstars):
+		if (index != None) and ((index < 0) or (index >= toc.size)):
+			print 'Pixel %d not in input file (%d pixels).' % (index, toc.size)
+			return 1
+	
 	if values.pix_index != None:
-		pix_index, gal_lb, N_stars = seek_to_pixel(f, values.pix_index)
-		print pix_index
+		print toc['pix_index'][values.pix_index]
 	
 	if values.nstars != None:
-		pix_index, gal_lb, N_stars = seek_to_pixel(f, values.nstars)
-		print N_stars
+		print toc['N_stars'][values.nstars]
 	
-	f.close()
+	if values.list:
+		print '# index  pix_index  l  b  N_stars  offset'
+		for i,row in enumerate(toc):
+			print '%d %d %.6f %.6f %d %d' % (i, row['pix_index'], row['l'], row['b'], row['N_stars'], row['offset'])
 	
 	return 0
 
 if __name__ == '__main__':
 	main()
-
@@ -90,26 +90,60 @@ class index_by_key(object):
 
 class index_by_unsortable_key(object):
 	'''Returns sets of indices referring to each value of the key,
-	where the key is not sortable (does not admit < or > operators).'''
+	where the key is not sortable (does not admit < or > operators).
+	Keys are bucketed by their byte representation, and equality is
+	checked only within each bucket, so grouping takes linear time.'''
 	
 	def __init__(self, key):
 		self.key = key
-		self.unused = np.ones(len(key), dtype=np.bool)
+		self.first = []
+		self.blocks = []
+		
+		buckets = {}
+		for i,k in enumerate(key):
+			k_arr = np.asarray(k)
+			bucket = buckets.setdefault((k_arr.dtype.str, k_arr.shape, k_arr.tostring()), [])
+			for n in bucket:
+				if np.array_equal(key[self.first[n]], k):
+					self.blocks[n].append(i)
+					break
+			else:
+				bucket.append(len(self.blocks))
+				self.first.append(i)
+				self.blocks.append([i])
+		
+		self.block_num = 0
 	
 	def __iter__(self):
 		return self
 	
 	def next(self):
-		if np.all(~self.unused):
+		if self.block_num == len(self.blocks):
 			raise StopIteration
 		else:
-			block_indices = []
-			unused_indices = np.where(self.unused)[0]
-			for i in unused_indices:
-				if np.all(self.key[i] == self.key[unused_indices[0]]):
-					block_indices.append(i)
-					self.unused[i] = False
-			return self.key[unused_indices[0]], block_indices
+			block_indices = self.blocks[self.block_num]
+			block_key = self.key[self.first[self.block_num]]
+			self.block_num += 1
+			return block_key, block_indices
+
+
+def group_rows(arr):
+	'''
+	Group identical rows of a 2-D array.
+	
+	Input:
+	    arr           2-D array
+	
+	Output:
+	    rows          Unique rows of <arr>, in ascending order
+	    block_indices List containing the indices of the rows of <arr>
+	                  equal to each unique row
+	'''
+	rows, inverse = np.unique(arr, axis=0, return_inverse=True)
+	inverse = inverse.reshape(-1)
+	order = np.argsort(inverse, kind='mergesort')
+	block_indices = np.split(order, np.cumsum(np.bincount(inverse, minlength=rows.shape[0]))[:-1])
+	return rows, block_indices
 
 
 
@@ -129,6 +163,12 @@ def main():
 	
 	print ''
 	
+	rows, block_indices = group_rows(np.array(x))
+	for key, indices in zip(rows, block_indices):
+		print key, y[indices]
+	
+	print ''
+	
 	return 0
 
 if __name__ == '__main__':
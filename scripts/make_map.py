@@ -25,6 +25,8 @@
 import matplotlib as mplib
 import matplotlib.patheffects as PathEffects
 import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 
 import numpy as np
 import healpy as hp
@@ -34,13 +36,19 @@ import gzip
 
 import sys, argparse
 import os
+import multiprocessing
 from os.path import abspath, isdir
 
 import healpix_utils as hputils
 import iterators
+import reddening_io
 
 
-def load_reddening(fname):
+# Stack of rasterized frames and plot settings, shared with worker processes by export_frames
+_frame_data = None
+
+
+def load_reddening(fname, N_procs=None):
 	'''
 	Load the pixels contained in the file(s) given by <fname>,
 	returning the reddening profile, along with the healpix
@@ -49,6 +57,7 @@ def load_reddening(fname):
 	
 	Input:
 		fname		(string or list of strings)
+		N_procs		# of processes with which to load files
 	
 	Output:
 		mu_anchors	(list of flat np.float64 arrays)
@@ -66,49 +75,13 @@ def load_reddening(fname):
 	chi2dof_list = []
 	
 	# Store (DM, Ar) fit for each healpix pixel
-	for filename in fname:
-		#print 'Opening %s ...' % filename
-		f = open(abspath(filename), 'rb')
-		
-		while True:
-			try:
-				pix_index = np.fromfile(f, dtype=np.uint64, count=1)[0]
-				N_stars = np.fromfile(f, dtype=np.uint32, count=1)[0]
-				measure = np.fromfile(f, dtype=np.float64, count=1)[0]
-				success = np.fromfile(f, dtype=np.uint16, count=1)[0]
-				N_regions = np.fromfile(f, dtype=np.uint16, count=1)[0]
-				line_int = np.fromfile(f, dtype=np.float64, count=N_stars)
-				mu_anchors = np.fromfile(f, dtype=np.float64, count=N_regions+1)
-				Ar_anchors = np.fromfile(f, dtype=np.float64, count=N_regions+1)
-				
-				
-				#print 'pixel index: %d' % pix_index
-				#print '# of stars: %d' % N_stars
-				'''
-				print 'chisq: %.2f (%.2f / d.o.f.)' % (measure, measure / float(N_stars - int(N_regions) - 1))
-				print 'success: %d' % success
-				print '# of regions: %d' % N_regions
-				'''
-				'''
-				print 'line integrals:'
-				print line_int
-				print 'mu anchors:'
-				print mu_anchors
-				print 'A_r anchors:'
-				print Ar_anchors
-				'''
-				#print ''
-				
-				mu_anchors_list.append(mu_anchors)
-				Ar_anchors_list.append(Ar_anchors)
-				pix_index_list.append(pix_index)
-				chi2dof_list.append(measure / float(N_stars - int(N_regions) - 1))
-				
-			except:
-				f.close()
-				break
-		
-		f.close()
+	for table in reddening_io.load_tables(fname, N_procs):
+		if table is None:
+			continue
+		mu_anchors_list += list(table['mu_anchors'])
+		Ar_anchors_list += list(table['Ar_anchors'])
+		pix_index_list += list(table['pix_index'])
+		chi2dof_list += list(table['measure'] / (table['N_stars'].astype(np.float64) - table['N_regions'].astype(np.float64) - 1.))
 	
 	pix_index_list = np.array(pix_index_list, dtype=np.uint64)
 	
@@ -166,35 +139,19 @@ def eval_Ar(mu_anchors, Ar_anchors, pix_index, mu_eval, nside=512):
 	Ar_map.fill(np.inf)
 	
 	# Sort the elements in mu
-	if len(mu_eval) == 0:
-		mu_eval = [mu_eval]
-	mu_eval.sort()
+	mu_eval = np.sort(np.atleast_1d(np.asarray(mu_eval, dtype=np.float64)))
 	
-	# Evaluate each pixel in the maps
-	for mu_arr, indices in iterators.index_by_unsortable_key(mu_anchors):
-		Ar_arr = np.empty((len(mu_arr), len(indices)), dtype=np.float64)
-		for i in indices:
-			Ar_arr[:,i] = Ar_anchors[i]
+	# Group together pixels sharing the same anchors
+	if len(set([len(mu_arr) for mu_arr in mu_anchors])) == 1:
+		groups = zip(*iterators.group_rows(np.array(mu_anchors, dtype=np.float64)))
+	else:
+		groups = iterators.index_by_unsortable_key(mu_anchors)
 		
-		n = 0
-		j = 1
-		pix = pix_index[indices]
-		while j <= len(mu_arr):
-			if mu_arr[j] >= mu_eval[n]:
-				slope = (Ar_arr[j] - Ar_arr[j-1]) / (mu_arr[j] - mu_arr[j-1])
-				Ar_map[n, pix] = Ar_arr[j-1] + slope * (mu_eval[n] - mu_arr[j-1])
-				
-				#print '%.3f <= %.3f <= %.3f' % (mu_arr[j-1], mu_eval[n], mu_arr[j])
-				#print 'Delta_mu = %.3g' % (mu_eval[n] - mu_arr[j-1])
-				#print 'slope:'
-				#print slope
-				#print ''
-				
-				n += 1
-				if n >= len(mu_eval):
-					break
-			else:
-				j += 1
+	# Evaluate each group of pixels in the maps
+	for mu_arr, indices in groups:
+		Ar_arr = np.array([Ar_anchors[i] for i in indices], dtype=np.float64).T
+		pix = np.asarray(pix_index)[indices].astype(np.int64)
+		Ar_map[:, pix] = hputils.interpolate_anchors(mu_arr, Ar_arr, mu_eval)
 	
 	return Ar_map
 
@@ -202,7 +159,9 @@ def eval_Ar(mu_anchors, Ar_anchors, pix_index, mu_eval, nside=512):
 
 def write_maps(fname, maps, mu, nest=True):
 	'''
-	Write extinction map to a FITS file.
+	Write extinction map to a FITS file. The maps are stored as a single
+	2-D image of shape (# of distances, # of pixels), following a primary
+	HDU containing the distance moduli (see read_maps).
 	
 	Input:
 	    fname  output filename
@@ -212,49 +171,257 @@ def write_maps(fname, maps, mu, nest=True):
 	           ordering is used.
 	'''
 	
+	maps = np.asarray(maps, dtype=np.float64)
 	if len(maps.shape) == 1:
-		maps.shape = (1, maps.shape[0])
+		maps = maps.reshape(1, maps.shape[0])
 	elif len(maps.shape) != 2:
 		raise Exception('<maps> has invalid shape.')
 	if len(mu) != len(maps):
 		raise Exception('<mu> must have same length as <maps>.')
 	
+	img = pyfits.ImageHDU(maps)
+	img.header.update('PIXTYPE', 'HEALPIX')
+	if nest:
+		img.header.update('ORDERING', 'NESTED')
+	else:
+		img.header.update('ORDERING', 'RING')
+	img.header.update('NSIDE', hp.npix2nside(maps.shape[1]))
+	img.header.update('NDIST', maps.shape[0])
+	img.header.update('DESC', 'EXTINCTN')
+	img.header.update('UNITS', 'MAGS')
+	
+	hdulist = pyfits.HDUList([pyfits.PrimaryHDU(np.asarray(mu, dtype=np.float64)), img])
+	hdulist.writeto(fname, clobber=True)
+
+
+def read_maps(fname):
 	'''
-	cols = []
-	cols.append(pyfits.Column(name='MU', format='%dD' % len(mu), array=mu))
-	for i, m in enumerate(maps):
-		cols.append(pyfits.Column(name='A_R %d' % i, format='D', array=m))
+	Read in extinction map from a FITS file written by write_maps. The
+	file is memory-mapped, so that pixels are only read from disk as
+	they are accessed. Files with one image HDU per distance (written
+	by earlier versions of write_maps, or dense maps saved by
+	hputils.ExtinctionMap.save) are stacked lazily (see
+	hputils.LazyPlanes).
 	
-	tbhdu = pyfits.new_table(cols)
-	tbhdu.header.update('NESTED', nest, 'Healpix ordering scheme.')
-	tbhdu.header.update('NSIDE', hp.npix2nside(maps.shape[1]), 'Healpix nside parameter.')
+	Input:
+	    fname  input filename
 	
-	tbhdu.writeto(fname, clobber=True)
+	Output:
+	    maps   Extinction maps, indexed by (distance, pixel)
+	    mu     Distance modulus of each extinction map
 	'''
 	
-	hdu = []
-	hdu.append(pyfits.PrimaryHDU(mu))
-	for m in maps:
-		hdu.append(pyfits.ImageHDU(m))
-	hdulist = pyfits.HDUList(hdu)
-	hdulist.writeto(fname, clobber=True)
+	f = pyfits.open(abspath(fname), memmap=True)
+	if f[0].header.get('INDXSCHM', 'IMPLICIT') == 'EXPLICIT':
+		raise ValueError('%s contains a partial-sky map (load it with hputils.ExtinctionMap).' % fname)
+	mu = np.array(f[0].data, dtype=np.float64).flatten()
 
+	# Skip the images of N_stars and measure in files saved by ExtinctionMap
+	hdus = [hdu for hdu in f[1:] if hdu.header.get('DESC', 'EXTINCTN') == 'EXTINCTN']
+	if len(hdus) == 0:
+		raise ValueError('No extinction maps found in %s.' % fname)
+	if (len(hdus) == 1) and (hdus[0].header['NAXIS'] == 2):
+		maps = hdus[0].data
+	else:
+		maps = hputils.LazyPlanes(hdus, hdus[0].header['NAXIS1'])
+	if len(maps) != mu.size:
+		raise ValueError('# of maps in %s does not match # of distance moduli.' % fname)
+	
+	return maps, mu
 
-def read_maps(fname):
+
+
+def load_map(input_files, nside=512, nest=True, adaptive=False):
+	'''
+	Load an extinction map from a FITS file, or from the reddening files
+	generated by fit_pdfs.py (given as a list of files, or a directory
+	containing .dat files). If <adaptive> is True, the pixels are
+	mixed-order cells identified by unique pixel number, with the finest
+	cells at <nside> (see hputils.AdaptiveExtinctionMap).
+	'''
+	if (len(input_files) == 1) and isdir(input_files[0]):
+		input_dir = input_files[0]
+		input_files = []
+		for f in os.listdir(input_dir):
+			if f.endswith('.dat'):
+				input_files.append(os.path.join(input_dir, f))
+	if adaptive:
+		if (len(input_files) == 1) and (input_files[0].endswith('.fits')):
+			return hputils.AdaptiveExtinctionMap(input_files[0])
+		max_order = int(np.round(np.log2(nside)))
+		return hputils.AdaptiveExtinctionMap(input_files, FITS=False, max_order=max_order)
+	if (len(input_files) == 1) and (input_files[0].endswith('.fits')):
+		return hputils.ExtinctionMap(input_files[0])
+	return hputils.ExtinctionMap(input_files, FITS=False, nside=nside, nested=nest)
+
+
+def frame_fname(fname_pattern, k):
+	'''
+	Filename of the <k>-th frame. The pattern may contain a format
+	specifier (e.g. frame_%04d.png); otherwise, the frame number is
+	inserted before the extension.
 	'''
-	Read in extinction map from a FITS file.
+	if '%' in fname_pattern:
+		return fname_pattern % k
+	base, ext = os.path.splitext(fname_pattern)
+	if ext == '':
+		ext = '.png'
+	return '%s.%04d%s' % (base, k, ext)
+
+
+def export_frame(k):
+	'''
+	Render the <k>-th frame of the shared stack to a file. The figure is
+	drawn directly onto an Agg canvas, independent of pyplot's state.
+	'''
+	img, mu_eval, extent, vmin, vmax, figsize, dpi, diff, fname_pattern = _frame_data
+	
+	fig = Figure(figsize=figsize, dpi=dpi)
+	canvas = FigureCanvasAgg(fig)
+	ax = fig.add_axes([0.08, 0.1, 0.8, 0.75])
+	image = ax.imshow(img[k].T, extent=extent, origin='lower', aspect='auto', interpolation='nearest', vmin=vmin, vmax=vmax)
+	ax.set_xlabel(r'$\ell$')
+	ax.set_ylabel(r'$b$')
+	
+	# Label frame
+	x_min, x_max = ax.get_xlim()
+	y_min, y_max = ax.get_ylim()
+	x, y = x_min + 0.95*(x_max - x_min), y_min + 0.95*(y_max - y_min)
+	txt = ax.text(x, y, r'$\mu = %.2f$' % mu_eval[k], color='white', fontsize=14, horizontalalignment='right', verticalalignment='top')
+	txt.set_path_effects([PathEffects.withStroke(linewidth=2, foreground='k')])
+	if diff:
+		fig.suptitle(r'$\Delta A_r$', fontsize=20, y=0.95)
+	else:
+		fig.suptitle(r'$A_r$', fontsize=20, y=0.95)
+	
+	# Add colorbar
+	cax = fig.add_axes([0.9, 0.1, 0.03, 0.75])
+	fig.colorbar(image, cax=cax)
+	
+	fname = frame_fname(fname_pattern, k)
+	canvas.print_figure(fname, dpi=dpi)
+	
+	return fname
+
+
+def export_frames(m, mu_eval, fname_pattern, lb_bounds=(0., 360., -90., 90.), size=(500,200), center_gal=False, diff=False, vmin=None, vmax=None, figsize=(9,5), dpi=150, N_procs=None):
+	'''
+	Export one image per distance modulus, rendering the frames in a
+	pool of <N_procs> processes. The map is evaluated once, at all
+	distances and only in the pixels covered by the image, and the
+	color scale is shared by all frames.
 	
 	Input:
-	    fname  input filename
+	    m              ExtinctionMap
+	    mu_eval        Distance moduli of the frames
+	    fname_pattern  Output filename pattern (see frame_fname)
+	    lb_bounds      (l_min, l_max, b_min, b_max)
+	    size           (xsize, ysize) of rasterized images
+	    center_gal     If True, center the images on l = 0
+	    diff           Show differential extinction between frames
+	    vmin, vmax     Color scale. By default, 0 and the 99th percentile
+	                   of the last frame (or of all frames, if <diff>).
+	
+	Output:
+	    List of filenames written
 	'''
+	global _frame_data
+	
+	mu_eval = np.array(mu_eval, dtype=np.float64)
+	
+	# Rasterize all distances using one projection grid
+	proj = hputils.get_projection(m.nside, m.nested, lb_bounds, size, center_gal)
+	pix_index, inverse = np.unique(proj.pix, return_inverse=True)
+	Ar = m.evaluate(mu_eval, pix_index=pix_index)
+	if diff:
+		Ar[1:] = Ar[1:] - Ar[:-1]
+	img = Ar[:, inverse].reshape(mu_eval.size, size[0], size[1])
+	del Ar, inverse
+	
+	# Color scale, computed once for all frames
+	if vmin is None:
+		vmin = 0.
+	if vmax is None:
+		if diff:
+			finite = img[np.isfinite(img)]
+		else:
+			finite = img[-1][np.isfinite(img[-1])]
+		vmax = np.percentile(finite, 99.) if finite.size != 0 else 1.
+		del finite
+	
+	extent = [lb_bounds[1], lb_bounds[0], lb_bounds[2], lb_bounds[3]]
+	if center_gal:
+		extent[0] -= 180.
+		extent[1] -= 180.
+	
+	# Workers inherit the frame stack when the pool is forked
+	_frame_data = (img, mu_eval, extent, vmin, vmax, figsize, dpi, diff, fname_pattern)
+	if N_procs == 1:
+		fnames = map(export_frame, range(mu_eval.size))
+	else:
+		pool = multiprocessing.Pool(N_procs)
+		fnames = pool.map(export_frame, range(mu_eval.size))
+		pool.close()
+		pool.join()
+	_frame_data = None
 	
-	d,h = pyfits.read(fname)
-	# TODO: Finish this function
+	return fnames
 
 
+def main_frames(args):
+	parser = argparse.ArgumentParser(prog='make_map.py frames', description='Export one image of reddening per distance modulus (e.g., as frames of a movie).', add_help=True)
+	parser.add_argument('input', type=str, nargs='+', help='Reddening files generated by fit_pdfs.py, directory containing input as .dat files, or FITS map.')
+	parser.add_argument('-o', '--out', type=str, required=True, help='Output filename pattern, e.g. frames/frame_%%04d.png.')
+	parser.add_argument('-n', '--nside', type=int, default=512, help='Healpix nside parameter.')
+	parser.add_argument('-nst', '--nest', action='store_true', help='Maps are stored in nested ordering scheme.')
+	parser.add_argument('-mu', '--mu', type=float, nargs='+', default=None, help='Distance moduli of frames.')
+	parser.add_argument('-mr', '--mu_range', type=float, nargs=3, default=(5., 17., 49), help='Distance moduli of frames: (start, stop, # of frames). Ignored if --mu is given (default: 5 17 49).')
+	parser.add_argument('-lb', '--lb_bounds', type=float, nargs=4, default=(0., 360., -90., 90.), help='(l_min, l_max, b_min, b_max).')
+	parser.add_argument('-sz', '--size', type=int, nargs=2, default=(500,200), help='Dimensions of each image: (xsize, ysize).')
+	parser.add_argument('-fig', '--figsize', type=float, nargs=2, default=(9,5), help='Width and height of each frame, in inches.')
+	parser.add_argument('-dpi', '--dpi', type=float, default=150, help='Dots per inch of output images.')
+	parser.add_argument('-min', '--min_Ar', type=float, default=None, help='Minimum Ar in color scale (default: 0).')
+	parser.add_argument('-max', '--max_Ar', type=float, default=None, help='Maximum Ar in color scale (default: 99th percentile at last distance).')
+	parser.add_argument('-d', '--diff', action='store_true', help='Show differential extinction at each distance modulus.')
+	parser.add_argument('-np', '--procs', type=int, default=None, help='# of processes with which to render frames (default: # of CPUs).')
+	parser.add_argument('-ad', '--adaptive', action='store_true', help='Pixels are mixed-order cells, identified by unique pixel number (see fits2galstarinput.py --adaptive), with the finest cells at --nside.')
+	values = parser.parse_args(args)
+	
+	if values.mu is not None:
+		mu_eval = np.array(values.mu, dtype=np.float64)
+	else:
+		mu_eval = np.linspace(values.mu_range[0], values.mu_range[1], int(values.mu_range[2]))
+	
+	m = load_map(values.input, nside=values.nside, nest=values.nest, adaptive=values.adaptive)
+	print '%d pixel(s) loaded.' % m.npix()
+	if values.adaptive:
+		m = m.to_healpix()
+	
+	out_dir = os.path.dirname(abspath(frame_fname(values.out, 0)))
+	if not isdir(out_dir):
+		os.makedirs(out_dir)
+	
+	lb_bounds = list(values.lb_bounds)
+	center_gal = (lb_bounds[0] == 0.) and (lb_bounds[1] == 360.)
+	np.seterr(all='ignore')
+	
+	fnames = export_frames(m, mu_eval, values.out, lb_bounds=lb_bounds, size=values.size, center_gal=center_gal, diff=values.diff, vmin=values.min_Ar, vmax=values.max_Ar, figsize=values.figsize, dpi=values.dpi, N_procs=values.procs)
+	print 'Wrote %d frame(s): %s ... %s' % (len(fnames), fnames[0], fnames[-1])
+	
+	return 0
 
 
 def main():
+	if 'python' in sys.argv[0]:
+		offset = 2
+	else:
+		offset = 1
+	
+	# Subcommands
+	if sys.argv[offset:offset+1] == ['frames']:
+		return main_frames(sys.argv[offset+1:])
+	
+	
 	parser = argparse.ArgumentParser(prog='make_map.py', description='Generate a map from the given reddening files generated by fit_pdfs.py.', add_help=True)
 	parser.add_argument('input', type=str, nargs='+', help='Reddening files generated by fit_pdfs.py, or directory containing input as .dat files.')
 	parser.add_argument('-n', '--nside', type=int, default=512, help='Healpix nside parameter.')
@@ -270,11 +437,9 @@ def main():
 	parser.add_argument('-fig', '--figsize', type=float, nargs=2, default=(9,5), help='Width and height of figure, in inches.')
 	parser.add_argument('-po', '--plotout', type=str, default=None, help='Output filename for plot.')
 	parser.add_argument('-fo', '--fitsout', type=str, default=None, help='Output filename (of type FITS) for reddening map.')
+	parser.add_argument('-pyr', '--pyramid', action='store_true', help='Also save lower-resolution (nside/2, nside/4, ..., 1) copies of the map alongside --fitsout.')
+	parser.add_argument('-ad', '--adaptive', action='store_true', help='Pixels are mixed-order cells, identified by unique pixel number (see fits2galstarinput.py --adaptive), with the finest cells at --nside.')
 	parser.add_argument('-sh', '--show', action='store_true', help='Show plot.')
-	if 'python' in sys.argv[0]:
-		offset = 2
-	else:
-		offset = 1
 	values = parser.parse_args(sys.argv[offset:])
 	
 	#if values.rowcol[0] * values.rowcol[1] != len(values.mu):
@@ -282,26 +447,21 @@ def main():
 	#	return 1
 	
 	# Load in pixels
-	input_files = None
-	if (len(values.input) == 1) and isdir(values.input[0]):
-		input_files = []
-		for f in os.listdir(values.input[0]):
-			if f.endswith('.dat'):
-				input_files.append(os.path.join(values.input[0], f))
-		#input_files = filter(lambda f: f.endswith('.dat'), os.listdir(values.input[0]))
-	else:
-		input_files = values.input
-	m = None
-	if (len(values.input) == 1) and (values.input[0].endswith('.fits')):
-		m = hputils.ExtinctionMap(input_files[0])
-	else:
-		m = hputils.ExtinctionMap(input_files, FITS=False, nside=values.nside, nested=values.nest)
+	m = load_map(values.input, nside=values.nside, nest=values.nest, adaptive=values.adaptive)
 	print '%d pixel(s) loaded.' % m.npix()
 	
 	# Output reddening maps to a FITS file
 	if values.fitsout != None:
 		print 'Saving extinction map to %s...' % values.fitsout
 		m.save(values.fitsout)
+		if values.pyramid:
+			m.build_pyramid()
+			m.save_pyramid(values.fitsout)
+			print 'Saved %d lower-resolution level(s) of the map.' % len(m.pyramid)
+	
+	# Plot adaptive maps at the resolution of their finest cells
+	if values.adaptive:
+		m = m.to_healpix()
 	
 	# Generate reddening map at a range of distances
 	mu_eval = np.array(values.mu, dtype=np.float64)
@@ -343,8 +503,8 @@ def main():
 	# Set up figures and axes
 	fig, ax = [], []
 	for i in range(len(values.mu)):
-		if i % (nrows*ncol) = 0:
-			fig.append(plt.figure(figsize=values.figsize, dpi=value.dpi))
+		if i % (nrows*ncol) == 0:
+			fig.append(plt.figure(figsize=values.figsize, dpi=values.dpi))
 		if values.mollweide:
 			ax.append(fig[-1].add_subplot(nrows, ncol, (i+1) % (nrows*ncol), projection='mollweide'))
 		else:
@@ -356,7 +516,7 @@ def main():
 				ax[-1].set_yticklabels([])
 	
 	# Give axes to m to plot
-	image = m.to_axes(ax, values.mu, size=values.size, center_gal=center_gal, lb_bounds=lb_bounds, log_scale=False, diff=value.diff)
+	image = m.to_axes(ax, values.mu, size=values.size, center_gal=center_gal, lb_bounds=lb_bounds, log_scale=False, diff=values.diff)
 	
 	
 	
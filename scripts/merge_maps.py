@@ -0,0 +1,317 @@
+#!/usr/bin/env python2.7
+# -*- coding: utf-8 -*-
+#
+#       merge_maps.py
+#       
+#       Copyright 2012 Greg <greg@greg-G53JW>
+#       
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 2 of the License, or
+#       (at your option) any later version.
+#       
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#       
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#       MA 02110-1301, USA.
+#       
+#       
+
+
+import os, sys, argparse
+from os.path import abspath, isdir, exists, join
+from itertools import groupby, izip
+
+import numpy as np
+import healpy as hp
+
+import healpix_utils as hputils
+import reddening_io
+
+
+# Ways of resolving pixels which appear in more than one input
+DUPLICATE_POLICIES = ('measure', 'stars', 'last', 'first')
+
+
+class MapMerger():
+	'''
+	Streaming merge of reddening profiles into a single healpix map.
+	Each batch of pixels is written directly into arrays preallocated
+	for the full sky (memory-mapped .npy files, if a scratch prefix is
+	given), so that no more than one input is held in memory at a time.
+	
+	Pixels which appear more than once are resolved by <policy>:
+	    measure  Keep the fit with the lowest (best) measure
+	    stars    Keep the fit with the most stars
+	    last     Keep the last fit encountered
+	    first    Keep the first fit encountered
+	Ties are resolved in favor of the later fit.
+	
+	The distance anchors of every input are checked against those of the
+	first input, to within <mu_tol>.
+	'''
+	
+	def __init__(self, nside, nested=True, policy='measure', scratch=None, mu_tol=1.e-6):
+		if policy not in DUPLICATE_POLICIES:
+			raise ValueError('Unknown duplicate policy: %s (choose from %s).' % (policy, ', '.join(DUPLICATE_POLICIES)))
+		self.nside = nside
+		self.nested = nested
+		self.policy = policy
+		self.scratch = scratch
+		self.mu_tol = mu_tol
+		self.N_pix = hp.nside2npix(nside)
+		
+		self.mu = None
+		self.Ar = None
+		self.N_stars = np.zeros(self.N_pix, dtype=np.uint32)
+		self.measure = np.empty(self.N_pix, dtype=np.float64)
+		self.measure.fill(np.NaN)
+		self.filled = np.zeros(self.N_pix, dtype=np.bool)
+		
+		self.N_records = 0
+		self.N_duplicates = 0
+	
+	def scratch_fname(self):
+		return '%s.Ar.npy' % abspath(self.scratch)
+	
+	def allocate(self, mu):
+		'''
+		Allocate the map of Ar, with the given distance anchors.
+		'''
+		self.mu = np.array(mu, dtype=np.float64)
+		shape = (self.mu.size, self.N_pix)
+		if self.scratch is None:
+			self.Ar = np.empty(shape, dtype=np.float64)
+		else:
+			self.Ar = np.lib.format.open_memmap(self.scratch_fname(), mode='w+', dtype=np.float64, shape=shape)
+		self.Ar.fill(np.NaN)
+	
+	def check_mu(self, mu_anchors, source):
+		'''
+		Raise a ValueError if any of the given distance anchors (one set
+		per row) differ from those of the map.
+		'''
+		mu_anchors = np.atleast_2d(mu_anchors)
+		if self.mu is None:
+			self.allocate(mu_anchors[0])
+		if (mu_anchors.shape[1] != self.mu.size) or np.any(np.abs(mu_anchors - self.mu[None,:]) > self.mu_tol):
+			raise ValueError('Distance anchors in %s are incompatible with those of the merged map.' % source)
+	
+	def score(self, N_stars, measure):
+		'''
+		Rank fits of the same pixel under the duplicate policy (higher
+		is better).
+		'''
+		if self.policy == 'stars':
+			return np.asarray(N_stars, dtype=np.float64)
+		score = -np.asarray(measure, dtype=np.float64)
+		score[np.isnan(score)] = -np.inf
+		return score
+	
+	def add(self, pix_index, N_stars, measure, mu_anchors, Ar_anchors, source='input'):
+		'''
+		Merge a batch of pixels into the map.
+		
+		Input:
+		    pix_index   Healpix pixel numbers (in the ordering of the map)
+		    N_stars     # of stars in each pixel
+		    measure     Fit measure of each pixel
+		    mu_anchors  Distance anchors, shape (# of pixels, # of anchors),
+		                or one set shared by all pixels
+		    Ar_anchors  Ar at the anchors, shape (# of pixels, # of anchors)
+		    source      Name of the input, for error messages
+		
+		Output:
+		    # of pixels written
+		'''
+		pix_index = np.asarray(pix_index, dtype=np.int64)
+		if pix_index.size == 0:
+			return 0
+		if np.any((pix_index < 0) | (pix_index >= self.N_pix)):
+			raise ValueError('%s contains pixels outside of a map with nside = %d.' % (source, self.nside))
+		self.check_mu(mu_anchors, source)
+		N_stars = np.asarray(N_stars)
+		measure = np.asarray(measure, dtype=np.float64)
+		self.N_records += pix_index.size
+		
+		# Resolve duplicates within the batch
+		rows = np.arange(pix_index.size)
+		if self.policy == 'first':
+			score = -rows.astype(np.float64)
+		elif self.policy == 'last':
+			score = np.zeros(pix_index.size, dtype=np.float64)
+		else:
+			score = self.score(N_stars, measure)
+		order = np.lexsort((rows, score, pix_index))
+		best = np.ones(order.size, dtype=np.bool)
+		best[:-1] = (pix_index[order[1:]] != pix_index[order[:-1]])
+		sel = order[best]
+		pix = pix_index[sel]
+		
+		# Resolve duplicates with pixels already in the map
+		filled = self.filled[pix]
+		self.N_duplicates += pix_index.size - sel.size + np.sum(filled)
+		if self.policy == 'first':
+			replace = ~filled
+		elif self.policy == 'last':
+			replace = np.ones(sel.size, dtype=np.bool)
+		else:
+			replace = ~filled | (score[sel] >= self.score(self.N_stars[pix], self.measure[pix]))
+		sel, pix = sel[replace], pix[replace]
+		
+		self.Ar[:, pix] = np.asarray(Ar_anchors, dtype=np.float64)[sel].T
+		self.N_stars[pix] = N_stars[sel]
+		self.measure[pix] = measure[sel]
+		self.filled[pix] = True
+		
+		return sel.size
+	
+	def add_table(self, table, source='input'):
+		'''
+		Merge the per-pixel table of a file produced by fit_pdfs.py (see
+		reddening_io.load_table).
+		'''
+		if (table is None) or (table.size == 0):
+			return 0
+		return self.add(table['pix_index'], table['N_stars'], table['measure'], table['mu_anchors'], table['Ar_anchors'], source)
+	
+	def add_map(self, m, source='input', chunk_size=2**18):
+		'''
+		Merge the valid pixels of a (partial) ExtinctionMap, such as one
+		produced by an independent job. The pixels are read <chunk_size>
+		at a time, so that lazily loaded maps are never read in full.
+		'''
+		if isinstance(m, hputils.AdaptiveExtinctionMap):
+			raise ValueError('%s is an adaptive map, which cannot be merged into a healpix map.' % source)
+		if m.nside != self.nside:
+			raise ValueError('%s has nside = %d, but the merged map has nside = %d.' % (source, m.nside, self.nside))
+		
+		col = np.where(np.isfinite(m.Ar[0]))[0]
+		pix_index = col
+		if m.is_sparse():
+			pix_index = m.sparse_index[col]
+		if m.nested and not self.nested:
+			pix_index = hp.nest2ring(self.nside, pix_index)
+		elif self.nested and not m.nested:
+			pix_index = hp.ring2nest(self.nside, pix_index)
+		
+		N_written = 0
+		for start in xrange(0, col.size, chunk_size):
+			c = col[start:start+chunk_size]
+			N_written += self.add(pix_index[start:start+chunk_size], np.asarray(m.N_stars[c]), np.asarray(m.measure[c]), m.mu, np.asarray(m.Ar[:, c]).T, source)
+		
+		return N_written
+	
+	def npix(self):
+		return np.sum(self.filled)
+	
+	def to_map(self, sparse=False):
+		'''
+		Return the merged map as an ExtinctionMap. The dense map shares
+		its arrays with the merger.
+		'''
+		mu = self.mu
+		if mu is None:
+			mu = np.zeros(1, dtype=np.float64)
+		m = hputils.ExtinctionMap(nside=self.nside, nested=self.nested, mu=mu, sparse=True)
+		if self.Ar is None:
+			if not sparse:
+				m.to_dense()
+			return m
+		
+		if sparse:
+			pix_index = np.where(self.filled)[0]
+			m.sparse_index = pix_index
+			m.Ar = self.Ar[:, pix_index]
+			m.N_stars = self.N_stars[pix_index]
+			m.measure = self.measure[pix_index]
+		else:
+			m.sparse_index = None
+			m.Ar, m.N_stars, m.measure = self.Ar, self.N_stars, self.measure
+		
+		return m
+	
+	def close(self):
+		'''
+		Release the map, removing the scratch file (if any).
+		'''
+		self.Ar = None
+		if (self.scratch is not None) and exists(self.scratch_fname()):
+			os.remove(self.scratch_fname())
+
+
+def expand_inputs(inputs):
+	'''
+	Replace directories in the list of inputs by the .dat files they
+	contain.
+	'''
+	fnames = []
+	for fname in inputs:
+		if isdir(fname):
+			fnames += sorted([join(fname, f) for f in os.listdir(fname) if f.endswith('.dat')])
+		else:
+			fnames.append(fname)
+	return fnames
+
+
+def merge(inputs, nside=512, nested=True, policy='measure', scratch=None, mu_tol=1.e-6, N_procs=None):
+	'''
+	Merge reddening files produced by fit_pdfs.py (records or columnar
+	profile files) and partial maps (FITS files) into a MapMerger, in
+	the order given. Reddening files are loaded concurrently, in a pool
+	of <N_procs> processes, and merged as they arrive.
+	'''
+	merger = MapMerger(nside, nested=nested, policy=policy, scratch=scratch, mu_tol=mu_tol)
+	fnames = expand_inputs(inputs)
+	
+	for is_fits, group in groupby(fnames, lambda f: f.endswith('.fits')):
+		group = list(group)
+		if is_fits:
+			for fname in group:
+				m = hputils.ExtinctionMap(fname, FITS=True, lazy=True)
+				merger.add_map(m, source=fname)
+				del m
+		else:
+			for fname, table in izip(group, reddening_io.load_tables(group, N_procs)):
+				merger.add_table(table, source=fname)
+	
+	return merger
+
+
+def main():
+	parser = argparse.ArgumentParser(prog='merge_maps.py', description='Merge reddening files generated by fit_pdfs.py and partial extinction maps into a single map, streaming each input into the output map.', add_help=True)
+	parser.add_argument('input', type=str, nargs='+', help='Reddening files generated by fit_pdfs.py, directories containing .dat files, or partial maps (FITS), merged in the order given.')
+	parser.add_argument('-o', '--out', type=str, required=True, help='Output filename (FITS).')
+	parser.add_argument('-n', '--nside', type=int, default=512, help='Healpix nside parameter.')
+	parser.add_argument('-nst', '--nest', action='store_true', help='Reddening files (and the output map) use the nested ordering scheme.')
+	parser.add_argument('-dup', '--duplicates', type=str, choices=DUPLICATE_POLICIES, default='measure', help='Fit to keep for pixels present in more than one input: lowest measure, most stars, last or first encountered (default: measure).')
+	parser.add_argument('-tol', '--mu_tol', type=float, default=1.e-6, help='Tolerance when comparing distance anchors of different inputs (default: 1e-6).')
+	parser.add_argument('-sc', '--scratch', type=str, default=None, help='Memory-map the merged map to <scratch>.Ar.npy while merging, rather than holding it in memory.')
+	parser.add_argument('-sp', '--sparse', action='store_true', help='Save the merged map as a partial-sky (explicitly indexed) table.')
+	parser.add_argument('-np', '--procs', type=int, default=None, help='# of processes with which to load reddening files (default: # of CPUs).')
+	if 'python' in sys.argv[0]:
+		offset = 2
+	else:
+		offset = 1
+	values = parser.parse_args(sys.argv[offset:])
+	
+	try:
+		merger = merge(values.input, nside=values.nside, nested=values.nest, policy=values.duplicates, scratch=values.scratch, mu_tol=values.mu_tol, N_procs=values.procs)
+	except ValueError as e:
+		print 'Error: %s' % e
+		return 1
+	print 'Merged %d pixel record(s) into %d pixel(s) (%d duplicate(s)).' % (merger.N_records, merger.npix(), merger.N_duplicates)
+	
+	merger.to_map(sparse=values.sparse).save(values.out)
+	merger.close()
+	print 'Saved merged map to %s.' % values.out
+	
+	return 0
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,313 @@
+#!/usr/bin/env python2.7
+# -*- coding: utf-8 -*-
+#
+#       neighbor_graph.py
+#       
+#       Copyright 2012 Greg <greg@greg-G53JW>
+#       
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 2 of the License, or
+#       (at your option) any later version.
+#       
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#       
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#       MA 02110-1301, USA.
+#       
+#       
+
+
+import os, sys, argparse
+from os.path import abspath, dirname, exists, join
+import hashlib
+
+import numpy as np
+import scipy.sparse
+import healpy as hp
+
+import healpix_utils as hputils
+
+
+def footprint_hash(pix_index):
+	'''
+	Short hash identifying a set of healpix pixels.
+	'''
+	return hashlib.md5(np.asarray(pix_index, dtype=np.int64).tostring()).hexdigest()[:16]
+
+
+def cache_fname(cache_dir, nside, nested, pix_index):
+	'''
+	Filename under which the neighbor graph of the given pixels is
+	cached.
+	'''
+	return join(cache_dir, 'neighbors_nside%d_%s_%s.npz' % (nside, 'nest' if nested else 'ring', footprint_hash(pix_index)))
+
+
+def build_adjacency(nside, nested, pix_index, chunk_size=2**16):
+	'''
+	Build the sparse (CSR) adjacency matrix linking each of the given
+	(sorted) healpix pixels to those of its eight neighbors which are
+	also in the set. Each link is weighted by exp(-d^2 / 2 sigma^2),
+	where d is the angular distance between the pixel centers and sigma
+	is the pixel scale, as in fit_pdfs.get_neighbors. The pixels are
+	processed in chunks of <chunk_size>.
+	'''
+	pix_index = np.asarray(pix_index, dtype=np.int64)
+	N_pix = pix_index.size
+	sigma = hp.pixelfunc.nside2resol(nside, arcmin=False)
+	theta, phi = hp.pix2ang(nside, pix_index, nest=nested)
+	index_dtype = np.int32 if N_pix < 2**31 else np.int64
+	
+	data, indices = [], []
+	indptr = np.zeros(N_pix+1, dtype=np.int64)
+	for start in xrange(0, N_pix, chunk_size):
+		end = min(start + chunk_size, N_pix)
+		
+		# Neighbors of each pixel (healpy marks missing neighbors with -1), row by row
+		neighbors = np.asarray(hp.pixelfunc.get_all_neighbours(nside, pix_index[start:end], nest=nested)).T
+		col, found = hputils.pixel_columns(pix_index, neighbors)
+		found &= (neighbors >= 0)
+		row = np.repeat(np.arange(start, end)[:,None], neighbors.shape[1], axis=1)
+		row, col = row[found], col[found]
+		
+		dist = hputils.angular_distance(theta[row], phi[row], theta[col], phi[col])
+		data.append(np.exp(-dist * dist / (2. * sigma * sigma)))
+		indices.append(col.astype(index_dtype))
+		indptr[start+1:end+1] = np.cumsum(np.sum(found, axis=1))
+		indptr[start+1:end+1] += indptr[start]
+	
+	if N_pix == 0:
+		data, indices = [np.zeros(0)], [np.zeros(0, dtype=index_dtype)]
+	W = scipy.sparse.csr_matrix((np.concatenate(data), np.concatenate(indices), indptr), shape=(N_pix, N_pix))
+	W.sum_duplicates()
+	
+	return W
+
+
+class NeighborGraph():
+	'''
+	Weighted graph linking each pixel in a set of healpix pixels to its
+	neighbors in the set, stored as a sparse (CSR) matrix, W. Operations
+	on a map defined on the pixels (an array whose last axis runs over
+	the pixels, in the order of pix_index) reduce to sparse
+	matrix-vector products with W.
+	'''
+	
+	def __init__(self, nside, nested, pix_index, W=None):
+		self.nside = nside
+		self.nested = nested
+		self.pix_index = np.asarray(pix_index, dtype=np.int64)
+		if W is None:
+			W = build_adjacency(nside, nested, self.pix_index)
+		self.W = W
+		self.W_norm = None
+	
+	def __len__(self):
+		return self.pix_index.size
+	
+	def save(self, fname):
+		'''
+		Save the graph to an .npz file. The file is written under a
+		temporary name and then renamed, so that concurrent jobs never
+		read a partially written graph.
+		'''
+		tmp_fname = '%s.%d.tmp' % (fname, os.getpid())
+		f = open(tmp_fname, 'wb')
+		np.savez(f, nside=self.nside, nested=self.nested, pix_index=self.pix_index, data=self.W.data, indices=self.W.indices, indptr=self.W.indptr)
+		f.close()
+		os.rename(tmp_fname, fname)
+	
+	def normalized(self):
+		'''
+		W, with each row normalized to unit sum (rows of pixels without
+		neighbors remain zero).
+		'''
+		if self.W_norm is None:
+			row_sum = np.asarray(self.W.sum(axis=1)).flatten()
+			scale = np.zeros(row_sum.size, dtype=np.float64)
+			scale[row_sum > 0.] = 1. / row_sum[row_sum > 0.]
+			self.W_norm = scipy.sparse.diags(scale, 0).dot(self.W).tocsr()
+		return self.W_norm
+	
+	def has_neighbors(self):
+		return np.diff(self.W.indptr) != 0
+	
+	def apply(self, W, values):
+		'''
+		Multiply <values> (with pixels along the last axis) by W.
+		'''
+		values = np.asarray(values, dtype=np.float64)
+		return W.dot(values.T).T
+	
+	def neighbor_mean(self, values):
+		'''
+		Weighted mean of the values in the neighbors of each pixel (NaN
+		for pixels without neighbors).
+		'''
+		mean = self.apply(self.normalized(), values)
+		mean[..., ~self.has_neighbors()] = np.NaN
+		return mean
+	
+	def smooth(self, values, self_weight=1., N_iter=1):
+		'''
+		Smooth the given map by replacing each pixel with the weighted
+		mean of itself (with weight <self_weight>) and its neighbors,
+		<N_iter> times.
+		'''
+		values = np.array(values, dtype=np.float64)
+		norm = self_weight + np.asarray(self.W.sum(axis=1)).flatten()
+		for i in xrange(N_iter):
+			values = (self_weight * values + self.apply(self.W, values)) / norm
+		return values
+	
+	def tension(self, values):
+		'''
+		Tension between each pixel and its neighbors, as in the neighbor
+		term of fit_pdfs.nlopt_measure:
+		    
+		    sum_j (w_ij (x_j - x_i) / (2 * 10 * 10))^2,
+		
+		with the weights normalized over the neighbors of each pixel. The
+		values should be in the units used by the fit. For maps with more
+		than one dimension, the tension is summed over all but the last
+		axis.
+		'''
+		values = np.asarray(values, dtype=np.float64)
+		W_norm = self.normalized()
+		W2 = W_norm.multiply(W_norm).tocsr()
+		W2_sum = np.asarray(W2.sum(axis=1)).flatten()
+		t = self.apply(W2, values * values) - 2. * values * self.apply(W2, values)
+		t += values * values * W2_sum
+		t = np.maximum(t, 0.) / (2. * 10. * 10.)**2
+		if t.ndim > 1:
+			t = np.sum(t.reshape(int(np.prod(t.shape[:-1])), t.shape[-1]), axis=0)
+		return t
+	
+	def inconsistency(self, values):
+		'''
+		Deviation of each pixel from the weighted mean of its neighbors,
+		in units of the robust (median absolute deviation) scatter of
+		these residuals over the map. For maps with more than one
+		dimension, the largest deviation over all but the last axis is
+		returned. Pixels without neighbors are assigned NaN.
+		'''
+		values = np.asarray(values, dtype=np.float64)
+		resid = values - self.neighbor_mean(values)
+		resid = resid.reshape(int(np.prod(resid.shape[:-1])), resid.shape[-1])
+		score = np.zeros(resid.shape, dtype=np.float64)
+		for k,r in enumerate(resid):
+			valid = np.isfinite(r)
+			if not np.any(valid):
+				score[k] = np.NaN
+				continue
+			scale = 1.4826 * np.median(np.abs(r[valid] - np.median(r[valid])))
+			if scale <= 0.:
+				scale = np.inf
+			score[k] = np.abs(r) / scale
+		score = np.max(score, axis=0)
+		score[~self.has_neighbors()] = np.NaN
+		return score
+
+
+def load_graph(fname):
+	'''
+	Load a neighbor graph saved by NeighborGraph.save.
+	'''
+	d = np.load(fname)
+	N_pix = d['pix_index'].size
+	W = scipy.sparse.csr_matrix((d['data'], d['indices'], d['indptr']), shape=(N_pix, N_pix))
+	return NeighborGraph(int(d['nside']), bool(d['nested']), d['pix_index'], W)
+
+
+def graph_for_map(m, cache_dir=None):
+	'''
+	Return the neighbor graph of the valid pixels of an ExtinctionMap,
+	along with the columns of Ar holding these pixels. If <cache_dir>
+	is given, the graph is cached there per (nside, ordering, set of
+	valid pixels), and is only built if it is not already in the cache.
+	'''
+	if isinstance(m, hputils.AdaptiveExtinctionMap):
+		raise ValueError('Neighbor graphs are only defined for healpix maps of a single nside.')
+	col = np.where(np.isfinite(m.Ar[0]))[0]
+	pix_index = col
+	if m.is_sparse():
+		pix_index = m.sparse_index[col]
+	
+	if cache_dir is None:
+		return NeighborGraph(m.nside, m.nested, pix_index), col
+	
+	fname = cache_fname(cache_dir, m.nside, m.nested, pix_index)
+	if exists(fname):
+		graph = load_graph(fname)
+		if np.array_equal(graph.pix_index, pix_index):
+			return graph, col
+	graph = NeighborGraph(m.nside, m.nested, pix_index)
+	if not exists(cache_dir):
+		os.makedirs(cache_dir)
+	graph.save(fname)
+	
+	return graph, col
+
+
+def main():
+	parser = argparse.ArgumentParser(prog='neighbor_graph.py', description='Check an extinction map for pixels inconsistent with their neighbors, and optionally smooth it, using a cached sparse neighbor graph.', add_help=True)
+	parser.add_argument('map', type=str, help='Extinction map (FITS) produced by make_map.py.')
+	parser.add_argument('-c', '--cache', type=str, default=None, help='Directory in which neighbor graphs are cached (default: directory containing the map).')
+	parser.add_argument('-ns', '--n_sigma', type=float, default=5., help='Flag pixels deviating from their neighbors by more than this many times the typical scatter (default: 5).')
+	parser.add_argument('-no', '--N_outliers', type=int, default=20, help='# of most inconsistent pixels to list (default: 20).')
+	parser.add_argument('-s', '--smooth', type=str, default=None, help='Output filename (FITS) for smoothed map.')
+	parser.add_argument('-it', '--iterations', type=int, default=1, help='# of smoothing passes (default: 1).')
+	parser.add_argument('-sw', '--self_weight', type=float, default=1., help='Weight of each pixel relative to a neighbor at zero separation, when smoothing (default: 1).')
+	if 'python' in sys.argv[0]:
+		offset = 2
+	else:
+		offset = 1
+	values = parser.parse_args(sys.argv[offset:])
+	
+	cache_dir = values.cache
+	if cache_dir is None:
+		cache_dir = dirname(abspath(values.map))
+	m = hputils.ExtinctionMap(abspath(values.map), FITS=True, lazy=True)
+	graph, col = graph_for_map(m, cache_dir)
+	print '%d pixel(s), %d neighbor link(s).' % (len(graph), graph.W.nnz)
+	
+	# Compare the reddening in each distance bin with that of the neighbors
+	Ar = np.asarray(m.Ar[:, col], dtype=np.float64)
+	Delta_Ar = Ar.copy()
+	Delta_Ar[1:] -= Ar[:-1]
+	tension = graph.tension(Delta_Ar)
+	score = graph.inconsistency(Delta_Ar)
+	flagged = np.where(np.nan_to_num(score) > values.n_sigma)[0]
+	print 'Mean tension with neighbors: %.4g' % np.mean(tension)
+	print '%d pixel(s) deviate from their neighbors by more than %.1f sigma.' % (flagged.size, values.n_sigma)
+	
+	if flagged.size != 0:
+		flagged = flagged[np.argsort(-score[flagged])][:values.N_outliers]
+		theta, phi = hp.pix2ang(m.nside, graph.pix_index[flagged], nest=m.nested)
+		l, b = hputils.thetaphi2lb(theta, phi)
+		print '%10s %8s %8s %8s' % ('pixel', 'l', 'b', 'sigma')
+		for i,k in enumerate(flagged):
+			print '%10d %8.3f %8.3f %8.2f' % (graph.pix_index[k], l[i], b[i], score[k])
+	
+	# Smooth the map
+	if values.smooth is not None:
+		m_smooth = hputils.ExtinctionMap(nside=m.nside, nested=m.nested, mu=m.mu, sparse=True)
+		m_smooth.sparse_index = graph.pix_index
+		m_smooth.Ar = graph.smooth(Ar, self_weight=values.self_weight, N_iter=values.iterations)
+		m_smooth.N_stars = np.array(m.N_stars[col], dtype=np.uint32)
+		m_smooth.measure = np.array(m.measure[col], dtype=np.float64)
+		if not m.is_sparse():
+			m_smooth.to_dense()
+		m_smooth.save(values.smooth)
+		print 'Saved smoothed map to %s.' % values.smooth
+	
+	return 0
+
+if __name__ == '__main__':
+	main()
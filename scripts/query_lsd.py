@@ -32,11 +32,114 @@ import pyfits
 import lsd
 
 import iterators
+import input_info
 
 import matplotlib.pyplot as plt
 
 
-def mapper(qresult, nside, nest, bounds):
+def lb2vec(l, b):
+	'''
+	Unit vectors pointing towards Galactic (l, b), in degrees.
+	'''
+	return hp.ang2vec(np.pi/180. * (90. - np.asarray(b, dtype=np.float64)), np.pi/180. * np.asarray(l, dtype=np.float64))
+
+
+def footprint_pixels(nside, nest, bounds=None, discs=None, polygons=None, chunk_size=2**22):
+	'''
+	Sorted array of the pixels in a footprint. A pixel is in the
+	footprint if its center lies within <bounds> (if given), and within
+	one of the <discs> or <polygons> (if any are given).
+	
+	Input:
+	    bounds      (l_min, l_max, b_min, b_max), in degrees
+	    discs       List of (l, b, radius), in degrees
+	    polygons    List of convex polygons, each given by the (l, b) of
+	                its vertices, in degrees: (l_0, b_0, l_1, b_1, ...)
+	'''
+	N_pix = hp.nside2npix(nside)
+	
+	# Pixels whose centers lie in one of the discs or polygons
+	pix_shapes = None
+	if (discs is not None) or (polygons is not None):
+		pix_shapes = []
+		for l, b, radius in (discs or []):
+			pix_shapes.append(hp.query_disc(nside, lb2vec(l, b), np.pi/180. * radius, nest=nest))
+		for vertices in (polygons or []):
+			vertices = np.reshape(vertices, (-1, 2))
+			pix_shapes.append(hp.query_polygon(nside, lb2vec(vertices[:,0], vertices[:,1]), nest=nest))
+		pix_shapes = np.unique(np.concatenate(pix_shapes).astype(np.int64))
+		if bounds is None:
+			return pix_shapes
+	
+	# Pixels whose centers lie within the bounds, in chunks of pixels
+	N_candidates = N_pix if pix_shapes is None else pix_shapes.size
+	pix_bounds = [np.empty(0, dtype=np.int64)]
+	for start in xrange(0, N_candidates, chunk_size):
+		if pix_shapes is None:
+			pix = np.arange(start, min(start + chunk_size, N_pix), dtype=np.int64)
+		else:
+			pix = pix_shapes[start:start+chunk_size]
+		theta_0, phi_0 = hp.pix2ang(nside, pix, nest=nest)
+		l_0 = 180./np.pi * phi_0
+		b_0 = 90. - 180./np.pi * theta_0
+		pix_bounds.append(pix[(l_0 >= bounds[0]) & (l_0 <= bounds[1]) & (b_0 >= bounds[2]) & (b_0 <= bounds[3])])
+	
+	return np.concatenate(pix_bounds)
+
+
+def footprint_table(nside, nest, bounds=None, discs=None, polygons=None):
+	'''
+	Lookup table for membership in a footprint (see footprint_pixels):
+	a boolean array over all pixels, or the sorted array of pixels in the
+	footprint, whichever is smaller.
+	'''
+	pix = footprint_pixels(nside, nest, bounds, discs, polygons)
+	N_pix = hp.nside2npix(nside)
+	if 8 * pix.size < N_pix:
+		return pix
+	table = np.zeros(N_pix, dtype=np.bool)
+	table[pix] = True
+	return table
+
+
+def footprint_b_range(nside, nest, footprint, chunk_size=2**22):
+	'''
+	Range of Galactic latitude (b_min, b_max) spanned by the centers of
+	the pixels in a footprint, given its lookup table (see
+	footprint_table), or None if the footprint is empty.
+	'''
+	b_min, b_max = None, None
+	for start in xrange(0, footprint.size, chunk_size):
+		if footprint.dtype == np.bool:
+			pix = start + np.nonzero(footprint[start:start+chunk_size])[0]
+		else:
+			pix = footprint[start:start+chunk_size]
+		if pix.size == 0:
+			continue
+		theta_0, phi_0 = hp.pix2ang(nside, pix, nest=nest)
+		b_0 = 90. - 180./np.pi * theta_0
+		b_min = np.min(b_0) if b_min is None else min(b_min, np.min(b_0))
+		b_max = np.max(b_0) if b_max is None else max(b_max, np.max(b_0))
+	if b_min is None:
+		return None
+	return b_min, b_max
+
+
+def in_footprint(pix_indices, footprint):
+	'''
+	Determine which of the given pixels are in a footprint, given its
+	lookup table (see footprint_table).
+	'''
+	if footprint.dtype == np.bool:
+		return footprint[pix_indices]
+	if footprint.size == 0:
+		return np.zeros(len(pix_indices), dtype=np.bool)
+	idx = np.searchsorted(footprint, pix_indices)
+	idx[idx == footprint.size] = 0
+	return (footprint[idx] == pix_indices)
+
+
+def mapper(qresult, nside, nest, footprint):
 	obj = lsd.colgroup.fromiter(qresult, blocks=True)
 	
 	if (obj != None) and (len(obj) > 0):
@@ -45,16 +148,16 @@ def mapper(qresult, nside, nest, bounds):
 		phi = np.pi/180. * obj['l']
 		pix_indices = hp.ang2pix(nside, theta, phi, nest=nest)
 		
+		# Filter out stars outside of the footprint, before grouping
+		if footprint is not None:
+			mask = in_footprint(pix_indices, footprint)
+			if not np.any(mask):
+				return
+			obj = obj[mask]
+			pix_indices = pix_indices[mask]
+		
 		# Group together stars having same index
 		for pix_index, block_indices in iterators.index_by_key(pix_indices):
-			# Filter out pixels by bounds
-			if bounds != None:
-				theta_0, phi_0 = hp.pix2ang(nside, pix_index, nest=nest)
-				l_0 = 180./np.pi * phi_0
-				b_0 = 90. - 180./np.pi * theta_0
-				if (l_0 < bounds[0]) or (l_0 > bounds[1]) or (b_0 < bounds[2]) or (b_0 > bounds[3]):
-					continue
-			
 			yield (pix_index, obj[block_indices])
 
 
@@ -93,6 +196,8 @@ def main():
 	parser.add_argument('out', type=str, help='Base filename for output.')
 	parser.add_argument('-n', '--nside', type=int, default=512, help='Healpix nside parameter (default: 512).')
 	parser.add_argument('-b', '--bounds', type=float, nargs=4, default=None, help='Restrict pixels to region enclosed by: l_min, l_max, b_min, b_max.')
+	parser.add_argument('-disc', '--disc', type=float, nargs=3, action='append', default=None, help='Restrict pixels to a disc: l, b, radius (in degrees). May be given more than once, in which case pixels in any of the discs or polygons are kept.')
+	parser.add_argument('-poly', '--polygon', type=float, nargs='+', action='append', default=None, help='Restrict pixels to a convex polygon, given by the (l, b) of its vertices: l_0 b_0 l_1 b_1 ... May be given more than once.')
 	parser.add_argument('-fs', '--filesize', type=int, default=85000, help='Number of stars per input file (default: 85000).')
 	parser.add_argument('-min', '--min_stars', type=int, default=5, help='Minimum # of stars in pixel.')
 	parser.add_argument('-sdss', '--sdss', action='store_true', help='Only select objects identified in the SDSS catalog as stars.')
@@ -105,15 +210,32 @@ def main():
 		offset = 1
 	values = parser.parse_args(sys.argv[offset:])
 	
-	# Determine the query bounds
+	for vertices in (values.polygon or []):
+		if (len(vertices) < 6) or (len(vertices) % 2 != 0):
+			print 'Each polygon requires at least three (l, b) vertices.'
+			return 1
+	
+	# Precompute the footprint, for filtering stars in the mapper
+	nest = (not values.ring)
+	footprint = None
+	if (values.bounds != None) or (values.disc is not None) or (values.polygon is not None):
+		footprint = footprint_table(values.nside, nest, values.bounds, values.disc, values.polygon)
+		N_footprint = np.sum(footprint) if footprint.dtype == np.bool else footprint.size
+		print '%d pixel(s) in footprint.' % N_footprint
+	
+	# Determine the query bounds, from the latitudes spanned by the footprint
 	query_bounds = None
-	if values.bounds != None:
+	if footprint is not None:
+		b_range = footprint_b_range(values.nside, nest, footprint)
+		if b_range is None:
+			print 'No pixels in specified bounds.'
+			return 0
 		query_bounds = []
 		query_bounds.append(0.)
 		query_bounds.append(360.)
 		pix_height = 90. / 2**np.sqrt(values.nside / 12)
-		query_bounds.append(max(-90., values.bounds[2] - 5.*pix_height))
-		query_bounds.append(min(90., values.bounds[3] + 5.*pix_height))
+		query_bounds.append(max(-90., b_range[0] - 5.*pix_height))
+		query_bounds.append(min(90., b_range[1] + 5.*pix_height))
 	else:
 		query_bounds = [0., 360., -90., 90.]
 	query_bounds = lsd.bounds.rectangle(query_bounds[0], query_bounds[2], query_bounds[1], query_bounds[3], coordsys='gal')
@@ -148,6 +270,8 @@ def main():
 		pix_map = np.zeros(12 * values.nside**2, dtype=np.uint64)
 	
 	f = None
+	fname = None
+	toc = None
 	findex = 0
 	N_stars_in_file = None
 	N_pix_in_file = None
@@ -160,8 +284,7 @@ def main():
 	b_max = -1.e100
 	
 	# Save each pixel to the file with the least number of stars
-	nest = (not values.ring)
-	for (pix_index, obj) in query.execute([(mapper, values.nside, nest, values.bounds), reducer], group_by_static_cell=True, bounds=query_bounds):
+	for (pix_index, obj) in query.execute([(mapper, values.nside, nest, footprint), reducer], group_by_static_cell=True, bounds=query_bounds):
 		N_pix_total += 1
 		N_stars_total += len(obj)
 		
@@ -170,8 +293,10 @@ def main():
 		
 		# Open new file, if necessary
 		if f is None:
-			f = open('%s_%d.in' % (base_fname, findex), 'wb')
+			fname = '%s_%d.in' % (base_fname, findex)
+			f = open(fname, 'wb')
 			f.write(np.array([0], dtype=np.uint32).tostring())
+			toc = []
 			findex += 1
 			N_stars_in_file = 0
 			N_pix_in_file = 0
@@ -200,6 +325,7 @@ def main():
 			b_min = gal_lb[1]
 		if gal_lb[1] > b_max:
 			b_max = gal_lb[1]
+		toc.append((pix_index, gal_lb[0], gal_lb[1], N_stars[0], f.tell()))
 		f.write(np.array([pix_index], dtype=np.uint32).tostring())	# Pixel index	(uint32)
 		f.write(gal_lb.tostring())									# (l, b)		(2 x float64)
 		f.write(N_stars.tostring())									# N_stars		(uint32)
@@ -222,6 +348,7 @@ def main():
 			f.seek(0)
 			f.write(np.array([N_pix_in_file], dtype=np.uint32).tostring())
 			f.close()
+			input_info.write_toc(fname, toc)
 			f = None
 			N_pix_used.append(N_pix_in_file)
 			N_saved.append(N_stars_in_file)
@@ -231,6 +358,7 @@ def main():
 		f.seek(0)
 		f.write(np.array([N_pix_in_file], dtype=np.uint32).tostring())
 		f.close()
+		input_info.write_toc(fname, toc)
 		N_pix_used.append(N_pix_in_file)
 		N_saved.append(N_stars_in_file)
 	
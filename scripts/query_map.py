@@ -0,0 +1,151 @@
+#!/usr/bin/env python2.7
+# -*- coding: utf-8 -*-
+#
+#       query_map.py
+#       
+#       Copyright 2012 Greg <greg@greg-G53JW>
+#       
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 2 of the License, or
+#       (at your option) any later version.
+#       
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#       
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#       MA 02110-1301, USA.
+#       
+#       
+
+import sys, argparse
+from os.path import abspath
+
+import numpy as np
+import pyfits
+
+import healpix_utils as hputils
+
+
+def annotated_dtype(dtype, Ar_col, flag_col):
+	'''
+	Data type of the input catalog, with columns for Ar and the coverage
+	flags appended.
+	'''
+	return np.dtype(dtype.descr + [(Ar_col, 'f8'), (flag_col, 'u1')])
+
+
+def query_npy(m, infile, outfile, l_col='l', b_col='b', mu_col='DM', Ar_col='Ar', flag_col='Ar_flags', chunk_size=2**20):
+	'''
+	Stream a catalog stored as a structured .npy array through
+	ExtinctionMap.query. Both the input and the output are memory-mapped,
+	so that only one chunk of stars is held in memory at a time.
+	'''
+	d = np.load(abspath(infile), mmap_mode='r')
+	dtype = annotated_dtype(d.dtype, Ar_col, flag_col)
+	out = np.lib.format.open_memmap(abspath(outfile), mode='w+', dtype=dtype, shape=d.shape)
+	
+	N_covered = 0
+	for start in xrange(0, d.size, chunk_size):
+		end = min(start + chunk_size, d.size)
+		chunk = d[start:end]
+		Ar, flags = m.query(chunk[l_col], chunk[b_col], chunk[mu_col], chunk_size=chunk_size)
+		for name in d.dtype.names:
+			out[name][start:end] = chunk[name]
+		out[Ar_col][start:end] = Ar
+		out[flag_col][start:end] = flags
+		N_covered += np.sum(flags == 0)
+	
+	out.flush()
+	del out
+	
+	return d.size, N_covered
+
+
+def query_fits(m, infile, outfile, l_col='l', b_col='b', mu_col='DM', Ar_col='Ar', flag_col='Ar_flags', chunk_size=2**20):
+	'''
+	Stream a catalog stored as a FITS binary table through
+	ExtinctionMap.query, writing the catalog with columns for Ar and the
+	coverage flags appended. The input table is memory-mapped, and the
+	output table is written one chunk of rows at a time, after a header
+	giving the final number of rows.
+	'''
+	f = pyfits.open(abspath(infile), memmap=True)
+	hdu = f[1]
+	if hdu.header.get('PCOUNT', 0) != 0:
+		f.close()
+		raise ValueError('Variable-length columns in %s are not supported.' % infile)
+	d = hdu.data
+	N_stars = d.shape[0]
+	
+	# Rows as stored in the file (big-endian, unscaled), plus the new columns
+	raw = d.view(np.ndarray)
+	dtype = np.dtype(raw.dtype.descr + [(Ar_col, '>f8'), (flag_col, 'u1')])
+	
+	# Header of the output table, built from its first row only
+	cols = hdu.columns + pyfits.ColDefs([pyfits.Column(name=Ar_col, format='D', unit='MAGS'), pyfits.Column(name=flag_col, format='B')])
+	header = pyfits.new_table(cols, header=hdu.header, nrows=1).header
+	header.update('NAXIS2', N_stars)
+	if header['NAXIS1'] != dtype.itemsize:
+		f.close()
+		raise ValueError('Unexpected row size in %s.' % infile)
+	
+	out = open(abspath(outfile), 'wb')
+	out.write(pyfits.PrimaryHDU().header.tostring())
+	out.write(header.tostring())
+	
+	N_covered = 0
+	for start in xrange(0, N_stars, chunk_size):
+		end = min(start + chunk_size, N_stars)
+		chunk = np.empty(end - start, dtype=dtype)
+		for name in raw.dtype.names:
+			chunk[name] = raw[name][start:end]
+		chunk[Ar_col], chunk[flag_col] = m.query(d.field(l_col)[start:end], d.field(b_col)[start:end], d.field(mu_col)[start:end], chunk_size=chunk_size)
+		chunk.tofile(out)
+		N_covered += np.sum(chunk[flag_col] == 0)
+	
+	# Pad the data to a whole number of FITS blocks
+	out.write('\0' * (-(N_stars * dtype.itemsize) % 2880))
+	out.close()
+	f.close()
+	
+	return N_stars, N_covered
+
+
+def main():
+	parser = argparse.ArgumentParser(prog='query_map.py', description='Annotate a catalog of stars with Ar from an extinction map, evaluated at the position and distance modulus of each star.', add_help=True)
+	parser.add_argument('map', type=str, help='Extinction map (FITS) produced by make_map.py.')
+	parser.add_argument('input', type=str, help='Input catalog (FITS binary table or structured .npy array).')
+	parser.add_argument('output', type=str, help='Output catalog, in the same format as the input.')
+	parser.add_argument('-l', '--l_col', type=str, default='l', help='Column containing Galactic longitude, in degrees (default: l).')
+	parser.add_argument('-b', '--b_col', type=str, default='b', help='Column containing Galactic latitude, in degrees (default: b).')
+	parser.add_argument('-mu', '--mu_col', type=str, default='DM', help='Column containing distance modulus (default: DM).')
+	parser.add_argument('-A', '--Ar_col', type=str, default='Ar', help='Name of output column for Ar (default: Ar).')
+	parser.add_argument('-fl', '--flag_col', type=str, default='Ar_flags', help='Name of output column for coverage flags (default: Ar_flags).')
+	parser.add_argument('-ch', '--chunk', type=int, default=2**20, help='# of stars to process at once (default: 2^20).')
+	if 'python' in sys.argv[0]:
+		offset = 2
+	else:
+		offset = 1
+	values = parser.parse_args(sys.argv[offset:])
+	
+	m = hputils.ExtinctionMap(abspath(values.map), FITS=True, lazy=True)
+	
+	kwargs = {'l_col':values.l_col, 'b_col':values.b_col, 'mu_col':values.mu_col, 'Ar_col':values.Ar_col, 'flag_col':values.flag_col, 'chunk_size':values.chunk}
+	if values.input.endswith('.npy'):
+		N_stars, N_covered = query_npy(m, values.input, values.output, **kwargs)
+	else:
+		N_stars, N_covered = query_fits(m, values.input, values.output, **kwargs)
+	del m
+	
+	print '%d of %d star(s) covered by map.' % (N_covered, N_stars)
+	print 'Flags: %d = pixel not in map, %d = distance modulus outside anchors.' % (hputils.QUERY_NO_PIXEL, hputils.QUERY_MU_RANGE)
+	
+	return 0
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,333 @@
+#!/usr/bin/env python2.7
+# -*- coding: utf-8 -*-
+#
+#       reddening_io.py
+#       
+#       Copyright 2012 Greg <greg@greg-G53JW>
+#       
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 2 of the License, or
+#       (at your option) any later version.
+#       
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#       
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#       MA 02110-1301, USA.
+#       
+#       
+
+import sys, argparse
+import struct
+import multiprocessing
+from os.path import abspath
+
+import numpy as np
+
+
+# Columnar profile files begin and end with this string
+PROFILE_MAGIC = 'GSPROF01'
+
+# Trailer: offsets of table, line_int offsets, line_int and index, followed by N_pix, N_anchors and PROFILE_MAGIC
+TRAILER_SIZE = 7 * 8
+
+
+def profile_dtype(N_anchors):
+	'''
+	Data type of one row in the per-pixel table of a columnar
+	profile file.
+	'''
+	return np.dtype([('pix_index', 'u8'), ('N_stars', 'u4'), ('success', 'u2'), ('N_regions', 'u2'), ('measure', 'f8'), ('mu_anchors', 'f8', N_anchors), ('Ar_anchors', 'f8', N_anchors)])
+
+
+def is_profile_file(fname):
+	'''
+	Return True if <fname> is a columnar profile file, and False if it
+	is (presumably) a file of records appended by fit_pdfs.py.
+	'''
+	f = open(abspath(fname), 'rb')
+	magic = f.read(len(PROFILE_MAGIC))
+	f.close()
+	return magic == PROFILE_MAGIC
+
+
+def scan_records(buf):
+	'''
+	Locate the variable-length pixel records appended by
+	fit_pdfs.output_profile in the string <buf>. A single pass is made
+	over the N_stars and N_regions fields, after which every other field
+	can be gathered with vectorized indexing. A truncated record at the
+	end of the buffer is ignored.
+	
+	Output:
+	    offsets    Byte offset of each record (np.int64)
+	    N_stars    # of stars in each record
+	    N_regions  # of piecewise-linear regions in each record
+	'''
+	size = len(buf)
+	offsets, N_stars, N_regions = [], [], []
+	unpack_header = struct.Struct('<8xI10xH').unpack_from
+	
+	o = 0
+	while o + 24 <= size:
+		n, r = unpack_header(buf, o)
+		o_next = o + 24 + 8 * (n + 2 * (r + 1))
+		if o_next > size:
+			break
+		offsets.append(o)
+		N_stars.append(n)
+		N_regions.append(r)
+		o = o_next
+	
+	return np.array(offsets, dtype=np.int64), np.array(N_stars, dtype=np.int64), np.array(N_regions, dtype=np.int64)
+
+
+def gather(buf, offsets, dtype, count=1):
+	'''
+	Gather <count> values of type <dtype> starting at each of the given
+	byte offsets into <buf>.
+	'''
+	dtype = np.dtype(dtype)
+	nbytes = dtype.itemsize * count
+	idx = offsets[:,None] + np.arange(nbytes)[None,:]
+	return buf[idx].view(dtype).reshape(offsets.size, count)
+
+
+def read_records(fname, line_int=True):
+	'''
+	Read the variable-length pixel records appended to <fname> by
+	fit_pdfs.output_profile. The file is read into memory at once.
+	
+	Output:
+	    table     Structured array with one row per pixel (see profile_dtype)
+	    line_int  List of line integrals (flat np.float64 arrays) for each
+	              pixel, or None if <line_int> is False
+	'''
+	f = open(abspath(fname), 'rb')
+	buf = f.read()
+	f.close()
+	
+	offsets, N_stars, N_regions = scan_records(buf)
+	if offsets.size == 0:
+		return None, ([] if line_int else None)
+	N_anchors = N_regions[0] + 1
+	if np.any(N_regions != N_regions[0]):
+		raise ValueError('Pixels in %s do not share the same # of anchors.' % fname)
+	
+	# Gather the fields of every record. Each record is a whole number of
+	# 8-byte words long, so pix_index and the anchors are word-aligned, and
+	# can be indexed directly. Only measure and success are misaligned.
+	buf_arr = np.frombuffer(buf, dtype=np.uint8)
+	words = np.frombuffer(buf, dtype=np.float64, count=len(buf)//8)
+	table = np.empty(offsets.size, dtype=profile_dtype(N_anchors))
+	table['pix_index'] = words.view(np.uint64)[offsets // 8]
+	table['N_stars'] = N_stars
+	table['measure'] = gather(buf_arr, offsets+12, np.float64)[:,0]
+	table['success'] = gather(buf_arr, offsets+20, np.uint16)[:,0]
+	table['N_regions'] = N_regions
+	anchor_words = (offsets + 24 + 8 * N_stars) // 8
+	table['mu_anchors'] = words[anchor_words[:,None] + np.arange(N_anchors)]
+	table['Ar_anchors'] = words[anchor_words[:,None] + np.arange(N_anchors, 2*N_anchors)]
+	
+	if not line_int:
+		return table, None
+	
+	line_int = [np.frombuffer(buf, dtype=np.float64, count=n, offset=o+24) for o,n in zip(offsets, N_stars)]
+	
+	return table, line_int
+
+
+def load_table(fname):
+	'''
+	Load the per-pixel table from either a columnar profile file or a
+	file of records appended by fit_pdfs.py.
+	'''
+	if is_profile_file(fname):
+		pf = ProfileFile(fname)
+		table = pf.table
+		pf.close()
+		return table
+	else:
+		return read_records(fname, line_int=False)[0]
+
+
+def load_tables(fnames, N_procs=None):
+	'''
+	Iterate over the per-pixel tables of the given files (in order),
+	loading the files concurrently in a pool of <N_procs> processes.
+	Files without any pixels yield None.
+	'''
+	if type(fnames) is str:
+		fnames = [fnames]
+	
+	if (len(fnames) < 2) or (N_procs == 1):
+		for fname in fnames:
+			yield load_table(fname)
+		return
+	
+	pool = multiprocessing.Pool(N_procs)
+	try:
+		for table in pool.imap(load_table, fnames):
+			yield table
+	finally:
+		pool.close()
+		pool.join()
+
+
+def write_profiles(fname, table, line_int=None):
+	'''
+	Write a columnar profile file.
+	
+	Layout:
+	    PROFILE_MAGIC
+	    table           (profile_dtype) x N_pix
+	    offsets         (uint64) x (N_pix + 1)
+	    line_int        (float64) x sum(N_stars)
+	    index           pix_index (uint64) x N_pix, row (uint64) x N_pix,
+	                    sorted by pix_index
+	    trailer         offsets of the above four blocks, N_pix, N_anchors
+	                    (uint64 each), PROFILE_MAGIC
+	
+	Input:
+	    fname     Output filename
+	    table     Structured array with one row per pixel (see profile_dtype)
+	    line_int  List of line integrals for each pixel. If None, no line
+	              integrals are stored.
+	'''
+	N_pix = table.size
+	N_anchors = table.dtype['mu_anchors'].shape[0]
+	
+	# Offset of each pixel's line integrals into the ragged store
+	offsets = np.zeros(N_pix+1, dtype=np.uint64)
+	if line_int is not None:
+		if len(line_int) != N_pix:
+			raise ValueError('<line_int> must contain one array per pixel.')
+		offsets[1:] = np.cumsum([l.size for l in line_int])
+	
+	# Index sorted by pixel number
+	order = np.argsort(table['pix_index'], kind='mergesort').astype(np.uint64)
+	
+	f = open(abspath(fname), 'wb')
+	f.write(PROFILE_MAGIC)
+	block_offsets = np.empty(4, dtype=np.uint64)
+	block_offsets[0] = f.tell()
+	f.write(table.astype(profile_dtype(N_anchors)).tostring())
+	block_offsets[1] = f.tell()
+	f.write(offsets.tostring())
+	block_offsets[2] = f.tell()
+	if line_int is not None:
+		for l in line_int:
+			f.write(np.asarray(l, dtype=np.float64).tostring())
+	block_offsets[3] = f.tell()
+	f.write(table['pix_index'][order].astype(np.uint64).tostring())
+	f.write(order.tostring())
+	f.write(block_offsets.tostring())
+	f.write(np.array([N_pix, N_anchors], dtype=np.uint64).tostring())
+	f.write(PROFILE_MAGIC)
+	f.close()
+
+
+class ProfileFile(object):
+	'''
+	Columnar profile file, opened for reading. The per-pixel table and
+	the index are loaded when the file is opened, while line integrals
+	are read from disk on demand.
+	'''
+	
+	def __init__(self, fname):
+		self.fname = abspath(fname)
+		self.f = open(self.fname, 'rb')
+		
+		# Read the trailer
+		self.f.seek(-TRAILER_SIZE, 2)
+		trailer = self.f.read(TRAILER_SIZE)
+		if trailer[-len(PROFILE_MAGIC):] != PROFILE_MAGIC:
+			raise IOError('%s is not a columnar profile file.' % fname)
+		self.block_offsets = np.fromstring(trailer[:32], dtype=np.uint64)
+		self.N_pix, self.N_anchors = [int(n) for n in np.fromstring(trailer[32:48], dtype=np.uint64)]
+		
+		# Load the per-pixel table, the line-integral offsets and the index, each in one read
+		self.f.seek(int(self.block_offsets[0]), 0)
+		self.table = np.fromfile(self.f, dtype=profile_dtype(self.N_anchors), count=self.N_pix)
+		self.f.seek(int(self.block_offsets[1]), 0)
+		self.offsets = np.fromfile(self.f, dtype=np.uint64, count=self.N_pix+1)
+		self.f.seek(int(self.block_offsets[3]), 0)
+		self.index_pix = np.fromfile(self.f, dtype=np.uint64, count=self.N_pix)
+		self.index_row = np.fromfile(self.f, dtype=np.uint64, count=self.N_pix)
+	
+	def __len__(self):
+		return self.N_pix
+	
+	def close(self):
+		self.f.close()
+	
+	def find(self, pix_index):
+		'''
+		Return the row(s) in the table corresponding to the given
+		healpix pixel number(s), or -1 for pixels not in the file.
+		'''
+		pix_index = np.asarray(pix_index, dtype=np.uint64)
+		k = np.searchsorted(self.index_pix, pix_index)
+		k_clipped = np.minimum(k, self.N_pix-1)
+		found = (k < self.N_pix) & (self.index_pix[k_clipped] == pix_index)
+		return np.where(found, self.index_row[k_clipped].astype(np.int64), -1)
+	
+	def line_int(self, row):
+		'''
+		Read the line integrals of the stars in the given row of the
+		table.
+		'''
+		start, end = int(self.offsets[row]), int(self.offsets[row+1])
+		self.f.seek(int(self.block_offsets[2]) + 8 * start, 0)
+		return np.fromfile(self.f, dtype=np.float64, count=end-start)
+
+
+def pack_profiles(infiles, outfile):
+	'''
+	Combine files of records appended by fit_pdfs.py into a single
+	columnar profile file.
+	'''
+	if type(infiles) is str:
+		infiles = [infiles]
+	
+	tables, line_int = [], []
+	for fname in infiles:
+		table, l = read_records(fname)
+		if table is not None:
+			tables.append(table)
+			line_int += l
+	if len(tables) == 0:
+		raise ValueError('No pixels found in input files.')
+	N_anchors = set([t.dtype['mu_anchors'].shape[0] for t in tables])
+	if len(N_anchors) != 1:
+		raise ValueError('Input files do not share the same # of anchors.')
+	
+	table = np.concatenate(tables)
+	write_profiles(outfile, table, line_int)
+	
+	return table.size
+
+
+
+def main():
+	parser = argparse.ArgumentParser(prog='reddening_io.py', description='Pack reddening profiles generated by fit_pdfs.py into a columnar, indexed file.', add_help=True)
+	parser.add_argument('input', type=str, nargs='+', help='Reddening files generated by fit_pdfs.py.')
+	parser.add_argument('-o', '--out', type=str, required=True, help='Output filename.')
+	if 'python' in sys.argv[0]:
+		offset = 2
+	else:
+		offset = 1
+	values = parser.parse_args(sys.argv[offset:])
+	
+	N_pix = pack_profiles(values.input, values.out)
+	print 'Packed %d pixel(s) into %s.' % (N_pix, values.out)
+	
+	return 0
+
+if __name__ == '__main__':
+	main()
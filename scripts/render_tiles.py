@@ -0,0 +1,282 @@
+#!/usr/bin/env python2.7
+# -*- coding: utf-8 -*-
+#
+#       render_tiles.py
+#       
+#       Copyright 2012 Greg <greg@greg-G53JW>
+#       
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 2 of the License, or
+#       (at your option) any later version.
+#       
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#       
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#       MA 02110-1301, USA.
+#       
+#       
+
+import os, sys, argparse
+from os.path import abspath, exists, join
+import json, hashlib
+import multiprocessing
+
+import matplotlib as mplib
+mplib.use('Agg')
+import matplotlib.image
+
+import numpy as np
+import healpy as hp
+
+import healpix_utils as hputils
+
+
+# Map opened by each worker process
+_tile_map = None
+
+
+def tile_bounds(zoom, x, y):
+	'''
+	Bounds (l_min, l_max, b_min, b_max) of a tile. At zoom level <zoom>,
+	the sky is divided into 2^(zoom+1) columns and 2^zoom rows of tiles.
+	Column x = 0 starts at l = 360 (increasing x runs towards smaller l),
+	and row y = 0 starts at b = 90.
+	'''
+	dl = 360. / 2**(zoom+1)
+	db = 180. / 2**zoom
+	return [360. - (x+1) * dl, 360. - x * dl, 90. - (y+1) * db, 90. - y * db]
+
+
+def tiles_covering(l, b, zoom, margin=0.):
+	'''
+	Return the (x, y) indices of the tiles at the given zoom level which
+	lie within <margin> degrees of any of the given points.
+	'''
+	n_x, n_y = 2**(zoom+1), 2**zoom
+	dl = 360. / n_x
+	db = 180. / n_y
+	
+	# Sample each point's neighborhood finely enough not to skip tiles
+	steps = np.linspace(-margin, margin, int(np.ceil(2. * margin / min(dl, db))) + 2)
+	x_list, y_list = [], []
+	for dx in steps:
+		x_list.append(np.floor((360. - np.mod(l + dx, 360.)) / dl).astype(np.int64) % n_x)
+	for dy in steps:
+		y_list.append(np.clip(np.floor((90. - (b + dy)) / db).astype(np.int64), 0, n_y-1))
+	
+	tile_id = np.unique(np.concatenate([x * n_y + y for x in x_list for y in y_list]))
+	return tile_id // n_y, tile_id % n_y
+
+
+def tile_fname(out_dir, k, zoom, x, y, fmt):
+	'''
+	Filename of a tile at the <k>-th distance.
+	'''
+	return join(out_dir, '%d' % k, '%d' % zoom, '%d_%d.%s' % (x, y, fmt))
+
+
+def manifest_files(out_dir, manifest):
+	'''
+	Filenames of all the tiles listed in a manifest.
+	'''
+	settings = manifest['settings']
+	fnames = set()
+	for key in manifest['tiles']:
+		zoom, x, y = [int(s) for s in key.split('/')]
+		for k in xrange(len(settings['mu'])):
+			fnames.add(tile_fname(out_dir, k, zoom, x, y, settings['format']))
+	return fnames
+
+
+def init_worker(map_fname):
+	'''
+	Open the map lazily in each worker. The FITS file is memory-mapped,
+	so that its pages are shared between the workers.
+	'''
+	global _tile_map
+	_tile_map = hputils.ExtinctionMap(map_fname, FITS=True, lazy=True)
+
+
+def render_tile(task):
+	'''
+	Render one tile at every distance. The tile is skipped if the hash of
+	the reddening profiles it covers matches <old_hash> and all of its
+	files exist.
+	
+	Input (packed in <task>):
+	    zoom, x, y   Tile
+	    mu_eval      Distance moduli at which to render the tile
+	    tile_size    Width and height of the tile, in pixels
+	    fmt          'png' or 'npy' (raw float32)
+	    vmin, vmax   Color scale (for PNG tiles)
+	    cmap         Name of colormap (for PNG tiles)
+	    out_dir      Output directory
+	    old_hash     Hash of tile in previous render (or None)
+	
+	Output:
+	    key, hash, rendered  (hash is None if the tile contains no
+	                          valid pixels)
+	'''
+	zoom, x, y, mu_eval, tile_size, fmt, vmin, vmax, cmap, out_dir, old_hash = task
+	m = _tile_map
+	key = '%d/%d/%d' % (zoom, x, y)
+	
+	# Healpix pixels covered by the tile
+	proj = hputils.get_projection(m.nside, m.nested, tile_bounds(zoom, x, y), [tile_size, tile_size])
+	pix_index, inverse = np.unique(proj.pix, return_inverse=True)
+	
+	# Gather the reddening profiles in the tile
+	if m.is_sparse():
+		col, found = hputils.pixel_columns(m.sparse_index, pix_index)
+		Ar_anchors = m.Ar[:, col]
+		Ar_anchors[:, ~found] = np.NaN
+	else:
+		Ar_anchors = np.asarray(m.Ar[:, pix_index], dtype=np.float64)
+	if not np.any(np.isfinite(Ar_anchors[0])):
+		return key, None, False
+	
+	# Skip the tile if its profiles have not changed
+	tile_hash = hashlib.md5(pix_index.astype(np.int64).tostring() + Ar_anchors.tostring()).hexdigest()
+	fnames = [tile_fname(out_dir, k, zoom, x, y, fmt) for k in xrange(len(mu_eval))]
+	if (tile_hash == old_hash) and all([exists(f) for f in fnames]):
+		return key, tile_hash, False
+	
+	# Evaluate only the pixels in the tile, at all distances at once
+	Ar = hputils.interpolate_anchors(m.mu, Ar_anchors, mu_eval)
+	img = Ar[:, inverse].reshape(len(mu_eval), tile_size, tile_size)
+	
+	for subimg, fname in zip(img, fnames):
+		subimg = subimg.T[::-1]		# North up, l decreasing to the right
+		tile_dir = os.path.dirname(fname)
+		if not exists(tile_dir):
+			try:
+				os.makedirs(tile_dir)
+			except OSError:
+				pass
+		if fmt == 'png':
+			matplotlib.image.imsave(fname, subimg, vmin=vmin, vmax=vmax, cmap=cmap)
+		else:
+			np.save(fname, subimg.astype(np.float32))
+	
+	return key, tile_hash, True
+
+
+def render_pyramid(map_fname, out_dir, mu_eval, max_zoom=3, tile_size=256, fmt='png', vmin=0., vmax=None, cmap=None, N_procs=None, force=False):
+	'''
+	Render a tile pyramid of the extinction map in <map_fname> at the
+	given distance moduli, for zoom levels 0 through <max_zoom>. Only
+	tiles which lie near valid pixels are rendered. A manifest in
+	<out_dir> records the hash of each tile, so that rerunning over an
+	updated map only re-renders the tiles whose pixels have changed
+	(unless <force> is True). Tiles listed in the previous manifest which
+	are no longer produced are deleted.
+	
+	If <vmax> is not given, the color scale is set by the 99th percentile
+	of Ar at the largest distance. This is recorded in the manifest and
+	reused by later renders, so that the color scale (and thus every
+	tile) is only recomputed if <force> is True.
+	
+	Output:
+	    N_rendered, N_skipped
+	'''
+	map_fname = abspath(map_fname)
+	out_dir = abspath(out_dir)
+	mu_eval = [float(mu) for mu in mu_eval]
+	m = hputils.ExtinctionMap(map_fname, FITS=True, lazy=True)
+	
+	# Reuse tiles from a previous render with the same settings
+	settings = {'nside':m.nside, 'nested':m.nested, 'mu':mu_eval, 'tile_size':tile_size, 'format':fmt, 'vmin':vmin, 'max_Ar':vmax, 'cmap':cmap}
+	manifest_fname = join(out_dir, 'manifest.json')
+	old_manifest = None
+	old_tiles = {}
+	if exists(manifest_fname):
+		f = open(manifest_fname, 'r')
+		old_manifest = json.load(f)
+		f.close()
+		if (not force) and (old_manifest.get('settings') == json.loads(json.dumps(settings))):
+			old_tiles = old_manifest['tiles']
+	
+	# Color scale, computed once for all tiles
+	if vmax is None:
+		if (len(old_tiles) != 0) and ('vmax' in old_manifest):
+			vmax = old_manifest['vmax']
+		else:
+			vmax = m.Ar_percentile(99., mu_eval=max(mu_eval))
+	
+	# Determine which tiles contain valid pixels
+	col, l, b = m.valid_lb()
+	margin = 2. * hputils.rad2deg(hp.pixelfunc.nside2resol(m.nside))
+	tasks = []
+	for zoom in xrange(max_zoom+1):
+		x, y = tiles_covering(l, b, zoom, margin)
+		for xx, yy in zip(x, y):
+			key = '%d/%d/%d' % (zoom, xx, yy)
+			tasks.append((zoom, int(xx), int(yy), mu_eval, tile_size, fmt, vmin, vmax, cmap, out_dir, old_tiles.get(key)))
+	del m, col, l, b
+	
+	# Render tiles across a pool of processes, each memory-mapping the map
+	tiles = {}
+	N_rendered = 0
+	if N_procs == 1:
+		init_worker(map_fname)
+		results = (render_tile(t) for t in tasks)
+	else:
+		pool = multiprocessing.Pool(N_procs, init_worker, (map_fname,))
+		results = pool.imap_unordered(render_tile, tasks, chunksize=4)
+	for key, tile_hash, rendered in results:
+		if tile_hash is not None:
+			tiles[key] = tile_hash
+		N_rendered += int(rendered)
+	if N_procs != 1:
+		pool.close()
+		pool.join()
+	
+	# Write manifest
+	if not exists(out_dir):
+		os.makedirs(out_dir)
+	manifest = {'settings':settings, 'vmax':float(vmax), 'map':map_fname, 'max_zoom':max_zoom, 'tiles':tiles}
+	f = open(manifest_fname + '.tmp', 'w')
+	json.dump(manifest, f, indent=1, sort_keys=True)
+	f.close()
+	os.rename(manifest_fname + '.tmp', manifest_fname)
+	
+	# Remove stale tiles
+	if old_manifest is not None:
+		for fname in manifest_files(out_dir, old_manifest) - manifest_files(out_dir, manifest):
+			if exists(fname):
+				os.remove(fname)
+	
+	return N_rendered, len(tiles) - N_rendered
+
+
+def main():
+	parser = argparse.ArgumentParser(prog='render_tiles.py', description='Render a multi-zoom tile pyramid of an extinction map at a set of distances.', add_help=True)
+	parser.add_argument('map', type=str, help='Extinction map (FITS) produced by make_map.py.')
+	parser.add_argument('out', type=str, help='Output directory.')
+	parser.add_argument('-mu', '--mu', type=float, nargs='+', default=(5., 6.5, 8., 9.5, 11., 12.5, 14., 15.5, 17.), help='Distance moduli at which to render tiles.')
+	parser.add_argument('-z', '--zoom', type=int, default=3, help='Maximum zoom level (default: 3).')
+	parser.add_argument('-ts', '--tile_size', type=int, default=256, help='Width and height of each tile, in pixels (default: 256).')
+	parser.add_argument('-fmt', '--format', type=str, choices=('png', 'npy'), default='png', help='Tile format: PNG image or raw float32 array (default: png).')
+	parser.add_argument('-max', '--max_Ar', type=float, default=None, help='Maximum Ar in color scale (default: 99th percentile at the largest distance, kept from the previous render unless --force is given).')
+	parser.add_argument('-cm', '--cmap', type=str, default=None, help='Colormap for PNG tiles.')
+	parser.add_argument('-np', '--procs', type=int, default=None, help='# of processes with which to render tiles (default: # of CPUs).')
+	parser.add_argument('-f', '--force', action='store_true', help='Re-render all tiles, ignoring the existing manifest.')
+	if 'python' in sys.argv[0]:
+		offset = 2
+	else:
+		offset = 1
+	values = parser.parse_args(sys.argv[offset:])
+	
+	N_rendered, N_skipped = render_pyramid(values.map, values.out, values.mu, max_zoom=values.zoom, tile_size=values.tile_size, fmt=values.format, vmax=values.max_Ar, cmap=values.cmap, N_procs=values.procs, force=values.force)
+	print '%d tile(s) rendered, %d unchanged.' % (N_rendered, N_skipped)
+	
+	return 0
+
+if __name__ == '__main__':
+	main()
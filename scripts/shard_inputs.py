@@ -0,0 +1,331 @@
+#!/usr/bin/env python2.7
+# -*- coding: utf-8 -*-
+#
+#       shard_inputs.py
+#       
+#       Copyright 2012 Greg <greg@greg-G53JW>
+#       
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 2 of the License, or
+#       (at your option) any later version.
+#       
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#       
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#       MA 02110-1301, USA.
+#       
+#       
+
+import sys, argparse
+import json, heapq
+from os.path import abspath, getsize
+
+import numpy as np
+import scipy.optimize
+
+import input_info
+
+
+# Features of each pixel on which the galstar runtime is modeled to depend
+# linearly: a fixed overhead, the # of stars, the # of detections (star-band
+# pairs) and the summed precision, log10(1/err), of the detections
+COST_FEATURES = ('overhead', 'N_stars', 'N_det', 'precision')
+
+# # of bands, and the error which flags a nondetection
+N_BANDS = 5
+ERR_NONDETECT = 1.e10
+
+
+def pixel_features(err):
+	'''
+	Runtime features (see COST_FEATURES) of one pixel, given the
+	photometric errors (N_stars x N_BANDS) of its stars.
+	'''
+	det = (err < ERR_NONDETECT)
+	precision = -np.log10(np.clip(err[det], 1.e-3, 1.))
+	return np.array([1., err.shape[0], np.sum(det), np.sum(precision)], dtype=np.float64)
+
+
+def input_features(infile, star_bytes=input_info.STAR_BYTES, indices=None):
+	'''
+	Compute the runtime features of the pixels in a galstar input file.
+	The errors are the last N_BANDS doubles of each star, in both the
+	query_lsd.py and fits2galstarinput.py formats.
+	
+	Input:
+	    infile      galstar input file
+	    star_bytes  # of bytes per star
+	    indices     Pixels for which to compute features (default: all)
+	
+	Output:
+	    toc         Table of contents of the input file (see input_info)
+	    X           Features of the requested pixels (N_pix x N_features)
+	'''
+	toc, from_sidecar = input_info.load_toc(infile, star_bytes)
+	
+	# Check that the pixels exactly fill the file
+	size = 4
+	if toc.size != 0:
+		size = int(toc['offset'][-1]) + input_info.HEADER_BYTES + int(toc['N_stars'][-1]) * star_bytes
+	if size != getsize(infile):
+		raise ValueError('Input file %s is %d bytes, but its pixels take up %d bytes with %d bytes per star. The file may be corrupt, or use a different star format.' % (infile, getsize(infile), size, star_bytes))
+	
+	if indices is None:
+		indices = np.arange(toc.size)
+	
+	X = np.empty((len(indices), len(COST_FEATURES)), dtype=np.float64)
+	f = open(infile, 'rb')
+	for i,index in enumerate(indices):
+		row = toc[index]
+		f.seek(int(row['offset']) + input_info.HEADER_BYTES, 0)
+		data = np.fromfile(f, dtype=np.float64, count=int(row['N_stars']) * (star_bytes // 8))
+		X[i] = pixel_features(data.reshape(-1, star_bytes // 8)[:, -N_BANDS:])
+	f.close()
+	
+	return toc, X
+
+
+class CostModel():
+	'''
+	Linear model of the galstar runtime of a pixel, in terms of the
+	features in COST_FEATURES. By default, the cost of a pixel is its
+	# of stars.
+	'''
+	
+	def __init__(self, coeffs=None):
+		if coeffs is None:
+			coeffs = [0., 1., 0., 0.]
+		self.coeffs = np.array(coeffs, dtype=np.float64)
+		if self.coeffs.size != len(COST_FEATURES):
+			raise ValueError('Cost model must have one coefficient per feature in %s.' % (COST_FEATURES,))
+	
+	def predict(self, X):
+		return np.dot(X, self.coeffs)
+	
+	def fit(self, X, t):
+		'''
+		Fit the (non-negative) coefficients to the runtimes <t> of pixels
+		with features <X>, returning the rms relative error of the fit.
+		'''
+		self.coeffs, resid = scipy.optimize.nnls(X, np.asarray(t, dtype=np.float64))
+		t_pred = self.predict(X)
+		return np.sqrt(np.mean(((t_pred - t) / np.maximum(t, 1.e-3))**2))
+	
+	def save(self, fname):
+		f = open(fname, 'w')
+		json.dump({'features':list(COST_FEATURES), 'coeffs':list(self.coeffs)}, f, indent=1)
+		f.close()
+
+
+def load_cost_model(fname):
+	f = open(fname, 'r')
+	model = json.load(f)
+	f.close()
+	if tuple(model['features']) != COST_FEATURES:
+		raise ValueError('Cost model in %s uses features %s, rather than %s.' % (fname, model['features'], COST_FEATURES))
+	return CostModel(model['coeffs'])
+
+
+def read_timings(fnames):
+	'''
+	Read timing logs written by galstar_batch.sh. Each line contains
+	the input file, the index of the pixel in the file, its healpix
+	index and the runtime (in seconds).
+	
+	Output:
+	    Dictionary of {infile: (indices, runtimes)}
+	'''
+	timings = {}
+	for fname in fnames:
+		f = open(fname, 'r')
+		for line in f:
+			fields = line.split()
+			if (len(fields) != 4) or line.startswith('#'):
+				continue
+			indices, t = timings.setdefault(fields[0], ([], []))
+			indices.append(int(fields[1]))
+			t.append(float(fields[3]))
+		f.close()
+	return timings
+
+
+def fit_cost_model(log_fnames, star_bytes=input_info.STAR_BYTES):
+	'''
+	Calibrate a cost model from galstar timing logs. The input files
+	named in the logs must be readable.
+	
+	Output:
+	    model, rms relative error, # of pixels in fit
+	'''
+	X, t = [], []
+	for infile, (indices, runtimes) in read_timings(log_fnames).iteritems():
+		toc, X_file = input_features(infile, star_bytes, indices)
+		X.append(X_file)
+		t.append(runtimes)
+	if len(X) == 0:
+		raise ValueError('No timings found in %s.' % (', '.join(log_fnames)))
+	X = np.concatenate(X)
+	t = np.concatenate(t)
+	
+	model = CostModel()
+	err = model.fit(X, t)
+	return model, err, t.size
+
+
+def greedy_assign(order, weight, K, load=None):
+	'''
+	Assign items, taken in the given order, each to the bin with the
+	least total weight so far. Taking the items in order of decreasing
+	weight gives the LPT (longest processing time first) heuristic,
+	whose makespan is within 4/3 of the optimum. The bins may start
+	with the weights in <load>, which is updated in place.
+	
+	Output:
+	    shard   Bin of each item
+	'''
+	if load is None:
+		load = np.zeros(K, dtype=np.float64)
+	heap = [(load[k], k) for k in xrange(K)]
+	heapq.heapify(heap)
+	shard = np.empty(weight.size, dtype=np.int64)
+	for i in order:
+		w, k = heapq.heappop(heap)
+		shard[i] = k
+		heapq.heappush(heap, (w + weight[i], k))
+	for w, k in heap:
+		load[k] = w
+	return shard
+
+
+def lpt_assign(cost, K):
+	'''
+	Pack pixels with the given predicted costs into K shards.
+	'''
+	return greedy_assign(np.argsort(cost, kind='mergesort')[::-1], cost, K)
+
+
+def balance_stats(cost, shard, K):
+	'''
+	Predicted makespan (cost of the slowest shard), mean cost per
+	shard and imbalance (makespan / mean - 1) of an assignment.
+	'''
+	load = np.bincount(shard, weights=cost, minlength=K)
+	mean = np.sum(cost) / float(K)
+	return np.max(load), mean, np.max(load) / mean - 1.
+
+
+def write_shards(infiles, tocs, pixels, shard, K, out_base, star_bytes=input_info.STAR_BYTES):
+	'''
+	Copy the pixels into the galstar input files <out_base>_k.in, for
+	k = 0, ..., K-1, writing a table of contents for each.
+	
+	Input:
+	    infiles     Input files
+	    tocs        Table of contents of each input file
+	    pixels      (file #, pixel #) of each pixel (N_pix x 2)
+	    shard       Shard of each pixel
+	'''
+	fin = [open(infile, 'rb') for infile in infiles]
+	fnames = []
+	for k in xrange(K):
+		fname = '%s_%d.in' % (out_base, k)
+		members = np.nonzero(shard == k)[0]
+		f = open(fname, 'wb')
+		f.write(np.array([members.size], dtype=np.uint32).tostring())
+		toc = []
+		for i in members:
+			row = tocs[pixels[i, 0]][pixels[i, 1]]
+			toc.append((row['pix_index'], row['l'], row['b'], row['N_stars'], f.tell()))
+			src = fin[pixels[i, 0]]
+			src.seek(int(row['offset']), 0)
+			f.write(src.read(input_info.HEADER_BYTES + int(row['N_stars']) * star_bytes))
+		f.close()
+		input_info.write_toc(fname, toc)
+		fnames.append(fname)
+	for f in fin:
+		f.close()
+	return fnames
+
+
+def main():
+	parser = argparse.ArgumentParser(prog='shard_inputs.py', description='Split galstar input files into shards of equal predicted runtime.', add_help=True)
+	parser.add_argument('infiles', type=str, nargs='*', help='galstar input files.')
+	parser.add_argument('-o', '--out', type=str, default=None, help='Base filename for output shards (written to <out>_k.in).')
+	parser.add_argument('-k', '--shards', type=int, default=1, help='# of shards (default: 1).')
+	parser.add_argument('-cm', '--cost_model', type=str, default=None, help='Cost model (JSON). Written by --fit, and read otherwise (default: cost = # of stars).')
+	parser.add_argument('-fit', '--fit', type=str, nargs='+', default=None, help='Calibrate the cost model from timing logs written by galstar_batch.sh, and save it to --cost_model.')
+	parser.add_argument('-sb', '--star_bytes', type=int, default=input_info.STAR_BYTES, help='# of bytes per star in the input files (default: %d).' % input_info.STAR_BYTES)
+	if 'python' in sys.argv[0]:
+		offset = 2
+	else:
+		offset = 1
+	values = parser.parse_args(sys.argv[offset:])
+	
+	# Calibrate the cost model
+	if values.fit is not None:
+		if values.cost_model is None:
+			print '--fit requires --cost_model.'
+			return 1
+		model, err, N_fit = fit_cost_model([abspath(fname) for fname in values.fit], values.star_bytes)
+		model.save(abspath(values.cost_model))
+		print 'Fit cost model to %d pixel(s) (rms relative error: %.3f):' % (N_fit, err)
+		for name, c in zip(COST_FEATURES, model.coeffs):
+			print '\t%s: %.4g s' % (name, c)
+		if len(values.infiles) == 0:
+			return 0
+	elif values.cost_model is not None:
+		model = load_cost_model(abspath(values.cost_model))
+	else:
+		model = CostModel()
+	
+	if len(values.infiles) == 0:
+		print 'No input files given.'
+		return 1
+	if values.shards < 1:
+		print '--shards must be positive.'
+		return 1
+	
+	# Predict the cost of each pixel
+	infiles = [abspath(fname) for fname in values.infiles]
+	tocs, pixels, cost = [], [], []
+	for i,infile in enumerate(infiles):
+		toc, X = input_features(infile, values.star_bytes)
+		tocs.append(toc)
+		pixels.append(np.column_stack((np.repeat(i, toc.size), np.arange(toc.size))))
+		cost.append(model.predict(X))
+	pixels = np.concatenate(pixels)
+	cost = np.concatenate(cost)
+	N_stars = np.concatenate([toc['N_stars'] for toc in tocs]).astype(np.float64)
+	if cost.size == 0:
+		print 'No pixels in input files.'
+		return 1
+	
+	# Pack pixels into shards, and compare with balancing by # of stars
+	K = values.shards
+	shard = lpt_assign(cost, K)
+	makespan, mean, imbalance = balance_stats(cost, shard, K)
+	makespan_0, mean_0, imbalance_0 = balance_stats(cost, greedy_assign(np.arange(cost.size), N_stars, K), K)
+	print '%d pixel(s) in %d shard(s). Predicted cost per shard: %.4g (mean), %.4g (lower bound on makespan).' % (cost.size, K, mean, max(mean, np.max(cost)))
+	print 'Cost-based LPT:          makespan = %.4g, imbalance = %.1f%%' % (makespan, 100. * imbalance)
+	print 'Balancing # of stars:    makespan = %.4g, imbalance = %.1f%%' % (makespan_0, 100. * imbalance_0)
+	
+	if values.out is not None:
+		out_base = abspath(values.out)
+		if out_base.endswith('.in'):
+			out_base = out_base[:-3]
+		if any(['%s_%d.in' % (out_base, k) in infiles for k in xrange(K)]):
+			print 'Output shards would overwrite input files.'
+			return 1
+		fnames = write_shards(infiles, tocs, pixels, shard, K, out_base, values.star_bytes)
+		print 'Wrote %d shard(s) to %s_*.in.' % (len(fnames), out_base)
+	
+	return 0
+
+if __name__ == '__main__':
+	main()